@@ -0,0 +1,232 @@
+"""
+PypadAdmission.py
+
+INTRODUCTION
+Contains the AdmissionControl class, which rate limits the writes (setState
+and import calls) a PypadServer accepts, per client and for the whole
+document, with token buckets.
+
+Without it, one client calling setState in a tight loop (a script hammering
+PypadClientCore.modify, for example) makes a revision and a notification to
+every other client per call, and the server spends its time on that client
+while everyone else's edits wait.
+
+TOKEN BUCKETS
+Every client has a bucket of CLIENT_BURST tokens, refilled at CLIENT_RATE
+tokens per second, and the document has one of DOCUMENT_BURST tokens,
+refilled at DOCUMENT_RATE. A write takes a token from its client's bucket and
+one from the document's. Clients that stay under their rate never wait; a
+burst of up to CLIENT_BURST writes goes through at once.
+
+WAITING
+A write that finds a bucket empty is not dropped: it waits, within the
+request engine but without holding a handler (see RequestEngine.outside),
+until both buckets have a token again, and is applied then. A Pyro proxy
+sends one call at a time, so a client with one connection has at most one
+write waiting, and waiting slows it down to its rate: a flooding client
+costs the server at most its rate in revisions, whatever it sends. Waiting
+writes are not merged; a client's next write only arrives once the last
+one was applied.
+
+A client that has MAX_WAITING_WRITES writes waiting (through several
+connections) has further writes rejected with ValueError.
+
+getAdmissionStats (see PypadServer.py) returns the counters: writes admitted
+right away, delayed and rejected, in total and per client.
+"""
+
+from time import time
+import threading
+
+# writes per second each client may make, and how many it may make at once
+CLIENT_RATE = 50
+CLIENT_BURST = 100
+
+# writes per second of all clients together, and how many at once
+DOCUMENT_RATE = 500
+DOCUMENT_BURST = 1000
+
+# writes of a client that may wait at once
+MAX_WAITING_WRITES = 4
+
+class TokenBucket:
+    """Holds up to burst tokens, refilled at rate tokens per second"""
+    def __init__(self, rate, burst):
+        """
+        Constructor for TokenBucket
+
+        Args:
+            rate: float; tokens added per second, None for no limit
+            burst: int; the most tokens the bucket holds
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time()
+
+    def refill(self, now):
+        """Adds the tokens accrued since the last refill"""
+        if self.rate != None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now):
+        """Returns the seconds until the bucket has a token"""
+        self.refill(now)
+        if self.rate == None or self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class AdmissionControl:
+    """
+    Rate limits the writes to one document, see above
+    """
+    def __init__(self, outside=None, clientRate=CLIENT_RATE,
+                 clientBurst=CLIENT_BURST, documentRate=DOCUMENT_RATE,
+                 documentBurst=DOCUMENT_BURST):
+        """
+        Constructor for AdmissionControl
+
+        Args:
+            outside: function; outside(function, *args) calls function while
+                the calling request doesn't hold a handler, see
+                RequestEngine.outside. None to wait in place
+            clientRate, clientBurst: the rate and burst of every client's
+                bucket, see TokenBucket
+            documentRate, documentBurst: the rate and burst of the
+                document's bucket
+        """
+        self.outside = outside
+        self.lock = threading.Lock()
+        # waited on by the writes waiting for tokens; notified when the
+        # limits change
+        self.condition = threading.Condition(self.lock)
+        self.buckets = {}
+        self.setLimits(clientRate, clientBurst, documentRate, documentBurst)
+        # the number of writes waiting, by client
+        self.waiting = {}
+        # 'admitted', 'delayed' and 'rejected' counts, by client and in
+        # total. The totals include clients that went away
+        self.counts = {}
+        self.totals = {'admitted': 0, 'delayed': 0, 'rejected': 0}
+
+    def setLimits(self, clientRate, clientBurst, documentRate, documentBurst):
+        """
+        Changes the rates and bursts, see the constructor. Buckets start
+        full again
+        """
+        self.lock.acquire()
+        try:
+            self.clientRate = clientRate
+            self.clientBurst = clientBurst
+            self.buckets = {}
+            self.document = TokenBucket(documentRate, documentBurst)
+            self.condition.notifyAll()
+        finally:
+            self.lock.release()
+
+    def forget(self, client):
+        """Drops the bucket and counters of a client that went away"""
+        self.lock.acquire()
+        try:
+            self.buckets.pop(client, None)
+            self.counts.pop(client, None)
+        finally:
+            self.lock.release()
+
+    def count(self, client, counter):
+        """Adds one to a counter of client. Callers hold lock"""
+        counts = self.counts.setdefault(client, {'admitted': 0, 'delayed': 0,
+                                                 'rejected': 0})
+        counts[counter] += 1
+        self.totals[counter] += 1
+
+    def delay(self, client):
+        """
+        Returns the seconds until both client's bucket and the document's
+        have a token. Callers hold lock
+        """
+        bucket = self.buckets.get(client)
+        if bucket == None:
+            bucket = TokenBucket(self.clientRate, self.clientBurst)
+            self.buckets[client] = bucket
+        now = time()
+        return max(bucket.delay(now), self.document.delay(now))
+
+    def take(self, client):
+        """
+        Takes a token from both buckets if both have one, and returns
+        whether it did. Callers hold lock
+        """
+        if self.delay(client) > 0:
+            return False
+        self.buckets[client].tokens -= 1
+        self.document.tokens -= 1
+        return True
+
+    def admit(self, client, function, *args):
+        """
+        Returns function(*args), called once the rate limits allow a write
+        of client. Raises ValueError if too many of client's writes are 
+        waiting
+
+        Args:
+            client: string; name of the client writing
+            function: applies the write and returns its result
+        """
+        self.lock.acquire()
+        try:
+            if self.take(client):
+                self.count(client, 'admitted')
+                wait = False
+            elif self.waiting.get(client, 0) >= MAX_WAITING_WRITES:
+                self.count(client, 'rejected')
+                raise ValueError('too many writes of %s are waiting' %
+                                 client)
+            else:
+                self.waiting[client] = self.waiting.get(client, 0) + 1
+                self.count(client, 'delayed')
+                wait = True
+        finally:
+            self.lock.release()
+        if wait:
+            if self.outside != None:
+                self.outside(self.wait, client)
+            else:
+                self.wait(client)
+        return function(*args)
+
+    def wait(self, client):
+        """Waits until both buckets have a token for client, and takes it"""
+        self.condition.acquire()
+        try:
+            try:
+                while not self.take(client):
+                    self.condition.wait(self.delay(client))
+            finally:
+                self.waiting[client] -= 1
+                if not self.waiting[client]:
+                    del self.waiting[client]
+        finally:
+            self.condition.release()
+
+    def stats(self):
+        """
+        Returns a dictionary with
+            'admitted': writes applied right away
+            'delayed': writes that waited for tokens
+            'rejected': writes refused because too many were waiting
+            'waiting': writes waiting now
+            'clients': the three counters of each registered client, by 
+                client name
+        """
+        self.lock.acquire()
+        try:
+            stats = dict(self.totals)
+            stats['waiting'] = sum(self.waiting.values())
+            stats['clients'] = dict([(client, dict(counts)) for client, counts
+                                     in self.counts.items()])
+            return stats
+        finally:
+            self.lock.release()
@@ -0,0 +1,347 @@
+"""
+PypadArchive.py
+
+INTRODUCTION
+Contains exportArchive and importArchive, which write a PypadData object with
+its whole revision history and drawing to an archive file and read it back,
+and the ArchiveReader class, which reads single revisions out of an archive.
+
+Archives are meant for backups and for moving a document to another server.
+Both directions stream: exporting pages spilled history segments in one at a
+time (see PypadHistory.py), and importing appends revision by revision, so
+the history spills to disk again as it outgrows its memory budget. Neither
+needs the whole history in memory.
+
+FILE LAYOUT
+An archive is a sequence of records, each a header packed as '>cBI' (record
+type, flags, payload length) followed by the pickled payload, compressed
+with zlib when flags is COMPRESSED:
+
+    'H' header      dictionary: version, number of revisions, drawing
+                    sequence number, keyframe interval, export time
+    'D' delta       (rev, time, author, edit): the edit (offset, length,
+                    text) from the previous record's revision to rev
+    'K' keyframe    (rev, time, author, edit, text): a delta that also has
+                    the full text of revision rev
+    'S' strokes     list of drawing segments, appended in order
+    'I' index       dictionary: 'keyframes', a list of (rev, offset) for
+                    every keyframe record, and 'strokes', the offset of the
+                    first stroke record
+    trailer         the offset of the index record packed as '>Q', then
+                    ARCHIVE_MAGIC
+
+The revision stream starts with a keyframe of revision 1 (whose edit is
+None) and has another one every ARCHIVE_KEYFRAME_INTERVAL revisions, so
+ArchiveReader reads revision N by seeking to the keyframe before it (found
+through the index at the end of the file) and replaying at most that many
+deltas. Revisions thinned by the
+history (see PypadHistory.py) are not in the archive; their edits are folded
+into the next retained revision, and reading them returns the newest
+revision before them, as in the history itself.
+
+The writer only appends, so an archive can be written to a pipe; reading
+single revisions needs a seekable file.
+
+Run 'python PypadArchive.py export <checkpoint directory> <archive>' to
+archive a document persisted by PypadServer.py -c (exporting reads the
+checkpoint directory but doesn't write to it), and 'python
+PypadArchive.py show <archive> [rev]' to look at an archive. Start the server
+with '-i <archive>' to import one.
+"""
+
+import cPickle as pickle
+import struct
+import sys
+import time
+import zlib
+from bisect import bisect_right
+
+from PypadRope import Rope
+from PypadHistory import SEGMENT_SIZE
+
+ARCHIVE_MAGIC = 'PYPADARC'
+ARCHIVE_VERSION = 1
+
+# revisions between two keyframes, which bounds the deltas replayed to read
+# one revision
+ARCHIVE_KEYFRAME_INTERVAL = 1000
+
+# drawing segments per stroke record
+STROKE_CHUNK = 1000
+
+# payloads longer than this are compressed
+COMPRESS_THRESHOLD = 256
+
+RECORD_HEADER = '>cBI'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER)
+COMPRESSED = 1
+TRAILER = '>Q'
+TRAILER_SIZE = struct.calcsize(TRAILER) + len(ARCHIVE_MAGIC)
+
+class ArchiveError(Exception):
+    """Raised when a file is not a valid archive"""
+    pass
+
+class ArchiveWriter:
+    """
+    Writes the records of an archive to a file, keeping track of their
+    offsets without seeking
+    """
+    def __init__(self, f):
+        """
+        Constructor for ArchiveWriter
+
+        Args:
+            f: file opened for binary writing, positioned at its start
+        """
+        self.file = f
+        self.offset = 0
+
+    def write(self, type, payload):
+        """Appends one record. Returns its offset"""
+        data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+        flags = 0
+        if len(data) > COMPRESS_THRESHOLD:
+            data = zlib.compress(data, 6)
+            flags = COMPRESSED
+        offset = self.offset
+        self.file.write(struct.pack(RECORD_HEADER, type, flags, len(data)))
+        self.file.write(data)
+        self.offset += RECORD_HEADER_SIZE + len(data)
+        return offset
+
+    def finish(self, index):
+        """Appends the index record and the trailer"""
+        offset = self.write('I', index)
+        self.file.write(struct.pack(TRAILER, offset) + ARCHIVE_MAGIC)
+        self.file.flush()
+
+def readRecord(f):
+    """
+    Reads the record at the position of f. Returns (type, payload), or
+    (None, None) at the end of the file
+    """
+    header = f.read(RECORD_HEADER_SIZE)
+    if len(header) < RECORD_HEADER_SIZE:
+        return None, None
+    type, flags, length = struct.unpack(RECORD_HEADER, header)
+    data = f.read(length)
+    if len(data) < length:
+        raise ArchiveError('archive is truncated')
+    if flags & COMPRESSED:
+        data = zlib.decompress(data)
+    return type, pickle.loads(data)
+
+def exportArchive(data, f, keyframeInterval=ARCHIVE_KEYFRAME_INTERVAL):
+    """
+    Writes the document with its history and drawing to an archive. The
+    revisions up to the moment of the call are exported; changes made while
+    the archive is written are not.
+
+    Args:
+        data: the PypadData object to export
+        f: file opened for binary writing
+        keyframeInterval: int; revisions between two keyframes
+
+    Returns the number of revisions exported
+    """
+    data.dataLock.acquire()
+    try:
+        store = data.history
+        last = len(store)
+        drawingSeq, drawing = data.drawingSeq, data.drawing
+    finally:
+        data.dataLock.release()
+
+    writer = ArchiveWriter(f)
+    writer.write('H', {'version': ARCHIVE_VERSION,
+                       'revisions': last,
+                       'drawingSeq': drawingSeq,
+                       'keyframeInterval': keyframeInterval,
+                       'exported': time.time()})
+
+    when, author = store.timesOf([1])[1], store.authorsOf([1])[1]
+    keyframes = [(1, writer.write('K', (1, when, author, None,
+                                        store.rope(1).flatten())))]
+    # the history is walked a segment's worth of revisions at a time, so
+    # that only about one segment is paged in at once
+    written = 1
+    for low in range(2, last + 1, SEGMENT_SIZE):
+        revs = range(low, min(low + SEGMENT_SIZE, last + 1))
+        times = store.timesOf(revs)
+        for rev, before, edit, after, author in store.walk(revs):
+            if rev <= written:
+                # a thinned revision at the end of the previous step was
+                # replaced by this one, which is already written
+                continue
+            written = rev
+            if rev not in times:
+                times.update(store.timesOf([rev]))
+            if rev - keyframes[-1][0] >= keyframeInterval:
+                offset = writer.write('K', (rev, times[rev], author, edit,
+                                            after.flatten()))
+                keyframes.append((rev, offset))
+            else:
+                writer.write('D', (rev, times[rev], author, edit))
+
+    strokes = writer.offset
+    for i in range(0, len(drawing), STROKE_CHUNK):
+        writer.write('S', drawing[i : i + STROKE_CHUNK])
+    writer.finish({'keyframes': keyframes, 'strokes': strokes})
+    return last
+
+def importArchive(data, f):
+    """
+    Replaces the document by the one in an archive, revision by revision.
+    data must not be in use by clients yet. When it is persisted (see
+    PypadCheckpoint.py), the imported document is checkpointed once it is
+    complete rather than journaled revision by revision.
+
+    Args:
+        data: the PypadData object to import into
+        f: file opened for binary reading, positioned at its start
+
+    Returns the number of revisions imported
+    """
+    type, header = readRecord(f)
+    if type != 'H' or header.get('version') != ARCHIVE_VERSION:
+        raise ArchiveError('not a Pypad archive, or an unknown version')
+
+    data.dataLock.acquire()
+    try:
+        journal, data.journal = data.journal, None
+        try:
+            drawing = []
+            while True:
+                type, payload = readRecord(f)
+                if type == 'K' and payload[0] == 1:
+                    rev, when, author, edit, text = payload
+                    data.resetText(text, when, author)
+                elif type == 'K' or type == 'D':
+                    rev, when, author, edit = payload[:4]
+                    # thinned revisions before rev read as the one before
+                    # them; keep their numbers with empty edits
+                    while len(data.history) < rev - 1:
+                        data.appendRevision((0, 0, ''), None, when)
+                    data.appendRevision(edit, author, when)
+                elif type == 'S':
+                    drawing.extend(payload)
+                else:
+                    break
+            data.textCache = None
+            data.drawing = drawing
+            data.drawingSeq = header['drawingSeq']
+            data.drawingLog = []
+        finally:
+            data.journal = journal
+    finally:
+        data.dataLock.release()
+    if len(data.history) != header['revisions']:
+        raise ArchiveError('archive is truncated')
+    if journal != None:
+        journal.checkpoint()
+    return header['revisions']
+
+class ArchiveReader:
+    """
+    Reads single revisions and the drawing out of an archive, using the
+    index instead of unpacking the whole file
+    """
+    def __init__(self, f):
+        """
+        Constructor for ArchiveReader
+
+        Args:
+            f: seekable file opened for binary reading
+        """
+        self.file = f
+        f.seek(0)
+        type, self.header = readRecord(f)
+        if type != 'H' or self.header.get('version') != ARCHIVE_VERSION:
+            raise ArchiveError('not a Pypad archive, or an unknown version')
+        f.seek(-TRAILER_SIZE, 2)
+        trailer = f.read(TRAILER_SIZE)
+        if trailer[-len(ARCHIVE_MAGIC):] != ARCHIVE_MAGIC:
+            raise ArchiveError('archive is truncated')
+        (offset,) = struct.unpack(TRAILER, trailer[:-len(ARCHIVE_MAGIC)])
+        f.seek(offset)
+        type, index = readRecord(f)
+        if type != 'I':
+            raise ArchiveError('archive index is missing')
+        self.keyframes = index['keyframes']
+        self.keyframeRevs = [rev for rev, offset in self.keyframes]
+        self.strokes = index['strokes']
+
+    def __len__(self):
+        """Returns the number of revisions in the archive"""
+        return self.header['revisions']
+
+    def revision(self, rev):
+        """
+        Returns (text, time, author) of revision rev. A thinned revision
+        returns the newest revision before it.
+        """
+        if rev < 1 or rev > len(self):
+            raise IndexError('revision %d does not exist' % rev)
+        self.file.seek(self.keyframes[bisect_right(self.keyframeRevs, rev)
+                                      - 1][1])
+        type, (found, when, author, edit, text) = readRecord(self.file)
+        rope = Rope(text)
+        while True:
+            type, payload = readRecord(self.file)
+            if type != 'D' or payload[0] > rev:
+                break
+            found, when, author, edit = payload
+            rope = rope.replace(*edit)
+        return rope.flatten(), when, author
+
+    def drawing(self):
+        """Returns the drawing as a list of segments"""
+        self.file.seek(self.strokes)
+        drawing = []
+        while True:
+            type, payload = readRecord(self.file)
+            if type != 'S':
+                return drawing
+            drawing.extend(payload)
+
+def main(script, command=None, *args):
+    if command == 'export' and len(args) == 2:
+        # imported here so that reading archives doesn't need Pyro
+        import os
+        from PypadServer import PypadData
+        from PypadCheckpoint import recover, HISTORY_DIRECTORY
+        directory, path = args
+        data = PypadData('')
+        # spilled segments are read from the checkpoint; with no budget,
+        # the journal replayed after it stays in memory rather than being
+        # spilled into the server's directory
+        data.history.directory = os.path.join(directory, HISTORY_DIRECTORY)
+        data.history.budget = None
+        recover(data, directory)
+        f = open(path, 'wb')
+        try:
+            print 'Exported %d revisions' % exportArchive(data, f)
+        finally:
+            f.close()
+    elif command == 'show' and len(args) in (1, 2):
+        f = open(args[0], 'rb')
+        try:
+            reader = ArchiveReader(f)
+            if len(args) == 2:
+                text, when, author = reader.revision(int(args[1]))
+                sys.stdout.write(text)
+            else:
+                print '%d revisions, %d keyframes, %d drawing segments' % \
+                      (len(reader), len(reader.keyframes),
+                       len(reader.drawing()))
+                print 'exported', time.ctime(reader.header['exported'])
+        finally:
+            f.close()
+    else:
+        print 'usage: python PypadArchive.py export <checkpoint directory> ' \
+              '<archive>'
+        print '       python PypadArchive.py show <archive> [rev]'
+
+if __name__ == '__main__':
+    main(*sys.argv)
@@ -0,0 +1,196 @@
+"""
+PypadBlame.py
+
+INTRODUCTION
+Contains the BlameIndex class, which knows for every line of the document
+which revision (and so which client) last changed it.
+
+The attribution is a rope (see PypadRope.py) holding one revision number per
+line. Each new revision replaces the entries of the lines its edit touched,
+which costs O(log n + edit length): the lines are found with Rope.lineOf, so
+the text is never scanned. Edits that only insert or delete whole lines leave
+the neighbouring lines alone, like a line based diff would.
+
+Because ropes share structure, the attribution of every BLAME_INTERVAL-th
+revision is kept as a keyframe. The attribution of any other revision is
+rebuilt from the keyframe before it by replaying at most BLAME_INTERVAL edits.
+
+When the history is thinned (see PypadHistory.py), a thinned revision is
+blamed as the retained revision the store returns for it, and a keyframe of
+a thinned revision is useless: the edit of the next retained revision
+applies to the text of the retained revision before it. Such keyframes are
+dropped when blame comes across them, and blame keeps the attribution of
+the retained revisions it replays as keyframes in their place.
+"""
+
+import threading
+from bisect import bisect_right, insort
+
+from PypadRope import Rope
+
+# a keyframe of the attribution is kept every BLAME_INTERVAL revisions
+BLAME_INTERVAL = 100
+
+# rough memory cost of one line of a keyframe (its slot in a rope leaf; the
+# revision numbers are shared), in bytes. Keyframes share unchanged leaves,
+# so this overestimates
+BLAME_ENTRY_BYTES = 8
+
+def blameEdit(blame, before, edit, rev):
+    """
+    Returns the attribution after edit
+
+    Args:
+        blame: Rope of revision numbers, one per line of before
+        before: Rope; the text the edit applies to
+        edit: the edit (offset, length, text)
+        rev: int; the revision the edit made
+    """
+    offset, length, text = edit
+    if length == 0 and text == '':
+        # changes nothing, so no line is the edit's
+        return blame
+    removed = before.slice(offset, offset + length)
+    first = before.lineOf(offset)
+    oldLines = removed.count('\n')
+    newLines = text.count('\n')
+    atStart = offset == 0 or before.slice(offset - 1, offset) == '\n'
+    atEnd = offset + length == len(before) or \
+        before.slice(offset + length, offset + length + 1) == '\n'
+    if atStart and removed[-1:] in ('', '\n') and text[-1:] in ('', '\n'):
+        # whole lines, inserted or removed before line first
+        return blame.replace(first, oldLines, (rev,) * newLines)
+    if atEnd and removed[:1] in ('', '\n') and text[:1] in ('', '\n'):
+        # whole lines, inserted or removed after line first
+        return blame.replace(first + 1, oldLines, (rev,) * newLines)
+    return blame.replace(first, oldLines + 1, (rev,) * (newLines + 1))
+
+class BlameIndex:
+    """
+    The line attribution of a document, kept up to date by PypadData as
+    revisions are added in order
+    """
+    def __init__(self, text):
+        """
+        Constructor for BlameIndex
+
+        Args:
+            text: string; the text of revision 1
+        """
+        self.lock = threading.Lock()
+        self.reset(Rope(text))
+
+    def reset(self, rope):
+        """Starts over from revision 1, whose text is rope"""
+        self.lock.acquire()
+        try:
+            self.current = Rope((1,) * rope.lineCount())
+            self.currentRev = 1
+            self.keyframes = {1: self.current}
+            self.keyframeRevs = [1]
+            # the lines of all keyframes, for memoryBytes
+            self.entries = len(self.current)
+            # changed by every reset, so blame doesn't keep keyframes of
+            # the history before it
+            self.generation = getattr(self, 'generation', 0) + 1
+        finally:
+            self.lock.release()
+
+    def add(self, rev, before, edit):
+        """
+        Attributes the lines changed by revision rev
+
+        Args:
+            rev: int; the new revision
+            before: Rope; the text of revision rev-1
+            edit: the edit that made rev
+        """
+        blame = blameEdit(self.current, before, edit, rev)
+        self.lock.acquire()
+        try:
+            self.current, self.currentRev = blame, rev
+            if rev % BLAME_INTERVAL == 0:
+                self.keyframes[rev] = blame
+                self.keyframeRevs.append(rev)
+                self.entries += len(blame)
+        finally:
+            self.lock.release()
+
+    def rebuild(self, store):
+        """
+        Attributes all revisions of store (a RevisionStore, see
+        PypadHistory.py), after the history was loaded from a checkpoint
+        """
+        self.reset(store.rope(1))
+        for rev, before, edit, after, author in \
+        store.walk(range(2, len(store) + 1)):
+            self.add(rev, before, edit)
+
+    def memoryBytes(self):
+        """Estimates the memory used by the keyframes, in O(1)"""
+        return BLAME_ENTRY_BYTES * self.entries
+
+    def keyframe(self, rev, store):
+        """
+        Returns (start, blame, generation): the newest keyframe at or before
+        the retained revision rev whose revision is still retained, and the
+        generation it belongs to. Keyframes of thinned revisions are dropped
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                if rev == self.currentRev:
+                    return rev, self.current, self.generation
+                start = self.keyframeRevs[
+                    bisect_right(self.keyframeRevs, rev) - 1]
+                blame = self.keyframes[start]
+                generation = self.generation
+            finally:
+                self.lock.release()
+            if start == 1 or store.retainedRev(start) == start:
+                return start, blame, generation
+            self.lock.acquire()
+            try:
+                if self.generation == generation and start in self.keyframes:
+                    self.entries -= len(self.keyframes.pop(start))
+                    self.keyframeRevs.remove(start)
+            finally:
+                self.lock.release()
+
+    def blame(self, rev, store):
+        """
+        Returns the attribution of revision rev as a list with one
+        (author, rev) pair per line, where author is the name of the client
+        that made rev (None for revision 1). A thinned revision is blamed
+        as the retained revision before it, whose text store.rope returns
+
+        Args:
+            rev: int; the revision
+            store: the RevisionStore holding the revisions
+        """
+        rev = store.retainedRev(rev)
+        start, blame, generation = self.keyframe(rev, store)
+
+        authors = {}
+        last = start
+        for walked, before, edit, after, author in \
+        store.walk(range(start + 1, rev + 1)):
+            blame = blameEdit(blame, before, edit, walked)
+            authors[walked] = author
+            if walked - last >= BLAME_INTERVAL:
+                # in place of the keyframes of thinned revisions
+                last = walked
+                self.lock.acquire()
+                try:
+                    if self.generation == generation and \
+                    walked not in self.keyframes:
+                        self.keyframes[walked] = blame
+                        insort(self.keyframeRevs, walked)
+                        self.entries += len(blame)
+                finally:
+                    self.lock.release()
+
+        revs = blame.flatten()
+        missing = set(revs).difference(authors)
+        authors.update(store.authorsOf(missing))
+        return [(authors[line], line) for line in revs]
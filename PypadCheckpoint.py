@@ -0,0 +1,310 @@
+"""
+PypadCheckpoint.py
+
+INTRODUCTION
+Contains the Journal and Checkpointer classes, which persist a PypadData
+object (the text with its revision index, and the drawing) without stalling
+setState while the document is written to disk.
+
+Every change is appended to a journal file as it happens. Appending one edit
+costs about as much as the edit is long, so the write path stays fast.
+
+A Checkpointer thread periodically, or after enough bytes were journaled,
+takes a snapshot of the document and writes it to a checkpoint file. Taking
+the snapshot only copies a few references while holding the data lock: the
+revision ropes are immutable (see PypadRope.py), the revision history only
+copies its list of hot edits (see PypadHistory.py), and the drawing list is
+replaced rather than modified. The expensive part, pickling the snapshot,
+happens on the checkpointer thread.
+
+History segments spilled to disk are kept in the history subdirectory and are
+referred to by the checkpoint rather than copied into it.
+
+Checkpoints are written to a temporary file and renamed over the old one, so
+a crash never leaves a half written checkpoint behind. At the moment of the
+snapshot the journal switches to a new file; once the checkpoint is on disk the
+older journal files are deleted. Recovery loads the checkpoint and replays
+only the journal written after it.
+
+FILES (in the checkpoint directory)
+    checkpoint.pkl      the latest checkpoint
+    journal.<n>         journal files, replayed in order of n
+    history/            spilled history segments
+"""
+
+import cPickle as pickle
+import os
+import struct
+import threading
+import time
+
+# defaults for the Checkpointer
+CHECKPOINT_INTERVAL = 60            # seconds between checkpoints
+CHECKPOINT_BYTES = 1024 * 1024      # journaled bytes that trigger a checkpoint
+
+CHECKPOINT_FILE = 'checkpoint.pkl'
+JOURNAL_PREFIX = 'journal.'
+HISTORY_DIRECTORY = 'history'
+
+def journalFiles(directory):
+    """Returns the journal numbers found in directory, in ascending order"""
+    numbers = []
+    for name in os.listdir(directory):
+        if name.startswith(JOURNAL_PREFIX):
+            try:
+                numbers.append(int(name[len(JOURNAL_PREFIX):]))
+            except ValueError:
+                pass
+    numbers.sort()
+    return numbers
+
+def readJournal(filename):
+    """
+    Yields the records of a journal file. A record cut short by a crash
+    ends the journal.
+    """
+    f = open(filename, 'rb')
+    try:
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return
+            (length,) = struct.unpack('>I', header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield pickle.loads(data)
+    finally:
+        f.close()
+
+class Journal:
+    """
+    An append-only log of changes to a PypadData object. Records are tuples
+    ('text', rev, edit, author, when) or ('drawing', seq, op); see 
+    PypadData.publish in PypadServer.py.
+    """
+    def __init__(self, directory, number):
+        """
+        Constructor for Journal
+
+        Args:
+            directory: string; directory holding the journal files
+            number: int; number of the journal file to append to
+        """
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.number = number
+        self.bytesWritten = 0
+        self.file = open(self.filename(number), 'ab')
+
+    def filename(self, number):
+        """Returns the path of journal file number"""
+        return os.path.join(self.directory, JOURNAL_PREFIX + str(number))
+
+    def write(self, record):
+        """Appends one record to the journal. Returns its size in bytes"""
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        self.lock.acquire()
+        try:
+            self.file.write(struct.pack('>I', len(data)))
+            self.file.write(data)
+            self.file.flush()
+            self.bytesWritten += len(data) + 4
+        finally:
+            self.lock.release()
+        return len(data) + 4
+
+    def rotate(self):
+        """
+        Switches to a new journal file, so that later records go after the
+        checkpoint being taken. Returns the number of the new file.
+        """
+        self.lock.acquire()
+        try:
+            self.file.close()
+            self.number += 1
+            self.bytesWritten = 0
+            self.file = open(self.filename(self.number), 'ab')
+            return self.number
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Closes the journal file"""
+        self.lock.acquire()
+        try:
+            self.file.close()
+        finally:
+            self.lock.release()
+
+class Checkpointer(threading.Thread):
+    """
+    A background thread writing checkpoints of a PypadData object.
+
+    A checkpoint is written every interval seconds if anything changed, or
+    as soon as more than sizeTrigger bytes were journaled since the last
+    one.
+    """
+    def __init__(self, data, directory, interval=CHECKPOINT_INTERVAL,
+                 sizeTrigger=CHECKPOINT_BYTES):
+        """
+        Constructor for Checkpointer. Recovers data from directory (see
+        recover) and starts journaling its changes; call start() to begin
+        writing checkpoints.
+
+        Args:
+            data: the PypadData object to persist
+            directory: string; where the checkpoint and journal are kept
+            interval: float; seconds between checkpoints
+            sizeTrigger: int; journaled bytes that trigger a checkpoint
+        """
+        threading.Thread.__init__(self, name = 'Checkpointer')
+        self.setDaemon(True)
+        self.data = data
+        self.directory = directory
+        self.interval = interval
+        self.sizeTrigger = sizeTrigger
+        self.wakeup = threading.Event()
+        self.running = True
+        # stop can checkpoint while the thread does too
+        self.checkpointLock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # spilled history must outlive the process to be checkpointed
+        data.history.directory = os.path.join(directory, HISTORY_DIRECTORY)
+        data.history.checkpointed = True
+        number = recover(data, directory)
+        self.journal = Journal(directory, number)
+        data.journal = self
+
+    def write(self, record):
+        """
+        Journals one change. Called by PypadData, holding its data lock.
+        Wakes the checkpointer up once enough bytes were journaled.
+        """
+        self.journal.write(record)
+        if self.journal.bytesWritten > self.sizeTrigger:
+            self.wakeup.set()
+
+    def run(self):
+        """Writes checkpoints until stop is called"""
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if not self.running:
+                break
+            if self.journal.bytesWritten > 0:
+                try:
+                    self.checkpoint()
+                except (IOError, OSError), e:
+                    print 'Checkpoint failed:', e
+
+    def stop(self):
+        """Writes a last checkpoint and stops the thread"""
+        self.running = False
+        self.wakeup.set()
+        self.checkpoint()
+        self.journal.close()
+
+    def snapshot(self):
+        """
+        Captures the state of the document while holding the data lock.
+        Apart from the hot edits of the history, only references are
+        copied; the captured objects are never modified afterwards.
+        """
+        data = self.data
+        data.dataLock.acquire()
+        try:
+            snapshot = {'rev': len(data.history),
+                        'history': data.history.snapshot(),
+                        'drawingSeq': data.drawingSeq,
+                        'drawing': data.drawing}
+            # changes after this point go into the new journal file
+            snapshot['journal'] = self.journal.rotate()
+        finally:
+            data.dataLock.release()
+        return snapshot
+
+    def checkpoint(self):
+        """Writes a checkpoint of the document, atomically"""
+        self.checkpointLock.acquire()
+        try:
+            self.writeCheckpoint()
+        finally:
+            self.checkpointLock.release()
+
+    def writeCheckpoint(self):
+        """Does the work of checkpoint. Callers hold checkpointLock"""
+        start = time.time()
+        snapshot = self.snapshot()
+        rev = snapshot['rev']
+        history = snapshot['history']
+        garbage = history.pop('garbage')
+        history['baseText'] = history.pop('base').flatten()
+        state = {'rev': rev,
+                 'history': history,
+                 'drawingSeq': snapshot['drawingSeq'],
+                 'drawing': snapshot['drawing'],
+                 'journal': snapshot['journal']}
+
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        temp = path + '.tmp'
+        f = open(temp, 'wb')
+        try:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        if os.name == 'nt' and os.path.exists(path):
+            # rename can't replace a file on Windows
+            os.remove(path)
+        os.rename(temp, path)
+
+        # the journal before the snapshot is now covered by the checkpoint
+        for number in journalFiles(self.directory):
+            if number < snapshot['journal']:
+                os.remove(self.journal.filename(number))
+        # and so are history segments replaced before the snapshot
+        self.data.history.collectGarbage(garbage)
+        print 'Checkpointed revision %d in %.3f s' % (rev, time.time() - start)
+
+def recover(data, directory):
+    """
+    Loads the latest checkpoint in directory into data and replays the
+    journal written after it.
+
+    Args:
+        data: a freshly constructed PypadData object
+        directory: string; the checkpoint directory
+
+    Returns the number of the journal file new changes should go to
+    """
+    path = os.path.join(directory, CHECKPOINT_FILE)
+    firstJournal = 0
+    rev = 1
+    if os.path.exists(path):
+        f = open(path, 'rb')
+        try:
+            state = pickle.load(f)
+        finally:
+            f.close()
+        data.loadCheckpoint(state)
+        rev = state['rev']
+        firstJournal = state['journal']
+        print 'Loaded checkpoint of revision', rev
+
+    numbers = [n for n in journalFiles(directory) if n >= firstJournal]
+    replayed = 0
+    for number in numbers:
+        filename = os.path.join(directory, JOURNAL_PREFIX + str(number))
+        for record in readJournal(filename):
+            data.replayRecord(record)
+            replayed += 1
+    if replayed:
+        print 'Replayed %d journaled changes' % replayed
+
+    if numbers:
+        return numbers[-1] + 1
+    return firstJournal
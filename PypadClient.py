@@ -6,6 +6,9 @@ Contains the PypadClient class.
 The PypadClient class is the controller in the model view controller design 
 pattern of Pypad. It interfaces between the server and gui objects
 
+The server communication lives in PypadClientCore (PypadClientCore.py), which 
+doesn't need wx. PypadClient adds the wx gui loops on top of it.
+
 AUTHORS 
 Steven Zhang, Jason Poon, Reyner Crosby
 
@@ -50,16 +53,20 @@ Created initial frame work
 """
 
 
-from RemoteObject import *
+from PypadClientCore import *
 from threading import Thread
 from PypadGui import *
+from PypadTrace import tracer
+from PypadEdit import diffText
 from time import sleep
-from RemoteObject import *
 import sys
 
 DEBUG = False
 
-class PypadClient(RemoteObject):
+# seconds between checks of the drawing for local changes
+DRAWING_POLL_INTERVAL = 0.05
+
+class PypadClient(PypadClientCore):
     """
     A PypadClient (herein called client) 
     is an object that watches its PypadGui and the PypadServer.
@@ -71,11 +78,14 @@ class PypadClient(RemoteObject):
     
     That way, all the changes are (almost) instantaneous
     
+    The communication with the server is done by PypadClientCore; this class
+    is the wx frontend, which listens to the core and runs the gui loops.
+    
     Some code is modified from:
     http://ece.olin.edu/sd/current/web/notes/25_subject_observer/subject_observer.html
     """
 
-    def __init__(self, serverName):
+    def __init__(self, serverName, crdt=False):
         """
         Constructor for PypadClient object
         
@@ -83,6 +93,7 @@ class PypadClient(RemoteObject):
             serverName: string; the name of the PypadServer object to connect to
                 this name must match the defined in the instantiation of said 
                 object
+            crdt: bool; edit in CRDT mode, see PypadClientCore
         
         """
         
@@ -90,70 +101,100 @@ class PypadClient(RemoteObject):
         # display the current data
         self.textNeedsUpdating = True       
         self.drawingNeedsUpdating = True
-        ns = NameServer()
-        # register with the server
-        self.serverName = serverName
-        self.server = ns.get_proxy(self.serverName)
-        self.clientName, self.id = self.server.register()
-        print "I just registered with server."
-
-        # connect to the name server
         
-        RemoteObject.__init__(self, self.clientName)
-        print "I just registered with Name Server."
-        # modifying attributes
-    
-    
-    # Getters
-    def getClientName(self):
-        """Getter for client name. added 4/24 Steven"""
-        return self.clientName
-    def getId(self):
-        """Getter for id. added 11/26 Steven"""
-        return self.id
+        # trace id of the remote edit that raised textNeedsUpdating
+        self.textTraceId = None
+        
+        # becomes True once the initial text has been streamed to the gui
+        self.joined = False
+        
+        # set after a reconnect, when the gui text must be brought up to 
+        # syncedText as a whole
+        self.textNeedsResync = False
+        
+        # set when serverRev changed, for updateRevLoop
+        self.revChanged = threading.Event()
+        
+        # coalesce local changes before sending them, see Batcher. The gui
+        # is set by clientLoops
+        self.gui = None
+        self.textBatcher = Batcher(self.sendText, TEXT_MAX_LATENCY)
+        self.drawingBatcher = Batcher(self.sendDrawing, DRAWING_MAX_LATENCY)
+        
+        PypadClientCore.__init__(self, serverName, crdt = crdt)
+        self.addListener(self.remoteChanged)
 
     # the following methods are added by Steven
     # following modification from Mark Sheldon's Subject, Modifier, Observer
     # examples in the link above
-    def notify(self, type):
+    def remoteChanged(self, type, traceId=None):
         """
-        This method is invoked remotely
+        Listener for notifications from the server
         
-        When the PypadServer is modified, it invokes notify;
-        then the client sets off flags (corresponding to whether text or drawing
-        has changed), which allows the client to be updated in the loops below
+        When the PypadServer is modified, the client sets off flags 
+        (corresponding to whether text or drawing has changed), which allows 
+        the gui to be updated in the loops below
         
         Args:
-            type: 'text' or 'drawing'
+            type: 'text', 'drawing' or 'resync'
+            traceId: string; trace id of the edit, or None if it isn't traced
         """
-        if(DEBUG): print 'Notified', type
         if type == 'text':
             if(DEBUG): print 'self.textNeedsUpdating = True'
+            self.textTraceId = traceId
             self.textNeedsUpdating = True
+            self.revChanged.set()
         elif type == 'drawing':
             self.drawingNeedsUpdating = True
-
-    def modify(self, text=[], drawing=[], type = 'text'):
-        """
-        Changed the state of the server data. 
-        
-        Args:
-            type: 'text' or 'drawing'. 
-                Specifies whether text or drawing should be updated
-        """
-        self.server.setState(self.name, newText = text, newDrawing = drawing, type = type)
-        if DEBUG: print 'Setting state to ' + str(self.server.getState())
-        
-    def cleanup(self):
-        """
-        Inherited RemoteObject method to stop itself
-        Unregisters self from PypadServer
-        
-        Added by Steven Zhang 4/24
-        """
-        print 'Disconnecting from server'
-        self.server.remove(self.clientName)
-        RemoteObject.cleanup(self)
+        elif type == 'resync':
+            # the client reconnected and caught up; show the synced data
+            self.textNeedsResync = True
+            self.drawingNeedsUpdating = True
+            self.revChanged.set()
+    
+    def sendText(self):
+        """Sends the gui text to the server. Called by textBatcher"""
+        gui = self.gui
+        traceId = gui.t.getTraceId()
+        gui.t.setTextAsUpdated()
+        tracer.mark(traceId, 'client.textChanged')
+        text = gui.t.getText()
+        sent = False
+        if self.syncedText != None and self.syncedRev == self.serverRev:
+            # the server doesn't seem to have changed since the last sync, 
+            # so only the edit from the synced text has to be sent, not the
+            # document. The server checks that: a revision of someone else
+            # may be on its way to us
+            edit = diffText(self.syncedText, text)
+            if edit == None:
+                sent = True
+            else:
+                try:
+                    self.modify(text = edit, type = 'edit', traceId = traceId,
+                                baseRev = self.syncedRev)
+                    sent = True
+                except ValueError:
+                    # the server's text changed meanwhile
+                    pass
+        if not sent:
+            self.modify(text = text, type = 'text', traceId = traceId)
+        self.revChanged.set()
+        if(DEBUG): print "state=" + str(gui.t.getText())
+    
+    def sendDrawing(self):
+        """Sends the gui drawing to the server. Called by drawingBatcher"""
+        gui = self.gui
+        gui.d.setDrawingAsUpdated()
+        drawing = gui.d.getDrawing()
+        synced = self.syncedDrawing
+        if synced != None and gui.d.snapshotImage is self.drawingSnapshot \
+        and drawing[:len(synced)] == synced:
+            # only the new segments; after joining from a snapshot the gui
+            # doesn't even have the older ones
+            self.addStrokes(drawing[len(synced):])
+        else:
+            # the gui drawing was cleared
+            self.modify(drawing = drawing, type = 'drawing')
     
     def updateTextLoop(self, gui):
         """
@@ -161,6 +202,7 @@ class PypadClient(RemoteObject):
         text. 
         
         The client checks to see if gui has changed. If so, it notifies the server
+        through textBatcher, which sends bursts of typing together
         
         It also checks to see if server has flagged the client to update the gui.
         If so, it updates the gui.
@@ -172,20 +214,54 @@ class PypadClient(RemoteObject):
         """
         if(DEBUG): print "in updateTextLoop"
         while True:
+            # a file was opened; it replaces the server's text through a 
+            # chunked import rather than one huge setState
+            if gui.t.takeImportRequest():
+                gui.t.setTextAsUpdated()
+                self.importText(gui.t.getText(), 
+                                progress = gui.t.showUploadProgress)
+                self.revChanged.set()
+            
             # Check to see if gui has changed due to user input
             if gui.t.hasTextChanged() == True:
                 if(DEBUG): print "Gui just changed"
-                gui.t.setTextAsUpdated()
-                self.modify(text = gui.t.getText(), type = 'text')
-                if(DEBUG): print "state=" + str(gui.t.getText())
+                self.textBatcher.changed()
+            self.textBatcher.poll()
                 
             # Checks to see client's textNeedsUpdating flag has been raised by 
-            # server
-            if self.textNeedsUpdating == True:
+            # server. Remote changes wait while a file is being opened, since
+            # the file replaces the text anyway
+            if gui.t.isLoadingFile():
+                pass
+            elif self.textNeedsUpdating == True and self.joined == False:
+                # the first update fetches the whole document, which can be
+                # large, so it is streamed in chunks
+                self.textNeedsUpdating = False
+                self.streamTextToGui(gui)
+                self.joined = True
+            elif self.textNeedsResync == True:
+                self.textNeedsResync = False
+                self.textBatcher.flush()
+                gui.t.setText(self.syncedText)
+            elif self.textNeedsUpdating == True:
                 if(DEBUG): print "client.textNeedsUpdating == True"
-                if(DEBUG): print self.server.getState('text')
                 self.textNeedsUpdating = False
-                gui.t.setText(self.server.getState('text'))
+                # send what is waiting first, or the update would undo it
+                self.textBatcher.flush()
+                traceId = self.textTraceId
+                start = tracer.now()
+                # only the difference since the last update is downloaded
+                edits = self.syncText()
+                tracer.span(traceId, 'client.getState', start)
+                start = tracer.now()
+                if edits == None or gui.t.hasTextChanged():
+                    # the gui text isn't the last synced text, so the edits 
+                    # don't apply to it; let setText work out the difference
+                    gui.t.setText(self.syncedText)
+                else:
+                    for edit in edits:
+                        gui.t.applyEdit(edit)
+                tracer.span(traceId, 'gui.setText', start)
                 
             # This part which checks to see if the a person has inputed
             # a request for new revision. Since we want to check this as much as
@@ -197,28 +273,52 @@ class PypadClient(RemoteObject):
                 newRev = int(gui.t.getRevNumReq())
                 
                 #update to requested rev, but only if requested rev < current rev
-                if newRev < self.server.getRevNum():
-                    self.modify(text = self.server.getHistory(newRev), type = 'text')
-                gui.t.setText(self.server.getState('text'))
+                if newRev < self.getRevNum():
+                    self.modify(text = self.getHistory(newRev), type = 'text')
+                gui.t.setText(self.getText())
                 gui.t.setRevUpdateFlag(False)
             
+    def streamTextToGui(self, gui):
+        """
+        Fetches the server's text in chunks, showing the first screen as soon
+        as it arrives and appending the rest as it comes in.
+        
+        Args:
+            gui: the corresponding PypadGui object
+        """
+        received = 0
+        try:
+            for rev, offset, totalLength, chunk in self.streamText():
+                received += len(chunk)
+                if offset == 0:
+                    gui.t.beginStreamedText(chunk, totalLength)
+                else:
+                    gui.t.appendStreamedText(chunk, received, totalLength)
+        finally:
+            gui.t.endStreamedText()
+        
     def updateRevLoop(self, gui):
         """
         This loop is the event loop that handles requests between client and 
         the gui's revision box.
         
+        The revision number comes with the text notifications (see 
+        PypadClientCore.serverRev), so the server is never polled for it.
+        
         Jason wrote this loop.
         """
         if(DEBUG): print "in updateRevLoop"
         
         while True:
             if(DEBUG): print gui.t.revInput
-            sleep(5)    
+            # waiting in slices keeps the loop responsive to revInput
+            self.revChanged.wait(1)
             # we pause so that the user can input something in the rev box before 
             # it gets overwritten by the automated revision updater
-            if gui.t.revInput == False:
-                # Continually update the revision number on each GUI.
-                gui.t.nameTextCtrl.SetValue(str(self.server.getRevNum()))
+            if gui.t.revInput == False and self.revChanged.isSet():
+                self.revChanged.clear()
+                # update the revision number on each GUI.
+                gui.t.nameTextCtrl.SetValue(str(self.serverRev))
 
     def updateDrawingLoop(self, gui):
         """
@@ -230,17 +330,33 @@ class PypadClient(RemoteObject):
         """
         if(DEBUG): print "in update Drawing Loop"  
         while(True):
-            sleep(1)    
-            # drawing objects are full of data, so we don't want to update too often
-            # due to latency
+            # drawing objects are full of data, so we don't want to update too 
+            # often; drawingBatcher coalesces the changes of a stroke
+            wait = self.drawingBatcher.due()
+            if wait == None:
+                wait = DRAWING_POLL_INTERVAL
+            sleep(min(wait, DRAWING_POLL_INTERVAL))
+            # a hidden drawing window doesn't need drawing notifications
+            shown = gui.d.isDrawingShown()
+            if shown != ('drawing' in self.channels):
+                if shown:
+                    self.subscribe('drawing')
+                    self.drawingNeedsUpdating = True
+                else:
+                    self.unsubscribe('drawing')
             if gui.d.hasDrawingChanged() == True:
                 print "Drawing just changed"
-                gui.d.setDrawingAsUpdated()
-                self.modify(drawing = gui.d.getDrawing(),type = 'drawing')
+                self.drawingBatcher.changed()
+            self.drawingBatcher.poll()
             if self.drawingNeedsUpdating == True:
                 print "self.drawingNeedsUpdating == True"
                 self.drawingNeedsUpdating = False
-                gui.d.setDrawing(self.server.getState('drawing'))
+                self.drawingBatcher.flush()
+                # only the drawing operations since the last update are 
+                # downloaded
+                self.syncDrawing()
+                gui.d.setDrawing(list(self.syncedDrawing), 
+                                 self.drawingSnapshot)
                 
     def clientLoops(self, gui):
         """
@@ -248,7 +364,7 @@ class PypadClient(RemoteObject):
         
         Added 11/16/10 by Steven
         """
-        
+        self.gui = gui
         
         t1 = Thread(target = self.updateTextLoop, args =[gui])
         t1.start()
@@ -265,6 +381,9 @@ class PypadClient(RemoteObject):
         t4 = Thread(target = self.updateDrawingLoop, args =[gui])
         t4.start()
         
+        # keeps this client's registration with the server alive
+        self.startRenewing()
+        
             
 def main(script, *args):
     """
@@ -277,10 +396,28 @@ def main(script, *args):
     Written mostly by Steven
     """
     serverName = 'Pypad_dot_com'
+    maxLatency = None
+    crdt = False
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == '-t':
+            # writes edit propagation spans, see PypadTrace.py
+            tracer.enable('client', 'pypad_client_trace.log')
+        elif arg == '-l':
+            # longest time in milliseconds a local change waits to be sent
+            maxLatency = float(args.pop(0)) / 1000
+        elif arg == '-crdt':
+            # for servers started with -crdt, see PypadCrdt.py
+            crdt = True
+    
     ns = NameServer()
     serverData = ns.get_proxy(serverName)
     
-    client = PypadClient(serverName)
+    client = PypadClient(serverName, crdt)
+    if maxLatency != None:
+        client.textBatcher.maxLatency = maxLatency
+        client.drawingBatcher.maxLatency = maxLatency
     app = wx.App(False)
     gui = PypadGui()
     gui.t.SetTitle("Pypad client, connected to " + client.serverName
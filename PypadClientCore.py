@@ -0,0 +1,985 @@
+"""
+PypadClientCore.py
+
+INTRODUCTION
+Contains the PypadClientCore class, the part of a Pypad client that talks to
+the PypadServer. It does not import wx, so bots, importers and tests can use
+it on machines without a display.
+
+PypadClient (the wx frontend in PypadClient.py) is one consumer of this class.
+Other programs can either register callbacks with addListener, or iterate over
+remote changes with changes():
+
+    client = PypadClientCore('Pypad_dot_com')
+    client.start()
+    client.setText('hello from a bot')
+    for type, traceId in client.changes():
+        if type == 'text':
+            print client.getText()
+
+Local changes can be sent through a Batcher, which coalesces bursts of changes
+into fewer calls.
+
+AUTHORS
+Steven Zhang, Jason Poon, Reyner Crosby
+
+CREDITS
+Pyro author and package: http://pyro.sourceforge.net
+Remoteobjects Library: Allen Downey
+Subject-Observer-Modifier template: Mark Sheldon
+"""
+
+from RemoteObject import *
+from PypadTrace import tracer
+from PypadEdit import applyEdit, applyDrawingOps, diffText
+from PypadCrdt import RgaDocument
+from Queue import Queue, Empty
+import threading
+import time
+import mmap
+import os
+import sys
+
+DEBUG = False
+
+# the first chunk of a streamed text fetch only needs to fill the screen;
+# the rest is fetched in bigger chunks to keep the number of calls down
+FIRST_CHUNK_SIZE = 8192
+CHUNK_SIZE = 262144
+
+# seconds between renewals of the client's registration lease, see renewLoop.
+# Must be well below LEASE_TIME in PypadServer.py
+RENEW_INTERVAL = 10
+
+# outbound batching, see Batcher. Times are in seconds
+MIN_BATCH_INTERVAL = 0.02       # shortest time between two sends
+TEXT_MAX_LATENCY = 0.2          # longest a local text change waits
+DRAWING_MAX_LATENCY = 0.5       # longest a local drawing change waits
+RTT_FACTOR = 2                  # sends are spaced this many round trips apart
+RTT_SMOOTHING = 0.125           # weight of a new round trip time sample
+
+class Batcher:
+    """
+    Decides when local changes are sent to the server, so that a fast 
+    typist (or a long pen stroke) doesn't cost one call per keystroke.
+
+    The first change after a quiet period is sent at once. Changes that come
+    in while the last send is less than an interval ago are coalesced: the
+    next send carries all of them. The interval grows with the measured 
+    round trip time of the sends, so a slow server is sent to less often, 
+    but never beyond maxLatency.
+
+    The batcher doesn't hold the changes itself. send is a callable that 
+    reads the current local state and sends it; the owner calls changed()
+    when something changed and poll() regularly.
+    """
+    def __init__(self, send, maxLatency=TEXT_MAX_LATENCY,
+                 minInterval=MIN_BATCH_INTERVAL):
+        """
+        Constructor for Batcher
+
+        Args:
+            send: callable taking no arguments; sends the local changes
+            maxLatency: float; longest time a change waits to be sent
+            minInterval: float; shortest time between two sends
+        """
+        self.send = send
+        self.maxLatency = maxLatency
+        self.minInterval = minInterval
+        self.pending = False
+        # time of the first change not yet sent
+        self.firstPending = None
+        self.lastSend = 0
+        # smoothed round trip time of send, like TCP's
+        self.rtt = None
+        self.lock = threading.RLock()
+
+    def changed(self):
+        """Records that there is a local change to send"""
+        if not self.pending:
+            self.firstPending = time.time()
+            self.pending = True
+
+    def interval(self):
+        """Returns the current minimum time between two sends"""
+        if self.rtt == None:
+            return self.minInterval
+        return min(self.maxLatency, max(self.minInterval, 
+                                        RTT_FACTOR * self.rtt))
+
+    def due(self):
+        """
+        Returns the number of seconds until the pending changes should be
+        sent: 0 if now, None if nothing is pending
+        """
+        if not self.pending:
+            return None
+        now = time.time()
+        return max(0, min(self.lastSend + self.interval() - now,
+                          self.firstPending + self.maxLatency - now))
+
+    def poll(self):
+        """Sends the pending changes if they are due. Returns True if sent"""
+        if self.due() == 0:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """Sends the pending changes now, if there are any"""
+        self.lock.acquire()
+        try:
+            if not self.pending:
+                return
+            # changes made during the send are sent next time
+            self.pending = False
+            start = time.time()
+            try:
+                self.send()
+            except:
+                # keep the changes for the next try
+                self.pending = True
+                raise
+            finally:
+                self.lastSend = time.time()
+            sample = self.lastSend - start
+            if self.rtt == None:
+                self.rtt = sample
+            else:
+                self.rtt += RTT_SMOOTHING * (sample - self.rtt)
+        finally:
+            self.lock.release()
+
+class PypadClientCore(RemoteObject):
+    """
+    A PypadClientCore registers with a PypadServer, sends changes to it and is
+    notified by it whenever another client changes the server's data.
+
+    Notifications are passed on to listeners, which are callables taking
+    (type, traceId), where type is the channel the notification came on (see
+    CHANNELS in PypadServer.py). After reconnecting, listeners get type 
+    'resync': syncedText and syncedDrawing were brought up to date by the 
+    reconnect and should be shown as a whole.
+
+    The server only notifies the client on the channels it subscribed to, so
+    a client that e.g. only shows the drawing never hears about text changes.
+    The latest revision number and list of clients from the notifications
+    are kept in serverRev and presence.
+
+    A read-only client can be served by one of the server's relays instead of
+    the server itself (see PypadRelay.py); it then moves to another relay 
+    when its relay can't be reached.
+    
+    With a server in CRDT mode (PypadServer.py -crdt), a client made with 
+    crdt=True keeps its own replica of the text (see PypadCrdt.py). Text 
+    changes made through modify are applied to the replica, and so to 
+    syncedText, at once, and sent to the server in the background; 
+    changes of other clients come in on the 'crdt' channel instead of 
+    'text' and are merged by syncText. Changes made while the server can't
+    be reached are kept and sent when it is back.
+    """
+
+    def __init__(self, serverName, channels=('text', 'drawing'), 
+                 viaRelay=False, crdt=False):
+        """
+        Constructor for PypadClientCore object
+
+        Args:
+            serverName: string; the name of the PypadServer object to connect to
+                this name must match the defined in the instantiation of said
+                object
+            channels: list of the channels to subscribe to
+            viaRelay: bool; if True, the server picks one of its relays to 
+                serve this client, which then can't make changes
+            crdt: bool; if True, the text is edited in CRDT mode, see above
+        """
+        self.listeners = []
+        self.listenerLock = threading.Lock()
+
+        # the server's text as of revision syncedRev, as far as this client
+        # knows. None until the text is first fetched
+        self.syncedText = None
+        self.syncedRev = None
+        
+        # the same for the drawing and its sequence number. When the drawing
+        # was joined from a raster snapshot (see PypadRaster.py), 
+        # drawingSnapshot is the PNG image of the drawing up to some 
+        # sequence number and syncedDrawing only the segments after it; 
+        # otherwise drawingSnapshot is None
+        self.syncedDrawing = None
+        self.drawingSeq = None
+        self.drawingSnapshot = None
+
+        # True while reconnect is running
+        self.reconnecting = False
+
+        # set by stop, ends renewLoop
+        self.stopped = threading.Event()
+
+        # CRDT mode: crdt is the client's replica of the text, made by 
+        # joinCrdt, as of the server's batch crdtSeq of epoch crdtEpoch 
+        # (see PypadData.applyCrdtOps). crdtInbox holds the (epoch, seq, 
+        # ops) notifications not merged yet, and crdtPending (ops, edit) for
+        # the local edits the server hasn't acknowledged, see crdtSendLoop
+        self.crdtMode = crdt
+        self.crdt = None
+        self.crdtEpoch = None
+        self.crdtSeq = None
+        self.crdtInbox = []
+        self.crdtPending = []
+        self.crdtLock = threading.RLock()
+        self.crdtWakeup = threading.Event()
+        if crdt and 'text' in channels:
+            # text changes come as operations instead, and the revision 
+            # numbers on 'rev'
+            channels = [channel for channel in channels if channel != 'text']
+            channels.extend(['crdt', 'rev'])
+
+        self.channels = list(channels)
+        # the server's revision number, from the last 'text' or 'rev' 
+        # notification or change sent by this client
+        self.serverRev = None
+        # registered clients, from the last 'presence' notification
+        self.presence = None
+
+        ns = NameServer()
+        # the server whose relays serve this client, if viaRelay
+        self.originName = None
+        if viaRelay:
+            self.originName = serverName
+            serverName = ns.get_proxy(serverName).findRelay()
+        # register with the server
+        self.serverName = serverName
+        self.server = ns.get_proxy(self.serverName)
+        self.clientName, self.id = self.server.register(self.channels)
+        print "I just registered with server."
+
+        # connect to the name server, so the server can notify this client
+        RemoteObject.__init__(self, self.clientName, ns)
+        print "I just registered with Name Server."
+        
+        if crdt:
+            sender = threading.Thread(target = self.crdtSendLoop,
+                                      name = 'CrdtSender')
+            sender.setDaemon(True)
+            sender.start()
+
+    # Getters
+    def getClientName(self):
+        """Getter for client name"""
+        return self.clientName
+    def getId(self):
+        """Getter for id"""
+        return self.id
+
+    # Listeners
+    def addListener(self, listener):
+        """
+        Registers a callable that is invoked with (type, traceId) whenever
+        the server notifies this client of a change.
+
+        Listeners run on the Pyro request thread, so they should return
+        quickly (setting a flag or queueing work).
+        """
+        self.listenerLock.acquire()
+        try:
+            self.listeners.append(listener)
+        finally:
+            self.listenerLock.release()
+
+    def removeListener(self, listener):
+        """Unregisters a listener added with addListener"""
+        self.listenerLock.acquire()
+        try:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+        finally:
+            self.listenerLock.release()
+
+    def changes(self, timeout=None):
+        """
+        Generator yielding (type, traceId) for every remote change that
+        arrives while it is being iterated.
+
+        Args:
+            timeout: float; seconds to wait for a change before the iteration
+                stops. None waits forever.
+        """
+        queue = Queue()
+        listener = lambda type, traceId: queue.put((type, traceId))
+        self.addListener(listener)
+        try:
+            while True:
+                try:
+                    # Queue.get without a timeout can't be interrupted by
+                    # KeyboardInterrupt, so wait in slices
+                    if timeout == None:
+                        change = None
+                        while change == None:
+                            try:
+                                change = queue.get(True, 1)
+                            except Empty:
+                                pass
+                    else:
+                        change = queue.get(True, timeout)
+                except Empty:
+                    return
+                yield change
+        finally:
+            self.removeListener(listener)
+
+    # Subscriptions
+    def subscribe(self, *channels):
+        """Subscribes to more notification channels"""
+        self.call('subscribe', self.clientName, channels)
+        for channel in channels:
+            if channel not in self.channels:
+                self.channels.append(channel)
+
+    def unsubscribe(self, *channels):
+        """Stops the notifications on the given channels"""
+        self.call('unsubscribe', self.clientName, channels)
+        self.channels = [channel for channel in self.channels
+                         if channel not in channels]
+
+    # the following method is invoked remotely by the PypadServer
+    def notify(self, type, traceId=None, value=None):
+        """
+        This method is invoked remotely
+
+        When the PypadServer is modified, it invokes notify, which passes the
+        change on to each listener.
+
+        Args:
+            type: the channel, see CHANNELS in PypadServer.py. 'dropped' 
+                means the server dropped this client, which then reconnects
+            traceId: string; trace id of the edit, or None if it isn't traced
+            value: the revision number for 'text' and 'rev', the list of
+                clients for 'presence'
+
+        A 'resyncNeeded' notification means notifications were dropped, 
+        because this client fell too far behind; see PypadOutbox.py. It is
+        passed on to the listeners as a notification on each subscribed
+        channel, without values, so they fetch the current state.
+        """
+        if(DEBUG): print 'Notified', type
+        if type == 'dropped':
+            # reconnecting calls the server, so don't do it on the thread
+            # the server is waiting for
+            threading.Thread(target = self.reconnect).start()
+            return
+        if type == 'resyncNeeded':
+            # this client fell behind and the server dropped the changes it
+            # had queued for it; tell the listeners everything changed. The
+            # presence list comes with its notification, so it is fetched,
+            # like reconnecting, off the thread the server is waiting for
+            if 'presence' in self.channels:
+                threading.Thread(target = self.refreshPresence).start()
+            for channel in self.channels:
+                if channel == 'presence':
+                    continue
+                if channel != 'rev' or 'text' not in self.channels:
+                    self.notify(channel)
+            return
+        if type == 'crdt':
+            # merged by syncText; None makes it catch up with the server
+            self.crdtLock.acquire()
+            try:
+                self.crdtInbox.append(value)
+            finally:
+                self.crdtLock.release()
+            # for the listeners, it is a text change
+            type = 'text'
+        if type == 'text':
+            tracer.mark(traceId, 'client.notified')
+        if type in ('text', 'rev') and value != None:
+            self.serverRev = max(value, self.serverRev)
+        elif type == 'presence':
+            self.presence = value
+        self.listenerLock.acquire()
+        try:
+            listeners = list(self.listeners)
+        finally:
+            self.listenerLock.release()
+        for listener in listeners:
+            listener(type, traceId)
+
+    def refreshPresence(self):
+        """
+        Fetches the registered clients and passes them on as a 'presence'
+        notification. Leaves presence as it is if the server can't be
+        reached
+        """
+        try:
+            presence = self.call('getPresence')
+        except Pyro.errors.PyroError, e:
+            print 'Could not fetch the registered clients:', e
+            return
+        self.notify('presence', None, presence)
+
+    def modify(self, text=[], drawing=[], type = 'text', traceId=None,
+               baseRev=None):
+        """
+        Changed the state of the server data.
+
+        Args:
+            type: 'text', 'edit', 'drawing' or 'strokes'.
+                Specifies whether text or drawing should be updated. For
+                'strokes', drawing is the segments to append
+            traceId: string; trace id of the edit, see PypadTrace.py
+            baseRev: int; for 'edit', the revision the edit was made on. 
+                The server refuses the edit with ValueError if its text 
+                changed since (see PypadData.editText)
+
+        Returns the server's new revision number for text changes. In CRDT
+        mode, text changes don't wait for the server, and the last known 
+        revision number is returned
+        """
+        if self.crdtMode and (type == 'text' or type == 'edit'):
+            if self.crdt == None:
+                self.joinCrdt()
+            if type == 'text':
+                text = diffText(self.syncedText, text)
+                if text == None:
+                    return self.serverRev
+            return self.crdtEdit(text)
+        start = tracer.now()
+        rev = self.call('setState', self.name, newText = text, 
+                                   newDrawing = drawing, type = type, 
+                                   traceId = traceId, baseRev = baseRev)
+        tracer.span(traceId, 'client.modify', start)
+        if type != 'drawing' and type != 'strokes':
+            self.serverRev = max(rev, self.serverRev)
+        if type == 'text':
+            # the server's text is now exactly the text that was sent
+            self.syncedText, self.syncedRev = text, rev
+        elif type == 'drawing':
+            self.syncedDrawing, self.drawingSeq = list(drawing), rev
+            self.drawingSnapshot = None
+        elif type == 'strokes':
+            if self.drawingSeq != None and rev == self.drawingSeq + 1:
+                self.syncedDrawing = self.syncedDrawing + list(drawing)
+                self.drawingSeq = rev
+            # otherwise the next syncDrawing fetches them with the changes
+            # made in between
+        elif type == 'edit':
+            if self.syncedRev != None and rev == self.syncedRev + 1:
+                self.syncedText = applyEdit(self.syncedText, text)
+                self.syncedRev = rev
+            else:
+                # someone else's edit came in between, so the synced text is
+                # unknown until the next syncText
+                self.syncedText, self.syncedRev = None, None
+        return rev
+
+    # Convenience wrappers around the server's getters and setters
+    def getText(self):
+        """Returns the server's current text"""
+        return self.call('getState', 'text')
+    def setText(self, text, traceId=None):
+        """Replaces the server's text"""
+        self.modify(text = text, type = 'text', traceId = traceId)
+    def editText(self, offset, length, text, traceId=None):
+        """
+        Replaces length characters at offset of the server's text by text.
+        Only the edit is sent, so this is much cheaper than setText for 
+        large documents.
+        """
+        self.modify(text = (offset, length, text), type = 'edit', 
+                    traceId = traceId)
+    def getDrawing(self):
+        """Returns the server's current drawing"""
+        return self.call('getState', 'drawing')
+    def setDrawing(self, drawing):
+        """Replaces the server's drawing"""
+        self.modify(drawing = drawing, type = 'drawing')
+    def addStrokes(self, segments):
+        """Appends segments to the server's drawing"""
+        self.modify(drawing = segments, type = 'strokes')
+    def streamText(self, firstChunkSize=FIRST_CHUNK_SIZE, 
+                   chunkSize=CHUNK_SIZE):
+        """
+        Generator fetching the server's current text in chunks, so that a
+        large document never travels in one Pyro response.
+        
+        Yields (rev, offset, totalLength, chunk) for each chunk, in order. 
+        All chunks belong to revision rev, even if the text changes while 
+        it is being fetched. In CRDT mode, the text is the client's replica
+        as fetched by joinCrdt, and rev the last known revision.
+        """
+        if self.crdtMode:
+            self.joinCrdt()
+            text = self.syncedText
+            offset = 0
+            size = firstChunkSize
+            while True:
+                yield self.serverRev, offset, len(text), \
+                    text[offset : offset + size]
+                offset += size
+                size = chunkSize
+                if offset >= len(text):
+                    return
+        rev, totalLength, chunk = self.call('getTextHead', firstChunkSize)
+        chunks = [chunk]
+        yield rev, 0, totalLength, chunk
+        offset = len(chunk)
+        while offset < totalLength:
+            chunk = self.call('getTextRange', offset, chunkSize, rev)
+            if chunk == '':
+                break
+            chunks.append(chunk)
+            yield rev, offset, totalLength, chunk
+            offset += len(chunk)
+        self.syncedText, self.syncedRev = ''.join(chunks), rev
+    def importText(self, text, chunkSize=CHUNK_SIZE, progress=None, 
+                   traceId=None):
+        """
+        Replaces the server's text by text, uploading it in chunks so that a
+        large document never travels in one Pyro call (see 
+        PypadServer.beginImport). The other clients see one new revision.
+        
+        Args:
+            text: string, or anything else with a length that can be sliced,
+                such as an mmap, so only one chunk at a time is read
+            chunkSize: int; characters sent per call
+            progress: callable taking (sent, totalLength), called after each
+                chunk, or None
+            traceId: string; trace id of the import, see PypadTrace.py
+        
+        Returns the new revision number
+        """
+        totalLength = len(text)
+        self.call('beginImport', self.name)
+        chunks = []
+        offset = 0
+        while offset < totalLength:
+            chunk = text[offset : offset + chunkSize]
+            self.call('importChunk', self.name, offset, chunk)
+            chunks.append(chunk)
+            offset += len(chunk)
+            if progress != None:
+                progress(offset, totalLength)
+        rev = self.call('endImport', self.name, traceId)
+        self.serverRev = max(rev, self.serverRev)
+        if self.crdtMode:
+            # the server made the operations; merge them right away
+            self.syncText()
+        else:
+            self.syncedText, self.syncedRev = ''.join(chunks), rev
+        return rev
+    def importFile(self, path, chunkSize=CHUNK_SIZE, progress=None):
+        """
+        Replaces the server's text by the contents of the file at path, 
+        which is memory mapped and uploaded with importText
+        
+        Returns the new revision number
+        """
+        textfile = open(path, 'rb')
+        try:
+            if os.fstat(textfile.fileno()).st_size == 0:
+                # empty files can't be mapped
+                return self.importText('', chunkSize, progress)
+            data = mmap.mmap(textfile.fileno(), 0, access = mmap.ACCESS_READ)
+            try:
+                return self.importText(data, chunkSize, progress)
+            finally:
+                data.close()
+        finally:
+            textfile.close()
+    def syncText(self):
+        """
+        Brings syncedText up to the server's current revision. If the text 
+        was fetched before, only the difference since then is downloaded 
+        (see PypadServer.getDiff).
+        
+        Returns the list of edits that turned the old syncedText into the 
+        new one, or None if the whole text had to be fetched.
+        
+        In CRDT mode, merges the operations that came in instead, see 
+        syncCrdt.
+        """
+        if self.crdtMode:
+            return self.syncCrdt()
+        if self.syncedRev == None:
+            for chunk in self.streamText():
+                pass
+            return None
+        rev = self.call('getRevNum')
+        edits = self.call('getDiff', self.syncedRev, rev)
+        text = self.syncedText
+        for edit in edits:
+            text = applyEdit(text, edit)
+        self.syncedText, self.syncedRev = text, rev
+        self.serverRev = max(rev, self.serverRev)
+        return edits
+    # CRDT mode, see PypadCrdt.py
+    def joinCrdt(self, pending=None):
+        """
+        Fetches the server's replica of the text and makes it this client's
+        replica. 
+        
+        Args:
+            pending: list of (ops, edit) for local edits the server never 
+                got, from a replica of an earlier epoch. Their edits are 
+                made again on the new replica, at the same offsets
+        """
+        epoch, seq, state = self.call('getCrdtState')
+        if state == None:
+            raise ValueError('%s is not in CRDT mode' % self.serverName)
+        self.crdtLock.acquire()
+        try:
+            self.crdt = RgaDocument(self.clientName, state = state)
+            self.crdtEpoch, self.crdtSeq = epoch, seq
+            self.syncedText = self.crdt.getText()
+            self.crdtPending = []
+            for ops, edit in pending or []:
+                offset, length, text = edit
+                offset = min(offset, len(self.syncedText))
+                length = min(length, len(self.syncedText) - offset)
+                self.crdtEdit((offset, length, text))
+        finally:
+            self.crdtLock.release()
+    
+    def crdtEdit(self, edit):
+        """
+        Applies a local edit to the replica and syncedText, and queues the
+        operations for crdtSendLoop. Returns the last known revision number
+        """
+        self.crdtLock.acquire()
+        try:
+            ops = self.crdt.localEdit(*edit)
+            self.syncedText = applyEdit(self.syncedText, edit)
+            self.crdtPending.append((ops, edit))
+        finally:
+            self.crdtLock.release()
+        self.crdtWakeup.set()
+        return self.serverRev
+    
+    def crdtSendLoop(self):
+        """
+        Sends the pending operations to the server, all at once, until 
+        stop is called. When the server can't be reached they are kept and
+        sent again after the next edit or RENEW_INTERVAL seconds. When the
+        server refuses them (because its replica was made anew, see 
+        PypadData.applyCrdtOps), the client joins again and makes the 
+        pending edits again on the new replica.
+        """
+        while not self.stopped.isSet():
+            self.crdtWakeup.wait(RENEW_INTERVAL)
+            self.crdtWakeup.clear()
+            self.crdtLock.acquire()
+            try:
+                batch = list(self.crdtPending)
+                epoch = self.crdtEpoch
+            finally:
+                self.crdtLock.release()
+            if not batch:
+                continue
+            ops = []
+            for batchOps, edit in batch:
+                ops.extend(batchOps)
+            try:
+                rev = self.call('setState', self.name, newText = ops, 
+                                type = 'crdt', epoch = epoch)
+            except ValueError, e:
+                print 'The server refused %d edits, joining again:' % \
+                    len(batch), e
+                self.crdtLock.acquire()
+                try:
+                    try:
+                        # unless syncCrdt joined meanwhile
+                        if self.crdtEpoch == epoch:
+                            self.joinCrdt(self.crdtPending)
+                    except Exception, e:
+                        print 'Could not join again, keeping the edits:', e
+                        continue
+                finally:
+                    self.crdtLock.release()
+                # the listeners show the new replica; its edits go next
+                self.notify('resync')
+                self.crdtWakeup.set()
+                continue
+            except Exception, e:
+                print 'Could not send %d edits, keeping them:' % len(batch), e
+                continue
+            self.serverRev = max(rev, self.serverRev)
+            self.crdtLock.acquire()
+            try:
+                # unless joinCrdt replaced them meanwhile
+                if self.crdtPending[:len(batch)] == batch:
+                    del self.crdtPending[:len(batch)]
+            finally:
+                self.crdtLock.release()
+    
+    def syncCrdt(self):
+        """
+        Merges the operations that came in on the 'crdt' channel into the 
+        replica, in the server's order, fetching missed batches from the
+        server. Returns the edits they made to syncedText, or None if the 
+        replica had to be fetched again as a whole
+        """
+        self.crdtLock.acquire()
+        try:
+            if self.crdt == None:
+                self.joinCrdt()
+                return None
+            inbox, self.crdtInbox = self.crdtInbox, []
+            inbox.sort()
+            ops = []
+            seq = self.crdtSeq
+            for notification in inbox:
+                if notification == None or notification[0] != self.crdtEpoch \
+                or notification[1] > seq + 1:
+                    # missed batches, or the server's replica was made anew
+                    epoch, seq, ops = self.call('getCrdtOps', self.crdtSeq)
+                    if epoch != self.crdtEpoch or ops == None:
+                        self.joinCrdt(self.crdtPending)
+                        return None
+                    break
+                if notification[1] == seq + 1:
+                    seq = notification[1]
+                    ops.extend(notification[2])
+            edits = self.crdt.integrate(ops)
+            self.crdtSeq = seq
+            for edit in edits:
+                self.syncedText = applyEdit(self.syncedText, edit)
+            return edits
+        finally:
+            self.crdtLock.release()
+    
+    def syncDrawing(self):
+        """
+        Brings syncedDrawing up to the server's current drawing. Only the 
+        drawing operations since the last sync are downloaded when the 
+        server still has them.
+        
+        A client joining a large drawing gets the server's raster snapshot
+        (see PypadData.getDrawingSnapshot) and only the operations after it.
+        
+        Returns the list of segments appended to syncedDrawing, or None if
+        the drawing was replaced and has to be redrawn as a whole.
+        """
+        joined = False
+        if self.syncedDrawing == None:
+            seq, snapshot = self.call('getDrawingSnapshot')
+            if snapshot != None:
+                self.drawingSnapshot = snapshot
+                self.syncedDrawing, self.drawingSeq = [], seq
+                joined = True
+        seq, ops = self.call('getDrawingOps', self.drawingSeq)
+        if ops == None or self.syncedDrawing == None:
+            self.drawingSeq, self.syncedDrawing = self.call('getDrawingState')
+            self.syncedDrawing = list(self.syncedDrawing)
+            self.drawingSnapshot = None
+            return None
+        self.replayDrawingOps(ops)
+        self.drawingSeq = seq
+        if joined or [op for op in ops if op[0] != 'add']:
+            return None
+        added = []
+        for op in ops:
+            added.extend(op[1])
+        return added
+    def replayDrawingOps(self, ops):
+        """
+        Applies drawing operations to syncedDrawing. An operation replacing
+        the drawing replaces the snapshot too.
+        """
+        self.syncedDrawing = applyDrawingOps(self.syncedDrawing, ops)
+        if [op for op in ops if op[0] != 'add']:
+            self.drawingSnapshot = None
+    def getTextRange(self, offset, length, rev=None):
+        """Returns length characters of the server's text at offset"""
+        return self.call('getTextRange', offset, length, rev)
+    def getRevNum(self):
+        """Returns the number of the server's current revision"""
+        return self.call('getRevNum')
+    def getHistory(self, num):
+        """Returns the text of revision num"""
+        return self.call('getHistory', num)
+    def getBlame(self, rev=None):
+        """
+        Returns (author, rev) for each line of revision rev, see
+        PypadServer.getBlame
+        """
+        return self.call('getBlame', rev)
+    def searchHistory(self, query):
+        """
+        Returns the (first, last) ranges of revisions containing query, see
+        PypadServer.searchHistory
+        """
+        return self.call('searchHistory', query)
+
+    # Reconnecting
+    def call(self, method, *args, **kwargs):
+        """
+        Invokes method on the server. If the connection to the server was
+        lost, reconnects (see reconnect) and tries once more.
+        """
+        try:
+            return getattr(self.server, method)(*args, **kwargs)
+        except Pyro.errors.ProtocolError:
+            if self.reconnecting:
+                # the server is still unreachable; let reconnect fail
+                raise
+            print 'Lost connection to server, reconnecting'
+            if self.originName != None:
+                self.serverUnreachable()
+            else:
+                self.reconnect()
+            return getattr(self.server, method)(*args, **kwargs)
+
+    def checkRegistration(self):
+        """
+        Reconnects if the server has dropped this client, which happens
+        when a notification fails, for example during a network blip.
+        Returns True if a reconnect was needed.
+        """
+        if self.call('isRegistered', self.clientName):
+            return False
+        print 'Server dropped this client, reconnecting'
+        self.reconnect()
+        return True
+
+    def reconnect(self):
+        """
+        Registers again with the server under the same name, passing the
+        last applied revision and drawing sequence number, and applies what
+        was missed to syncedText and syncedDrawing. The server replays only
+        the missed changes when it can; otherwise the whole text or drawing
+        is downloaded again, if the client is subscribed to it.
+
+        Listeners are then notified with type 'resync'.
+        """
+        self.reconnecting = True
+        try:
+            self.server = NameServer().get_proxy(self.serverName)
+            missed = self.server.reconnect(self.clientName, self.syncedRev,
+                                           self.drawingSeq, self.channels)
+            self.serverRev = missed['rev']
+
+            if missed['edits'] != None and self.syncedText != None:
+                text = self.syncedText
+                for edit in missed['edits']:
+                    text = applyEdit(text, edit)
+                self.syncedText, self.syncedRev = text, missed['rev']
+            elif 'text' in self.channels:
+                # too far behind: download the text again
+                self.syncedText, self.syncedRev = None, None
+                self.syncText()
+            elif self.crdtMode:
+                # catch up, joining again if the server's replica was made
+                # anew, before the edits made meanwhile are sent again
+                self.crdtLock.acquire()
+                try:
+                    self.crdtInbox.append(None)
+                    if self.crdt != None:
+                        self.syncCrdt()
+                finally:
+                    self.crdtLock.release()
+                self.crdtWakeup.set()
+
+            if missed['drawingOps'] != None and self.syncedDrawing != None:
+                self.replayDrawingOps(missed['drawingOps'])
+                self.drawingSeq = missed['drawingSeq']
+            elif 'drawing' in self.channels:
+                self.syncedDrawing, self.drawingSeq = None, None
+                self.drawingSnapshot = None
+                self.syncDrawing()
+        finally:
+            self.reconnecting = False
+
+        self.notify('resync')
+
+    # Leases
+    def renewLoop(self):
+        """
+        Renews the registration with the server every RENEW_INTERVAL seconds
+        until stop is called, reconnecting if the server dropped this client
+        """
+        while not self.stopped.isSet():
+            self.stopped.wait(RENEW_INTERVAL)
+            if self.stopped.isSet():
+                break
+            try:
+                if not self.call('renew', self.clientName):
+                    print 'Server dropped this client, reconnecting'
+                    self.reconnect()
+            except Pyro.errors.PyroError:
+                # the server is unreachable; try again at the next renewal
+                print 'Could not reach the server to renew'
+                self.serverUnreachable()
+
+    def serverUnreachable(self):
+        """
+        Called when the server could not be reached. A client served by a 
+        relay asks the origin server for another relay and reconnects to it;
+        other clients wait for the server to come back.
+        """
+        if self.originName == None:
+            return
+        try:
+            origin = NameServer().get_proxy(self.originName)
+            self.serverName = origin.findRelay(self.serverName)
+            print 'Moving to relay', self.serverName
+            self.reconnect()
+        except (Pyro.errors.PyroError, SystemExit), e:
+            # SystemExit is how NameServer.get_proxy reports a missing name
+            print 'Could not move to another relay:', e
+
+    def startRenewing(self):
+        """Starts renewLoop in a separate thread"""
+        renewer = threading.Thread(target = self.renewLoop,
+                                   name = 'LeaseRenewer')
+        renewer.setDaemon(True)
+        renewer.start()
+
+    def start(self):
+        """
+        Starts handling notifications from the server in a separate thread,
+        and renewing the registration in another one. Listeners are only 
+        called while this loop is running.
+        """
+        self.threadLoop()
+        self.startRenewing()
+
+    def stop(self):
+        """Stops the thread started by start and waits for it to finish"""
+        self.stopped.set()
+        self.stopLoop()
+        self.join()
+
+    def cleanup(self):
+        """
+        Inherited RemoteObject method to stop itself
+        Unregisters self from PypadServer
+        """
+        print 'Disconnecting from server'
+        self.stopped.set()
+        try:
+            self.server.unregister(self.clientName)
+        except Pyro.errors.PyroError:
+            # the server is gone; its lease reaper will drop this client
+            pass
+        RemoteObject.cleanup(self)
+
+def main(script, serverName = 'Pypad_dot_com', *args):
+    """
+    Connects to a server without a gui and prints every remote text change.
+    With -relay, the client is served by one of the server's relays, and 
+    with -crdt it is in CRDT mode.
+    """
+    client = PypadClientCore(serverName, viaRelay = '-relay' in args,
+                             crdt = '-crdt' in args)
+    client.start()
+    print client.getText()
+    try:
+        for type, traceId in client.changes():
+            if type == 'text':
+                print '----------'
+                print client.getText()
+    finally:
+        client.stop()
+
+if __name__ == '__main__':
+    main(*sys.argv)
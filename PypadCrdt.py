@@ -0,0 +1,290 @@
+"""
+PypadCrdt.py
+
+INTRODUCTION
+Contains the RgaDocument class, the text of a document as a replicated
+growable array (RGA), a sequence CRDT. It is used by the optional CRDT mode
+of PypadServer (-crdt) and PypadClientCore (crdt=True).
+
+Without it, a client's edit is an offset into the text it last synced; when
+two clients type at once, one of them sends the whole text (see
+PypadClient.sendText) and the other one's keystrokes are lost. In CRDT mode
+every character has a unique id, and edits refer to ids instead of offsets,
+so they can be applied in any state that has the characters they refer to.
+Every client applies its own edits to its replica right away, sends them to
+the server without waiting for the reply, and merges the edits of others as
+they come in. All replicas that applied the same operations have the same
+text, whatever order concurrent operations came in. The server merges the
+operations into its own replica too, which turns them into ordinary edits
+(offset, length, text) for the history, and passes them on.
+
+OPERATIONS
+Ids are pairs (counter, site): a Lamport clock and the name of the client
+that made the character. The characters of the initial text have the site
+origin the replica was made with; the server uses its epoch (see
+PypadServer.enableCrdt), so the ids of a new replica never clash with those
+of an earlier one.
+
+    ('ins', id, ref, text)  inserts text after the character ref (None for
+                            the start of the document). The characters get
+                            the ids (counter, site), (counter + 1, site) ...
+    ('del', ids)            deletes the characters with the given ids
+
+Concurrent inserts after the same character are ordered by id, larger
+first, which is what makes all replicas agree (see insertPosition).
+Operations a replica already applied are skipped, so operations can be sent
+again after reconnecting. Operations must be applied after the operations
+that made the characters they refer to; the server passes them on in the
+order it applied them, which guarantees that. A batch that refers to a
+character the replica doesn't have, or isn't made of operations at all, is
+refused as a whole with ValueError before any of it is applied (see check).
+
+Deleted characters stay in the array as tombstones, since later operations
+may refer to them. The array is kept in blocks of about BLOCK_SIZE
+characters with their number of visible characters, so finding an offset or
+an id costs O(n / BLOCK_SIZE + BLOCK_SIZE) rather than a scan of the
+document.
+
+An RgaDocument is not thread safe; its users serialize access.
+"""
+
+# characters per block of the array; blocks are split at twice this size
+BLOCK_SIZE = 512
+
+class Block:
+    """A run of the array: ids, characters and which of them are visible"""
+    def __init__(self, ids, chars, alive):
+        self.ids = ids
+        self.chars = chars
+        self.alive = alive
+        self.visible = alive.count(True)
+
+class RgaDocument:
+    """
+    One replica of a document's text, see above
+    """
+    def __init__(self, site, text='', state=None, origin=''):
+        """
+        Constructor for RgaDocument
+
+        Args:
+            site: string; the name ids of local edits are made with
+            text: string; the initial text, whose characters get the ids
+                (1, origin) ...
+            state: the state of another replica (see getState), which is
+                copied instead
+            origin: string; the site of the initial text's ids
+        """
+        self.site = site
+        if state != None:
+            self.clock, ids, chars, alive = state
+            alive = [flag == '1' for flag in alive]
+        else:
+            self.clock = len(text)
+            ids = [(counter, origin) for counter in range(1, len(text) + 1)]
+            chars, alive = text, [True] * len(text)
+        self.blocks = []
+        self.blockOf = {}
+        for start in range(0, len(ids), BLOCK_SIZE):
+            self.addBlock(len(self.blocks),
+                          Block(ids[start : start + BLOCK_SIZE],
+                                list(chars[start : start + BLOCK_SIZE]),
+                                alive[start : start + BLOCK_SIZE]))
+        if not self.blocks:
+            self.addBlock(0, Block([], [], []))
+
+    def addBlock(self, index, block):
+        """Inserts block at index of the block list"""
+        self.blocks.insert(index, block)
+        for id in block.ids:
+            self.blockOf[id] = block
+
+    def getState(self):
+        """
+        Returns the state of the replica as (clock, ids, characters,
+        alive), for other replicas to start from. alive is a string of '1'
+        for visible and '0' for deleted characters
+        """
+        ids, chars, alive = [], [], []
+        for block in self.blocks:
+            ids.extend(block.ids)
+            chars.extend(block.chars)
+            alive.extend(block.alive)
+        return (self.clock, ids, ''.join(chars),
+                ''.join([flag and '1' or '0' for flag in alive]))
+
+    def __len__(self):
+        """Returns the length of the visible text"""
+        return sum([block.visible for block in self.blocks])
+
+    def getText(self):
+        """Returns the visible text"""
+        return ''.join([''.join([char for char, flag
+                                 in zip(block.chars, block.alive) if flag])
+                        for block in self.blocks])
+
+    def __contains__(self, id):
+        return id in self.blockOf
+
+    def locate(self, id):
+        """Returns (block index, index in the block) of the character id"""
+        block = self.blockOf[id]
+        return self.blocks.index(block), block.ids.index(id)
+
+    def offsetOf(self, blockIndex, index):
+        """Returns the number of visible characters before a position"""
+        before = sum([block.visible for block in self.blocks[:blockIndex]])
+        return before + self.blocks[blockIndex].alive[:index].count(True)
+
+    def visibleAt(self, offset):
+        """
+        Returns (block index, index in the block) of the visible character
+        at offset
+        """
+        for blockIndex, block in enumerate(self.blocks):
+            if offset < block.visible:
+                for index, flag in enumerate(block.alive):
+                    if flag:
+                        if offset == 0:
+                            return blockIndex, index
+                        offset -= 1
+            offset -= block.visible
+        raise IndexError('offset is beyond the end of the text')
+
+    def insertPosition(self, id, ref):
+        """
+        Returns (block index, index in the block) where the run starting
+        with id goes when it is inserted after ref: right after ref, but
+        after the characters inserted after ref with larger ids (and the
+        characters after them, whose ids are larger still)
+        """
+        if ref == None:
+            blockIndex, index = 0, 0
+        else:
+            blockIndex, index = self.locate(ref)
+            index += 1
+        while True:
+            block = self.blocks[blockIndex]
+            if index == len(block.ids):
+                if blockIndex + 1 == len(self.blocks):
+                    return blockIndex, index
+                blockIndex, index = blockIndex + 1, 0
+            elif block.ids[index] > id:
+                index += 1
+            else:
+                return blockIndex, index
+
+    def insert(self, blockIndex, index, ids, text):
+        """Puts the run ids, text at a position, splitting large blocks"""
+        block = self.blocks[blockIndex]
+        block.ids[index:index] = ids
+        block.chars[index:index] = list(text)
+        block.alive[index:index] = [True] * len(ids)
+        block.visible += len(ids)
+        for id in ids:
+            self.blockOf[id] = block
+        if len(block.ids) > 2 * BLOCK_SIZE:
+            del self.blocks[blockIndex]
+            for start in range(0, len(block.ids), BLOCK_SIZE):
+                self.addBlock(blockIndex,
+                              Block(block.ids[start : start + BLOCK_SIZE],
+                                    block.chars[start : start + BLOCK_SIZE],
+                                    block.alive[start : start + BLOCK_SIZE]))
+                blockIndex += 1
+
+    def localEdit(self, offset, length, text):
+        """
+        Applies an edit of the visible text made on this replica. Returns
+        the operations that make the same change on other replicas
+        """
+        ops = []
+        if length > 0:
+            ids = []
+            blockIndex, index = self.visibleAt(offset)
+            while len(ids) < length:
+                block = self.blocks[blockIndex]
+                if index == len(block.ids):
+                    blockIndex, index = blockIndex + 1, 0
+                    continue
+                if block.alive[index]:
+                    ids.append(block.ids[index])
+                index += 1
+            ops.append(('del', ids))
+        if text:
+            ref = None
+            if offset > 0:
+                blockIndex, index = self.visibleAt(offset - 1)
+                ref = self.blocks[blockIndex].ids[index]
+            ops.append(('ins', (self.clock + 1, self.site), ref, text))
+        self.integrate(ops)
+        return ops
+
+    def check(self, ops):
+        """
+        Raises ValueError unless ops is a list of well formed operations
+        that only refer to characters of the replica or inserted earlier in
+        the list. Changes nothing
+        """
+        def isId(id):
+            return isinstance(id, tuple) and len(id) == 2 and \
+                isinstance(id[0], (int, long)) and id[0] > 0 and \
+                isinstance(id[1], str)
+        if not isinstance(ops, (list, tuple)):
+            raise ValueError('operations must be a list')
+        inserted = {}
+        for op in ops:
+            if not isinstance(op, tuple) or not op:
+                raise ValueError('malformed operation %r' % (op,))
+            if op[0] == 'ins' and len(op) == 4:
+                id, ref, text = op[1:]
+                if not isId(id) or not isinstance(text, str) or not text:
+                    raise ValueError('malformed operation %r' % (op,))
+                if ref != None and (not isId(ref) or ref not in self.blockOf
+                                    and ref not in inserted):
+                    raise ValueError('unknown character %r' % (ref,))
+                for i in range(len(text)):
+                    inserted[(id[0] + i, id[1])] = True
+            elif op[0] == 'del' and len(op) == 2 and \
+            isinstance(op[1], (list, tuple)):
+                for id in op[1]:
+                    if not isId(id) or id not in self.blockOf \
+                    and id not in inserted:
+                        raise ValueError('unknown character %r' % (id,))
+            else:
+                raise ValueError('malformed operation %r' % (op,))
+
+    def integrate(self, ops):
+        """
+        Applies operations made on any replica, skipping the ones already
+        applied. Returns the edits (offset, length, text) they made to the
+        visible text, in order. Raises ValueError, without applying any of
+        them, if they don't pass check
+        """
+        self.check(ops)
+        edits = []
+        for op in ops:
+            if op[0] == 'ins':
+                (counter, site), ref, text = op[1:]
+                if (counter, site) in self.blockOf:
+                    continue
+                ids = [(counter + i, site) for i in range(len(text))]
+                blockIndex, index = self.insertPosition(ids[0], ref)
+                edits.append((self.offsetOf(blockIndex, index), 0, text))
+                self.insert(blockIndex, index, ids, text)
+                self.clock = max(self.clock, counter + len(text) - 1)
+            else:
+                for id in op[1]:
+                    blockIndex, index = self.locate(id)
+                    block = self.blocks[blockIndex]
+                    if not block.alive[index]:
+                        continue
+                    offset = self.offsetOf(blockIndex, index)
+                    block.alive[index] = False
+                    block.visible -= 1
+                    if edits and edits[-1][0] == offset and \
+                    edits[-1][2] == '':
+                        # the next character of a deleted range
+                        edits[-1] = (offset, edits[-1][1] + 1, '')
+                    else:
+                        edits.append((offset, 1, ''))
+        return edits
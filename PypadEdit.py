@@ -0,0 +1,118 @@
+"""
+PypadEdit.py
+
+INTRODUCTION
+Helper functions for edits. An edit is a tuple (offset, length, text) meaning
+"replace the length characters starting at offset by text". Insertions have
+length 0, deletions have text ''.
+
+Edits are what PypadData stores for each revision and what clients send
+instead of the whole document.
+
+Drawings change by drawing operations instead: ('add', segments) appends line
+segments to the drawing and ('set', segments) replaces the whole drawing.
+"""
+
+# strings are compared in blocks of this size before narrowing down to the
+# exact character, so that most of the comparing happens in C
+BLOCK_SIZE = 4096
+
+def commonPrefix(a, b):
+    """Returns the length of the longest common prefix of a and b"""
+    limit = min(len(a), len(b))
+    i = 0
+    while i < limit and a[i : i + BLOCK_SIZE] == b[i : i + BLOCK_SIZE]:
+        i += BLOCK_SIZE
+    if i >= limit:
+        return limit
+    # the first difference is in this block; binary search it
+    low, high = i, min(i + BLOCK_SIZE, limit)
+    while low < high:
+        middle = (low + high) // 2
+        if a[low : middle + 1] == b[low : middle + 1]:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+def commonSuffix(a, b, limit=None):
+    """
+    Returns the length of the longest common suffix of a and b, but no
+    more than limit characters
+    """
+    if limit == None:
+        limit = min(len(a), len(b))
+    lenA, lenB = len(a), len(b)
+    i = 0
+    while i < limit and \
+    a[max(lenA - i - BLOCK_SIZE, lenA - limit) : lenA - i] == \
+    b[max(lenB - i - BLOCK_SIZE, lenB - limit) : lenB - i]:
+        i += BLOCK_SIZE
+    if i >= limit:
+        return limit
+    low, high = i, min(i + BLOCK_SIZE, limit)
+    while low < high:
+        middle = (low + high) // 2
+        if a[lenA - middle - 1 : lenA - low] == b[lenB - middle - 1 : lenB - low]:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+def diffText(old, new):
+    """
+    Returns the smallest single edit that turns old into new, or None if they
+    are equal
+
+    Args:
+        old, new: strings
+    """
+    if old == new:
+        return None
+    prefix = commonPrefix(old, new)
+    suffix = commonSuffix(old, new, min(len(old), len(new)) - prefix)
+    return (prefix, len(old) - prefix - suffix,
+            new[prefix : len(new) - suffix])
+
+def applyEdit(text, edit):
+    """Returns text with edit applied"""
+    offset, length, insert = edit
+    return text[:offset] + insert + text[offset + length:]
+
+def composeRange(edits):
+    """
+    Composes a series of edits into the one range they changed.
+
+    Returns (start, oldEnd, newEnd), meaning that text[start:oldEnd] before
+    the edits became text[start:newEnd] after them, and everything outside
+    that range is unchanged. Returns None if the edits changed nothing.
+    Costs O(number of edits), independent of the size of the text.
+    """
+    changed = None
+    for edit in edits:
+        if edit == None:
+            continue
+        offset, length, text = edit
+        if length == 0 and len(text) == 0:
+            continue
+        if changed == None:
+            changed = (offset, offset + length, offset + len(text))
+            continue
+        start, oldEnd, newEnd = changed
+        # the union of the changed range and this edit, in the coordinates
+        # of the text before this edit
+        end = max(newEnd, offset + length)
+        changed = (min(start, offset),
+                   end - (newEnd - oldEnd),
+                   end + len(text) - length)
+    return changed
+
+def applyDrawingOps(drawing, ops):
+    """Returns a new drawing (list of segments) with ops applied, in order"""
+    drawing = list(drawing)
+    for op in ops:
+        if op[0] == 'add':
+            drawing.extend(op[1])
+        elif op[0] == 'set':
+            drawing = list(op[1])
+    return drawing
@@ -70,7 +70,15 @@ import wx
 import wx.richtext as rt
 import os.path
 import sys
+import mmap
+from cStringIO import StringIO
+from threading import Thread
 from time import sleep
+from PypadTrace import tracer
+from PypadEdit import diffText
+
+# files are read and written on a worker thread this many bytes at a time
+FILE_CHUNK_SIZE = 262144
 
 DEBUG = True    # change this flag if you want details on every gui change
 
@@ -92,7 +100,11 @@ class PypadGuiText(wx.Frame):
         wx.Frame.__init__(self, parent, id, title, position, size) 
         self.textpanel = wx.Panel (self)
         self.textpanel.SetBackgroundColour('white')
-        self.control = wx.TextCtrl(self, size=(400, 500), style=wx.TE_MULTILINE)
+        # a rich text control: on Windows, a plain multiline one counts a 
+        # newline as two positions, so offsets into the text (see 
+        # applyEdit) would be off by one per line
+        self.control = wx.TextCtrl(self, size=(400, 500), 
+                                   style=wx.TE_MULTILINE | wx.TE_RICH2)
         self.sizer = wx.BoxSizer(wx.HORIZONTAL)
         self.control.Bind(wx.EVT_TEXT, self.onTextChange)
         self.CreateExteriorWindowComponents()
@@ -130,9 +142,25 @@ class PypadGuiText(wx.Frame):
         # True when gui text becomes different from server text
         self.textChangeFlag = False 
         
+        # trace id of the edit the user is typing, see PypadTrace.py
+        self.traceId = None
+
+        # the drawing window of the same PypadGui, set by PypadGui
+        self.drawingWindow = None
+
         # Filename related attributes
         self.filename = "pypadtext.txt"
         self.dirname = '.'
+        
+        # True while a file is read or written by a worker thread
+        self.loadingFile = False
+        self.savingFile = False
+        # True once an opened file is in the text area and has to be 
+        # uploaded to the server, see takeImportRequest
+        self.importRequested = False
+        
+        # shown in the status bar while a document streams in
+        self.streamLabel = 'Loading document'
 
 # Text  collaboration framework created by Jason, Reyner, Steven 
 # Steven made all the getter/setter methods. 
@@ -145,6 +173,14 @@ class PypadGuiText(wx.Frame):
         Args: 
             event: a wxpython event
         """
+        # the text of a file being opened is uploaded as a whole once it is
+        # loaded, not keystroke by keystroke
+        if self.loadingFile:
+            return
+        # an edit is traced from its first keystroke until the client sends it
+        if self.traceId == None:
+            self.traceId = tracer.newTraceId()
+            tracer.mark(self.traceId, 'gui.onTextChange')
         self.textChangeFlag = True;
     def getText(self):
         """Getter for string in gui text area """
@@ -154,13 +190,58 @@ class PypadGuiText(wx.Frame):
         Setter for gui text area. Also make sure cursor remains in one place
         thru the insertion point methods
         
+        Only the range that differs from the current text is replaced, so 
+        the cost of updating the control depends on the size of the change,
+        not on the size of the document, and the text doesn't flicker.
+        
         Args:
             textState: string; 
         """
-        oldInsertionPoint = self.control.GetInsertionPoint()
-        self.control.SetValue(textState)
-        self.control.SetInsertionPoint(oldInsertionPoint)   
+        edit = diffText(self.control.GetValue(), textState)
+        if edit != None:
+            self.applyEdit(edit)
         self.textChangeFlag = False
+        self.traceId = None
+    def applyEdit(self, edit):
+        """
+        Applies a remote edit to the gui text area with Replace, Remove or
+        WriteText, shifting the cursor and selection so they stay on the 
+        same text. Positions in the control are offsets into its text, since
+        the control is TE_RICH2 (see __init__)
+        
+        Args:
+            edit: (offset, length, text); see PypadEdit.py
+        """
+        offset, length, text = edit
+        end = offset + length
+        selectionStart, selectionEnd = self.control.GetSelection()
+        insertionPoint = self.control.GetInsertionPoint()
+        
+        def shift(position):
+            """Returns where position ends up after the edit"""
+            if position <= offset:
+                return position
+            elif position >= end:
+                return position + len(text) - length
+            else:
+                # the position was inside the replaced text
+                return offset + len(text)
+        
+        if length > 0 and len(text) > 0:
+            self.control.Replace(offset, end, text)
+        elif length > 0:
+            self.control.Remove(offset, end)
+        elif len(text) > 0:
+            self.control.SetInsertionPoint(offset)
+            self.control.WriteText(text)
+        
+        if selectionStart != selectionEnd:
+            self.control.SetSelection(shift(selectionStart), 
+                                      shift(selectionEnd))
+        else:
+            self.control.SetInsertionPoint(shift(insertionPoint))
+        self.textChangeFlag = False
+        self.traceId = None
     def hasTextChanged(self):
         """
         Returns true whenever the text area has been changed by user typing
@@ -172,6 +253,74 @@ class PypadGuiText(wx.Frame):
         updates the gui from server data
         """
         self.textChangeFlag = False
+        self.traceId = None
+    def getTraceId(self):
+        """Getter for the trace id of the edit the user is typing"""
+        return self.traceId
+
+# Streamed text, so that the first screen of a large document shows up before
+# the rest of it has arrived
+    def beginStreamedText(self, firstChunk, totalLength):
+        """
+        Shows the first chunk of a document that is still being fetched.
+        The text area is read only until endStreamedText is called, so that
+        the user can't edit (and upload) a partial document.
+        
+        Args:
+            firstChunk: string; the beginning of the document
+            totalLength: int; length of the whole document
+        """
+        self.control.SetEditable(False)
+        self.setText(firstChunk)
+        self.showStreamProgress(len(firstChunk), totalLength)
+    def appendStreamedText(self, chunk, received, totalLength):
+        """
+        Adds the next chunk of a document started with beginStreamedText
+        
+        Args:
+            chunk: string; the next part of the document
+            received: int; number of characters received so far, with chunk
+            totalLength: int; length of the whole document
+        """
+        oldInsertionPoint = self.control.GetInsertionPoint()
+        self.control.AppendText(chunk)
+        self.control.SetInsertionPoint(oldInsertionPoint)
+        self.textChangeFlag = False
+        self.traceId = None
+        self.showStreamProgress(received, totalLength)
+    def endStreamedText(self):
+        """Makes the text area editable again once the document is complete"""
+        self.control.SetEditable(True)
+        self.SetStatusText('')
+    def showStreamProgress(self, received, totalLength):
+        """Shows how much of a streamed document has arrived"""
+        self.showProgress(self.streamLabel, received, totalLength)
+    def showProgress(self, label, done, total):
+        """
+        Shows the progress of a long operation in the status bar, and clears
+        it once done reaches total
+        """
+        if done < total:
+            self.SetStatusText('%s... %d%%' % (label, 100 * done // total))
+        else:
+            self.SetStatusText('')
+    def showUploadProgress(self, sent, totalLength):
+        """
+        Shows how much of an opened file has been uploaded. Called by the 
+        client from its own thread
+        """
+        wx.CallAfter(self.showProgress, 'Uploading', sent, totalLength)
+    def isLoadingFile(self):
+        """Returns True while a file is being opened, see openFile"""
+        return self.loadingFile
+    def takeImportRequest(self):
+        """
+        Returns True once after a file was opened, when the client should
+        upload the text area to the server with PypadClientCore.importText
+        """
+        requested = self.importRequested
+        self.importRequested = False
+        return requested
 
 # History Revision, Added Apr 22 2010 by Jason
 # Updated and improved version, Added Apr 27 2010 by Jason
@@ -228,6 +377,8 @@ class PypadGuiText(wx.Frame):
              (wx.ID_SAVE, '&Save', 'Save the current file', self.OnSave),
              (wx.ID_SAVEAS, 'Save &As', 'Save the file under a different name',
                 self.OnSaveAs),
+             (wx.NewId(), 'Show &Drawing', 'Show the drawing window',
+                self.OnShowDrawing),
              (None, None, None, None),
              (wx.ID_EXIT, 'E&xit', 'Terminate the program', self.OnExit)]:
             if id == None:
@@ -285,13 +436,47 @@ class PypadGuiText(wx.Frame):
         """Called when user clicks File -> Exit """
         self.Close()  # Close the main window.
 
+    def OnShowDrawing(self, event):
+        """Shows the drawing window again after it was closed"""
+        if self.drawingWindow != None:
+            self.drawingWindow.Show()
+
     def OnSave(self, event):
-        """Called when user clicks File -> Save"""
+        """
+        Called when user clicks File -> Save. The text is written by a 
+        worker thread in chunks, so the window stays responsive while a 
+        large document is saved.
+        """
+        if self.savingFile:
+            return
+        self.savingFile = True
+        thread = Thread(target = self.writeFile, 
+                        args = [os.path.join(self.dirname, self.filename), 
+                                self.control.GetValue()])
+        thread.setDaemon(True)
+        thread.start()
+
+    def writeFile(self, path, text):
+        """Writes text to path FILE_CHUNK_SIZE characters at a time"""
         try:    #this try/except was added by Steven to prevent save errors
-            textfile = open(os.path.join(self.dirname, self.filename), 'w')
-            textfile.write(self.control.GetValue())
-            textfile.close()
-        except:
+            textfile = open(path, 'w')
+            try:
+                for offset in range(0, len(text), FILE_CHUNK_SIZE):
+                    textfile.write(text[offset : offset + FILE_CHUNK_SIZE])
+                    wx.CallAfter(self.showProgress, 'Saving', 
+                                 offset + FILE_CHUNK_SIZE, len(text))
+            finally:
+                textfile.close()
+        except EnvironmentError:
+            wx.CallAfter(self.endSave, False)
+        else:
+            wx.CallAfter(self.endSave, True)
+
+    def endSave(self, saved):
+        """Called on the gui thread when writeFile is done"""
+        self.savingFile = False
+        self.SetStatusText('')
+        if not saved:
             dialog = wx.MessageDialog(self, 'Please Save As first', 'Error', wx.OK)
             dialog.ShowModal()
 
@@ -310,11 +495,66 @@ class PypadGuiText(wx.Frame):
         if dlg.ShowModal() == wx.ID_OK:
            self.filename = dlg.GetFilename()
            self.dirname = dlg.GetDirectory()
-           f = open(os.path.join(self.dirname, self.filename), 'r')
-           self.control.SetValue(f.read())
-           f.close()
+           self.openFile(os.path.join(self.dirname, self.filename))
         dlg.Destroy()
 
+    def openFile(self, path):
+        """
+        Shows the file at path in the text area. A worker thread memory maps
+        the file and hands it to the gui thread in chunks, like a streamed
+        document (see beginStreamedText), so the window stays responsive and
+        the first screen shows up right away. Once it is loaded, the client
+        uploads it as one chunked import (see takeImportRequest).
+        """
+        if self.loadingFile:
+            return
+        self.loadingFile = True
+        self.streamLabel = 'Opening ' + os.path.basename(path)
+        thread = Thread(target = self.readFile, args = [path])
+        thread.setDaemon(True)
+        thread.start()
+
+    def readFile(self, path):
+        """Reads path for openFile, FILE_CHUNK_SIZE bytes at a time"""
+        try:
+            textfile = open(path, 'rb')
+            try:
+                size = os.fstat(textfile.fileno()).st_size
+                # empty files can't be mapped
+                data = ''
+                if size > 0:
+                    data = mmap.mmap(textfile.fileno(), 0, 
+                                     access = mmap.ACCESS_READ)
+                try:
+                    wx.CallAfter(self.beginStreamedText, 
+                                 data[:FILE_CHUNK_SIZE], size)
+                    for offset in range(FILE_CHUNK_SIZE, size, 
+                                        FILE_CHUNK_SIZE):
+                        chunk = data[offset : offset + FILE_CHUNK_SIZE]
+                        wx.CallAfter(self.appendStreamedText, chunk, 
+                                     offset + len(chunk), size)
+                finally:
+                    if size > 0:
+                        data.close()
+            finally:
+                textfile.close()
+        except EnvironmentError:
+            wx.CallAfter(self.endOpenFile, False)
+        else:
+            wx.CallAfter(self.endOpenFile, True)
+
+    def endOpenFile(self, opened):
+        """Called on the gui thread when readFile is done"""
+        self.endStreamedText()
+        self.streamLabel = 'Loading document'
+        self.loadingFile = False
+        if opened:
+            self.importRequested = True
+        else:
+            dialog = wx.MessageDialog(self, 'Could not open ' + self.filename,
+                                      'Error', wx.OK)
+            dialog.ShowModal()
+
     def OnSaveAs(self, event):
         """Called when user clicks File -> Open"""
         if self.askUserForFilename(defaultFile=self.filename, \
@@ -346,11 +586,18 @@ class PypadGuiDrawing(wx.Frame):
         # lineList  is data structure that stores the list of lines drawn. 
         # It is used to communicate data to the client to server
         
+        # the server's raster snapshot of the drawing (see PypadRaster.py) 
+        # as a PNG image and as a bitmap, drawn below lineList; None unless
+        # the client joined a large drawing
+        self.snapshotImage = None
+        self.snapshot = None
+        
         # Bind drawing methods to mouse movements
         self.drawpanel.Bind(wx.EVT_PAINT, self.DrawSetup)
         self.drawpanel.Bind(wx.EVT_MOTION, self.DrawDrawing)
         self.drawpanel.Bind(wx.EVT_LEFT_DOWN, self.DrawDrawing)
         self.drawpanel.Bind(wx.EVT_RIGHT_DOWN, self.ReadDrawing)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
 	
 		# drawingChangeFlag notifies controller if drawing should be updated
         # When user edits the drawing
@@ -366,14 +613,35 @@ class PypadGuiDrawing(wx.Frame):
     def getDrawing(self):
         """Getter for data structure representing drawn lines"""
         return (self.lineList)
-    def setDrawing(self, lineList):
+    def setDrawing(self, lineList, snapshot=None):
         """
         Updates the drawing from external lineList by calling readDrawing method
         Called by client whenever server needs to update this gui
-        """
+        
+        Args:
+            lineList: list of segments
+            snapshot: string; PNG image of the drawing before lineList, or 
+                None if lineList is the whole drawing
+        """
+        if snapshot is not self.snapshotImage:
+            self.snapshotImage = snapshot
+            self.snapshot = None
+            if snapshot != None:
+                image = wx.ImageFromStream(StringIO(snapshot), 
+                                           wx.BITMAP_TYPE_PNG)
+                self.snapshot = image.ConvertToBitmap()
+                # only the segments are blitted, not the white background
+                self.snapshot.SetMask(wx.Mask(self.snapshot, wx.WHITE))
         self.lineList = lineList
         self.ReadDrawing()
         
+    def isDrawingShown(self):
+        """
+        Returns True if the window is shown. The client only listens to
+        drawing changes while it is
+        """
+        return self.IsShown()
+
     def hasDrawingChanged(self):
         """
         Returns true whenever the drawing area has been changed by user
@@ -477,6 +745,8 @@ class PypadGuiDrawing(wx.Frame):
             #clear
             if IsPointInRect(point, wx.Rect(5, 50, 65, 12)):
                 self.lineList = list()
+                self.snapshotImage = None
+                self.snapshot = None
                 self.dc.Clear()
                 self.DrawPanel()
                 self.onDrawingChange(event)
@@ -523,6 +793,10 @@ class PypadGuiDrawing(wx.Frame):
         """
         
         self.DrawPanel()
+        
+        if self.snapshot != None:
+            # the drawing up to the snapshot, in one blit
+            self.dc.DrawBitmap(self.snapshot, 0, 0, True)
 
         self.dc.SetBrush(wx.Brush('red'))
         self.dc.SetPen(wx.Pen('black',1))
@@ -573,6 +847,13 @@ class PypadGuiDrawing(wx.Frame):
     def OnExit(self, event):
         self.Close()  # Close the main window.
 
+    def OnClose(self, event):
+        """
+        Hides the window instead of destroying it, so that it can be shown
+        again from the text window's menu
+        """
+        self.Hide()
+
 class PypadGui():
     """
     A class that contains both a PypadGuiText and 
@@ -589,6 +870,7 @@ class PypadGui():
         """
         self.t = PypadGuiText(parent, id, title, position, size) 
         self.d = PypadGuiDrawing(parent, id, titled, positiond, sized)
+        self.t.drawingWindow = self.d
         self.t.Show()
         self.d.Show()
 		
@@ -0,0 +1,760 @@
+"""
+PypadHistory.py
+
+INTRODUCTION
+Contains the RevisionStore class, which holds the revision history of a
+PypadData object within a memory budget.
+
+Recent revisions are kept "hot" in memory as ropes (see PypadRope.py). When
+the estimated size of the hot revisions goes over the budget, the oldest ones
+are spilled to disk in segments: each segment file holds the full text of its
+first revision (the keyframe) and the edits leading to the others, compressed
+with zlib. Reading a spilled revision pages its segment back in and replays
+the edits from the keyframe. Recently used segments are cached.
+
+Spilling happens on a background thread, so setState never waits for a
+segment to be compressed and written.
+
+THINNING
+An optional policy thins ancient revisions when they are spilled. It is a list
+of (age, granularity) pairs in seconds, for example
+
+    [(24 * 3600, 3600), (30 * 24 * 3600, 24 * 3600)]
+
+keeps one revision per hour for revisions older than a day and one per day
+for revisions older than a month. Of the revisions in one hour (or day), only
+the last is retained; the edits of the others are folded into it. Revision
+numbers don't change: asking for a thinned revision returns the newest
+retained revision before it.
+
+Revisions spilled before they were old enough are thinned later, by rethin,
+which runs every RETHIN_INTERVAL seconds. Segment files are never modified:
+rethin writes new files, and the old ones are deleted by collectGarbage once
+no checkpoint refers to them.
+"""
+
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from PypadRope import Rope, LEAF_SIZE
+from PypadEdit import composeRange
+from PypadWorkers import workers
+
+# default memory budget for the hot revisions of one document, in bytes
+HISTORY_BUDGET = 64 * 1024 * 1024
+
+# number of revisions spilled together into one segment file
+SEGMENT_SIZE = 1000
+
+# the newest revisions that are always kept hot
+MIN_HOT_REVS = 100
+
+# number of paged-in segments (and rebuilt revisions) that are cached
+SEGMENT_CACHE_SIZE = 4
+
+# rough memory cost of one rope node, in bytes
+NODE_BYTES = 80
+
+# the thinning policy used by PypadServer -thin: hourly revisions after a day,
+# daily revisions after a month
+THINNING = [(24 * 3600, 3600), (30 * 24 * 3600, 24 * 3600)]
+
+# seconds between applications of the thinning policy to spilled segments
+RETHIN_INTERVAL = 3600
+
+def revisionCost(rope, edit):
+    """
+    Estimates the memory used by one hot revision: the nodes it doesn't
+    share with the previous revision (about two per level of the rope),
+    plus the inserted text
+    """
+    cost = NODE_BYTES * (2 * rope.root.height + 2)
+    if edit != None:
+        cost += len(edit[2])
+    return cost
+
+def ropeCost(rope):
+    """
+    Estimates the memory used by a rope that shares no nodes: its text and
+    about two nodes per leaf
+    """
+    return len(rope) + NODE_BYTES * 2 * (len(rope) // LEAF_SIZE + 1)
+
+def syncDirectory(directory):
+    """Flushes the entries of directory to disk, where that is possible"""
+    if os.name == 'nt':
+        # directories can't be opened on Windows
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Segment:
+    """
+    Describes one spilled segment. The segment file holds the revisions
+    first..last, of which only those in revs are retained.
+    """
+    def __init__(self, first, last, revs, filename, size):
+        self.first = first
+        self.last = last
+        self.revs = revs
+        self.filename = filename
+        self.size = size
+
+    def state(self):
+        """Returns the segment as a tuple, for checkpoints"""
+        return (self.first, self.last, self.revs, self.filename, self.size)
+
+class RevisionStore:
+    """
+    The revision history of one document. Revisions are numbered from 1.
+    """
+    def __init__(self, text, budget=HISTORY_BUDGET, directory=None,
+                 thinning=None, when=None, author=None):
+        """
+        Constructor for RevisionStore
+
+        Args:
+            text: string; the text of revision 1
+            budget: int; bytes of hot revisions to keep in memory, or None
+                for no limit
+            directory: string; where segment files go. A temporary
+                directory is made when None, and removed by cleanup
+            thinning: list of (age, granularity) pairs; see above
+            when: float; time of revision 1, default now
+            author: string; name of the client that made revision 1
+        """
+        if when == None:
+            when = time.time()
+        self.budget = budget
+        self.directory = directory
+        # the temporary directory the store made, if it made one
+        self.tempDirectory = None
+        self.thinning = thinning
+
+        # hot revisions: ropes[i] is revision hotStart + i and edits[i] is
+        # the edit that produced it from the revision before; times[i] and
+        # authors[i] tell when and by whom
+        self.hotStart = 1
+        self.ropes = [Rope(text)]
+        self.edits = [None]
+        self.times = [when]
+        self.authors = [author]
+        self.hotBytes = revisionCost(self.ropes[0], None)
+
+        # spilled revisions, in order; they cover revisions 1..hotStart-1
+        self.segments = []
+        self.spilledBytes = 0
+        self.generation = 0
+        # files replaced by rethin, deleted by collectGarbage
+        self.garbage = []
+        # set by the Checkpointer; see collectGarbage
+        self.checkpointed = False
+
+        self.lock = threading.RLock()
+        self.cacheLock = threading.Lock()
+        # (data, bytes) of paged-in segments, by filename, and rebuilt
+        # ropes, by (filename, index). cacheBytes is the memory they use
+        self.segmentCache = OrderedDict()
+        self.revisionCache = OrderedDict()
+        self.cacheBytes = 0
+
+        self.spillWakeup = threading.Event()
+        self.spiller = None
+
+    def __len__(self):
+        """Returns the number of revisions"""
+        # under the lock: spill drops hot revisions before it moves hotStart
+        self.lock.acquire()
+        try:
+            return self.hotStart - 1 + len(self.ropes)
+        finally:
+            self.lock.release()
+
+    def current(self):
+        """Returns the rope of the newest revision"""
+        return self.ropes[-1]
+
+    def append(self, rope, edit, when=None, author=None):
+        """
+        Adds a new revision
+
+        Args:
+            rope: Rope; the text of the new revision
+            edit: the edit that produced it from the previous revision
+            when: float; time of the revision, default now
+            author: string; name of the client that made the revision
+        """
+        if when == None:
+            when = time.time()
+        self.lock.acquire()
+        try:
+            self.ropes.append(rope)
+            self.edits.append(edit)
+            self.times.append(when)
+            self.authors.append(author)
+            self.hotBytes += revisionCost(rope, edit)
+            overBudget = self.overBudget()
+        finally:
+            self.lock.release()
+        if overBudget:
+            self.startSpiller()
+            self.spillWakeup.set()
+
+    # Reading revisions
+    def findSegment(self, rev):
+        """Returns the segment holding spilled revision rev"""
+        firsts = [segment.first for segment in self.segments]
+        return self.segments[bisect_right(firsts, rev) - 1]
+
+    def rope(self, rev):
+        """
+        Returns the rope of revision rev. Spilled revisions are paged in;
+        thinned revisions return the newest retained revision before them.
+        """
+        self.lock.acquire()
+        try:
+            if rev < 1 or rev > len(self):
+                raise IndexError('revision %d does not exist' % rev)
+            if rev >= self.hotStart:
+                return self.ropes[rev - self.hotStart]
+            segment = self.findSegment(rev)
+        finally:
+            self.lock.release()
+
+        index = bisect_right(segment.revs, rev) - 1
+        key = (segment.filename, index)
+        self.cacheLock.acquire()
+        try:
+            if key in self.revisionCache:
+                rope = self.revisionCache.pop(key)
+                self.revisionCache[key] = rope
+                return rope
+        finally:
+            self.cacheLock.release()
+
+        data = self.loadSegment(segment)
+        rope = Rope(data['keyframe'])
+        for edit in data['edits'][1:index + 1]:
+            rope = rope.replace(*edit)
+
+        self.cacheLock.acquire()
+        try:
+            if key not in self.revisionCache:
+                self.cacheBytes += ropeCost(rope)
+            self.revisionCache[key] = rope
+            while len(self.revisionCache) > SEGMENT_CACHE_SIZE:
+                self.cacheBytes -= ropeCost(
+                    self.revisionCache.popitem(last = False)[1])
+        finally:
+            self.cacheLock.release()
+        return rope
+
+    def retainedRev(self, rev):
+        """
+        Returns the newest retained revision at or before rev: rev itself
+        unless it was thinned. rope(rev) is the text of that revision
+        """
+        self.lock.acquire()
+        try:
+            if rev < 1 or rev > len(self):
+                raise IndexError('revision %d does not exist' % rev)
+            if rev >= self.hotStart:
+                return rev
+            segment = self.findSegment(rev)
+        finally:
+            self.lock.release()
+        return segment.revs[bisect_right(segment.revs, rev) - 1]
+
+    def editsBetween(self, low, high):
+        """
+        Returns the list of edits that turn revision low into revision high
+        (low <= high). Thinned revisions contribute their folded edits.
+        """
+        self.lock.acquire()
+        try:
+            hotStart = self.hotStart
+            hotEdits = []
+            if high >= hotStart:
+                hotEdits = self.edits[max(low + 1, hotStart) - hotStart :
+                                      high + 1 - hotStart]
+            segments = [segment for segment in self.segments
+                        if segment.last > low and segment.first <= high]
+        finally:
+            self.lock.release()
+
+        edits = []
+        for segment in segments:
+            data = self.loadSegment(segment)
+            for i in range(len(segment.revs)):
+                if low < segment.revs[i] <= high:
+                    edits.append(data['edits'][i])
+        edits.extend(hotEdits)
+        return [edit for edit in edits if edit != None]
+
+    def walk(self, revs):
+        """
+        Yields (rev, before, edit, after, author) for the given revisions in
+        ascending order: the ropes of the revisions before and after rev, the
+        edit between them and the client that made it. A thinned revision is replaced by the next
+        retained one. Each spilled segment is replayed at most once, however
+        many of its revisions are asked for.
+
+        Args:
+            revs: iterable of revision numbers, all greater than 1
+        """
+        revs = sorted(set(revs))
+        self.lock.acquire()
+        try:
+            hotStart = self.hotStart
+            ropes = list(self.ropes)
+            edits = list(self.edits)
+            authors = list(self.authors)
+            segments = list(self.segments)
+        finally:
+            self.lock.release()
+
+        i = 0
+        for segment in segments:
+            end = bisect_right(revs, segment.last, i)
+            if end == i:
+                continue
+            indexes = sorted(set([bisect_left(segment.revs, rev)
+                                  for rev in revs[i:end]]))
+            i = end
+            data = self.loadSegment(segment)
+            before = None
+            if indexes[0] == 0 and segment.first > 1:
+                before = self.rope(segment.first - 1)
+            rope = Rope(data['keyframe'])
+            k = 0
+            for index in indexes:
+                while k < index:
+                    k += 1
+                    before, rope = rope, rope.replace(*data['edits'][k])
+                edit = data['edits'][index]
+                if before != None and edit != None:
+                    yield (segment.revs[index], before, edit, rope,
+                           data['authors'][index])
+
+        for rev in revs[i:]:
+            if rev > hotStart - 1 + len(ropes):
+                break
+            index = rev - hotStart
+            if index == 0:
+                before = self.rope(rev - 1)
+            else:
+                before = ropes[index - 1]
+            yield rev, before, edits[index], ropes[index], authors[index]
+
+    def authorsOf(self, revs):
+        """
+        Returns a dictionary mapping each of revs to the client that made
+        it. A thinned revision maps to the author of the next retained one.
+        """
+        return self.recorded('authors', revs)
+
+    def timesOf(self, revs):
+        """
+        Returns a dictionary mapping each of revs to its time. A thinned
+        revision maps to the time of the next retained one.
+        """
+        return self.recorded('times', revs)
+
+    def recorded(self, key, revs):
+        """
+        Does the work of authorsOf and timesOf; key is 'authors' or 'times'
+        """
+        found = {}
+        self.lock.acquire()
+        try:
+            hotStart = self.hotStart
+            hot = getattr(self, key)
+            for rev in revs:
+                if hotStart <= rev < hotStart + len(hot):
+                    found[rev] = hot[rev - hotStart]
+            segments = list(self.segments)
+        finally:
+            self.lock.release()
+        spilled = sorted([rev for rev in revs if rev not in found])
+        firsts = [segment.first for segment in segments]
+        for rev in spilled:
+            segment = segments[bisect_right(firsts, rev) - 1]
+            data = self.loadSegment(segment)
+            found[rev] = data[key][bisect_left(segment.revs, rev)]
+        return found
+
+    def loadSegment(self, segment):
+        """Pages a segment file in, using the cache"""
+        self.cacheLock.acquire()
+        try:
+            if segment.filename in self.segmentCache:
+                cached = self.segmentCache.pop(segment.filename)
+                self.segmentCache[segment.filename] = cached
+                return cached[0]
+        finally:
+            self.cacheLock.release()
+
+        f = open(os.path.join(self.directory, segment.filename), 'rb')
+        try:
+            raw = zlib.decompress(f.read())
+        finally:
+            f.close()
+        data = pickle.loads(raw)
+        # segments written before authors were recorded have none
+        data.setdefault('authors', [None] * len(data['revs']))
+
+        self.cacheLock.acquire()
+        try:
+            if segment.filename not in self.segmentCache:
+                # the unpickled segment takes about as much as its pickle
+                self.segmentCache[segment.filename] = (data, len(raw))
+                self.cacheBytes += len(raw)
+            while len(self.segmentCache) > SEGMENT_CACHE_SIZE:
+                self.cacheBytes -= \
+                    self.segmentCache.popitem(last = False)[1][1]
+        finally:
+            self.cacheLock.release()
+        return data
+
+    # Spilling
+    def overBudget(self):
+        """
+        True if hot revisions should be spilled: the store is over budget
+        and has more than the MIN_HOT_REVS newest revisions hot
+        """
+        return self.budget != None and self.hotBytes > self.budget \
+            and len(self.ropes) > MIN_HOT_REVS
+
+    def startSpiller(self):
+        """Starts the background spilling thread, once"""
+        self.lock.acquire()
+        try:
+            if self.spiller == None:
+                self.spiller = threading.Thread(target = self.spillLoop,
+                                                name = 'HistorySpiller')
+                self.spiller.setDaemon(True)
+                self.spiller.start()
+        finally:
+            self.lock.release()
+
+    def spillLoop(self):
+        """
+        Spills segments whenever the store goes over budget, and re-thins
+        old segments every RETHIN_INTERVAL seconds
+        """
+        lastRethin = time.time()
+        while True:
+            self.spillWakeup.wait(RETHIN_INTERVAL)
+            self.spillWakeup.clear()
+            try:
+                while self.overBudget():
+                    self.spill()
+                if time.time() - lastRethin >= RETHIN_INTERVAL:
+                    lastRethin = time.time()
+                    self.rethin()
+            except Exception, e:
+                # keep spilling: the next attempt may work
+                print 'Spilling history failed:', e
+
+    def retained(self, revs, times, now):
+        """
+        Returns the revisions of revs to keep under the thinning policy.
+        The first and the last revision are always kept.
+
+        Args:
+            revs: list of revision numbers, in order
+            times: list; times[i] is the time of revs[i]
+            now: float; the current time
+        """
+        if not self.thinning or len(revs) < 3:
+            return list(revs)
+        kept = [revs[0]]
+        for i in range(1, len(revs) - 1):
+            age = now - times[i]
+            granularity = None
+            for minAge, step in self.thinning:
+                if age >= minAge:
+                    granularity = step
+            if granularity != None and \
+            int(times[i] // granularity) == int(times[i + 1] // granularity):
+                # the next revision is in the same bucket; fold this one in
+                continue
+            kept.append(revs[i])
+        kept.append(revs[-1])
+        return kept
+
+    def writeSegment(self, revs, times, authors, ropes, edits, firstEdit):
+        """
+        Writes a segment file holding the revisions revs
+
+        Args:
+            revs: list of retained revision numbers, in order
+            times: list of their times
+            authors: list of their authors
+            ropes: list of their ropes
+            edits: list; edits[i] is the list of edits turning revs[i-1]
+                into revs[i] (edits[0] is unused)
+            firstEdit: the edit that produced revs[0]
+
+        Returns the new Segment
+        """
+        folded = [firstEdit]
+        for i in range(1, len(revs)):
+            changed = composeRange(edits[i])
+            if changed == None:
+                folded.append((0, 0, ''))
+            else:
+                start, oldEnd, newEnd = changed
+                folded.append((start, oldEnd - start,
+                               ropes[i].slice(start, newEnd)))
+        data = {'revs': revs, 'times': times, 'authors': authors,
+                'keyframe': ropes[0].flatten(), 'edits': folded}
+        pickled = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+        if self.directory == None:
+            self.directory = tempfile.mkdtemp(prefix = 'pypad_history_')
+            self.tempDirectory = self.directory
+        elif not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.generation += 1
+        filename = 'segment.%d.%d' % (revs[0], self.generation)
+        path = os.path.join(self.directory, filename)
+        # compressed by a worker process when the pool is running, see
+        # PypadWorkers.py
+        size = workers.compressFile(pickled, path + '.tmp', 6)
+        os.rename(path + '.tmp', path)
+        # so that the segment's name is on disk before a checkpoint refers
+        # to it
+        syncDirectory(self.directory)
+        return Segment(revs[0], revs[-1], revs, filename, size)
+
+    def spill(self):
+        """
+        Spills the oldest hot revisions to a segment file: SEGMENT_SIZE of
+        them, or fewer if only that many more than MIN_HOT_REVS are hot.
+        The slow part runs without holding the lock; the hot ropes it reads
+        are immutable.
+        """
+        self.lock.acquire()
+        try:
+            first = self.hotStart
+            count = min(SEGMENT_SIZE, len(self.ropes) - MIN_HOT_REVS)
+            ropes = self.ropes[:count + 1]
+            edits = self.edits[:count + 1]
+            times = self.times[:count + 1]
+            authors = self.authors[:count + 1]
+        finally:
+            self.lock.release()
+
+        allRevs = range(first, first + count)
+        revs = self.retained(allRevs, times[:count], time.time())
+        indexes = [rev - first for rev in revs]
+        grouped = [None]
+        for i in range(1, len(indexes)):
+            grouped.append(edits[indexes[i - 1] + 1 : indexes[i] + 1])
+        segment = self.writeSegment(revs, [times[i] for i in indexes],
+                                    [authors[i] for i in indexes],
+                                    [ropes[i] for i in indexes],
+                                    grouped, edits[0])
+
+        self.lock.acquire()
+        try:
+            freed = 0
+            for i in range(count):
+                freed += revisionCost(self.ropes[i], self.edits[i])
+            del self.ropes[:count]
+            del self.edits[:count]
+            del self.times[:count]
+            del self.authors[:count]
+            self.hotStart += count
+            self.hotBytes -= freed
+            self.segments.append(segment)
+            self.spilledBytes += segment.size
+        finally:
+            self.lock.release()
+
+    def rethin(self):
+        """
+        Applies the thinning policy again to the spilled segments, for
+        revisions that have grown old enough since they were spilled
+        """
+        if not self.thinning:
+            return
+        self.lock.acquire()
+        try:
+            segments = list(self.segments)
+        finally:
+            self.lock.release()
+
+        for n in range(len(segments)):
+            segment = segments[n]
+            data = self.loadSegment(segment)
+            revs = self.retained(segment.revs, data['times'], time.time())
+            if len(revs) == len(segment.revs):
+                continue
+
+            # rebuild the retained revisions in one pass over the segment
+            ropes = [Rope(data['keyframe'])]
+            for edit in data['edits'][1:]:
+                ropes.append(ropes[-1].replace(*edit))
+            kept = set(revs)
+            indexes = [i for i in range(len(segment.revs))
+                       if segment.revs[i] in kept]
+            grouped = [None]
+            for i in range(1, len(indexes)):
+                grouped.append(data['edits'][indexes[i - 1] + 1 :
+                                             indexes[i] + 1])
+            newSegment = self.writeSegment(revs,
+                                           [data['times'][i] for i in indexes],
+                                           [data['authors'][i]
+                                            for i in indexes],
+                                           [ropes[i] for i in indexes],
+                                           grouped, data['edits'][0])
+
+            # the segment list may have changed while the segment was
+            # rewritten: spill appends to it and loadState replaces it. 
+            # So the segment is looked up again, under the lock, and the
+            # new file dropped if the segment is gone
+            self.lock.acquire()
+            try:
+                index = None
+                for i in range(len(self.segments)):
+                    if self.segments[i] is segment:
+                        index = i
+                        break
+                if index == None:
+                    self.garbage.append(newSegment.filename)
+                    continue
+                self.segments[index] = newSegment
+                self.spilledBytes += newSegment.size - segment.size
+                self.garbage.append(segment.filename)
+            finally:
+                self.lock.release()
+
+        if not self.checkpointed:
+            self.collectGarbage()
+
+    def collectGarbage(self, garbage=None):
+        """
+        Deletes segment files replaced by rethin. When the document is
+        checkpointed, this is only done after a checkpoint is written, since
+        the previous checkpoint may still refer to them.
+
+        Args:
+            garbage: list of the files to delete, as captured by snapshot;
+                default all of them
+        """
+        self.lock.acquire()
+        try:
+            if garbage == None:
+                garbage = list(self.garbage)
+            self.garbage = [filename for filename in self.garbage
+                            if filename not in garbage]
+        finally:
+            self.lock.release()
+        for filename in garbage:
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                pass
+
+    def cleanup(self):
+        """
+        Removes the temporary directory the store made for its segments,
+        if it made one. Called when the server stops; spilled revisions
+        can't be read afterwards. Segments in a given directory are kept
+        """
+        self.lock.acquire()
+        try:
+            directory, self.tempDirectory = self.tempDirectory, None
+            if directory != None and self.directory == directory:
+                self.directory = None
+        finally:
+            self.lock.release()
+        if directory != None:
+            shutil.rmtree(directory, True)
+
+    # Checkpoints, see PypadCheckpoint.py
+    def snapshot(self):
+        """
+        Captures the store: the segment list and copies of the hot lists.
+        The ropes themselves are immutable, so they are not copied.
+        """
+        self.lock.acquire()
+        try:
+            return {'segments': [segment.state() for segment in self.segments],
+                    'hotStart': self.hotStart,
+                    'generation': self.generation,
+                    'base': self.ropes[0],
+                    'edits': list(self.edits),
+                    'times': list(self.times),
+                    'authors': list(self.authors),
+                    # files no longer referenced once this snapshot is saved
+                    'garbage': list(self.garbage)}
+        finally:
+            self.lock.release()
+
+    def loadState(self, state):
+        """
+        Replaces the store by a checkpointed one. state is a snapshot, with
+        the rope 'base' flattened into the string 'baseText'.
+        """
+        self.lock.acquire()
+        try:
+            self.segments = [Segment(*segment) for segment in
+                             state['segments']]
+            self.spilledBytes = sum([segment.size for segment in
+                                     self.segments])
+            self.hotStart = state['hotStart']
+            # new segment files must not reuse the names of old ones
+            self.generation = max(self.generation, state['generation'])
+            self.ropes = [Rope(state['baseText'])]
+            self.edits = [state['edits'][0]]
+            self.times = [state['times'][0]]
+            # checkpoints from before authors were recorded have none
+            authors = state.get('authors', [None] * len(state['edits']))
+            self.authors = [authors[0]]
+            # what spill frees for each hot revision; append adds the rest
+            self.hotBytes = revisionCost(self.ropes[0], self.edits[0])
+            for edit, when, author in zip(state['edits'][1:],
+                                          state['times'][1:], authors[1:]):
+                self.append(self.ropes[-1].replace(*edit), edit, when, author)
+        finally:
+            self.lock.release()
+        self.cacheLock.acquire()
+        try:
+            self.segmentCache.clear()
+            self.revisionCache.clear()
+            self.cacheBytes = 0
+        finally:
+            self.cacheLock.release()
+
+    def memoryStats(self):
+        """
+        Returns a dictionary with
+            'hot': estimated bytes of the revisions in memory
+            'hotRevisions': the number of revisions in memory
+            'spilled': bytes of the segment files on disk
+            'spilledRevisions': the number of spilled revisions
+            'cache': estimated bytes of paged-in segments and revisions
+        The counters are kept up to date as revisions are added, spilled and
+        paged in, so this costs O(1)
+        """
+        self.lock.acquire()
+        try:
+            return {'hot': self.hotBytes, 'hotRevisions': len(self.ropes),
+                    'spilled': self.spilledBytes,
+                    'spilledRevisions': self.hotStart - 1,
+                    'cache': self.cacheBytes}
+        finally:
+            self.lock.release()
@@ -0,0 +1,166 @@
+"""
+PypadOutbox.py
+
+INTRODUCTION
+Contains the Outbox class, which delivers the server's notifications to one
+client.
+
+Every registered client gets its own Outbox: a bounded queue of
+notifications and a thread that sends them one at a time. A client on a slow
+link only slows down its own thread, so the other clients keep getting their
+notifications as fast as before, and the number of threads no longer grows
+with the number of edits.
+
+When a client falls OUTBOX_SIZE notifications behind, its queue is replaced by
+a single 'resyncNeeded' marker and later notifications are dropped until the
+marker is sent: the client then fetches the current state instead of
+replaying every change. A client whose queue makes no progress for
+STUCK_DEADLINE seconds is disconnected by the server (see Server.reapLoop in
+PypadServer.py).
+"""
+
+import threading
+import time
+from collections import deque
+
+# notifications queued for one client before they collapse into a resync
+OUTBOX_SIZE = 64
+
+# seconds a client's queue may wait without any delivery before the client
+# is disconnected
+STUCK_DEADLINE = 30
+
+# rough memory cost of a queued notification besides its value, and of a
+# number or other small object in a value, in bytes
+NOTIFICATION_BYTES = 120
+OBJECT_BYTES = 24
+
+def valueCost(value):
+    """
+    Estimates the memory used by a notification value: strings by their
+    length, tuples and lists by their items
+    """
+    if isinstance(value, basestring):
+        return OBJECT_BYTES + len(value)
+    if isinstance(value, (tuple, list)):
+        return OBJECT_BYTES + sum([valueCost(item) for item in value])
+    return OBJECT_BYTES
+
+class Outbox(threading.Thread):
+    """
+    The queue of notifications for one client and the thread delivering
+    them. Notifications are tuples (type, traceId, value, created), where
+    created is the time they were queued.
+    """
+    def __init__(self, clientName, deliver, drop, size=OUTBOX_SIZE):
+        """
+        Constructor for Outbox. Call start() to begin delivering.
+
+        Args:
+            clientName: string; the client the notifications are for
+            deliver: callable taking (outbox, type, traceId, created, value);
+                sends one notification, raising an exception if the client
+                can't be reached
+            drop: callable taking clientName; called when a delivery fails
+            size: int; notifications queued before they collapse
+        """
+        threading.Thread.__init__(self, name = 'Outbox ' + clientName)
+        self.setDaemon(True)
+        self.clientName = clientName
+        self.deliver = deliver
+        self.drop = drop
+        self.size = size
+        # the client's proxy, created by deliver on first use. Only this
+        # thread uses it
+        self.proxy = None
+
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        # True while a 'resyncNeeded' marker is queued
+        self.resyncPending = False
+        # time the oldest undelivered notification has been waiting since
+        # the last delivery, or None if the queue is empty
+        self.waitingSince = None
+        # number of notifications dropped because of overflows
+        self.collapsed = 0
+        # estimated memory used by the queued notifications, see valueCost
+        self.queuedBytes = 0
+
+    def put(self, type, traceId=None, value=None):
+        """Queues a notification. Never blocks"""
+        self.condition.acquire()
+        try:
+            if self.closed:
+                return
+            if self.resyncPending:
+                self.collapsed += 1
+                return
+            if len(self.queue) >= self.size:
+                print 'Outbox of %s overflowed, sending resync' % \
+                      self.clientName
+                self.collapsed += len(self.queue) + 1
+                self.queue.clear()
+                self.queuedBytes = 0
+                self.resyncPending = True
+                type, traceId, value = 'resyncNeeded', None, None
+            if self.waitingSince == None:
+                self.waitingSince = time.time()
+            self.queue.append((type, traceId, value, time.time()))
+            self.queuedBytes += NOTIFICATION_BYTES + valueCost(value)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def stuckFor(self, now):
+        """Returns the seconds the queue has waited without a delivery"""
+        waitingSince = self.waitingSince
+        if waitingSince == None:
+            return 0
+        return now - waitingSince
+
+    def close(self):
+        """Stops the thread; queued notifications are discarded"""
+        self.condition.acquire()
+        try:
+            self.closed = True
+            self.queue.clear()
+            self.queuedBytes = 0
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def run(self):
+        """Delivers queued notifications until close is called"""
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                type, traceId, value, created = self.queue.popleft()
+                self.queuedBytes -= NOTIFICATION_BYTES + valueCost(value)
+                if type == 'resyncNeeded':
+                    # what comes after the marker is news to the client
+                    self.resyncPending = False
+            finally:
+                self.condition.release()
+
+            try:
+                self.deliver(self, type, traceId, created, value)
+            except:
+                # the client died (Pyro errors, or a NamingError turned
+                # into SystemExit by NameServer.get_proxy)
+                self.close()
+                self.drop(self.clientName)
+                return
+
+            self.condition.acquire()
+            try:
+                if self.queue:
+                    self.waitingSince = time.time()
+                else:
+                    self.waitingSince = None
+            finally:
+                self.condition.release()
@@ -0,0 +1,228 @@
+"""
+PypadRaster.py
+
+INTRODUCTION
+Contains the DrawingRaster class, which keeps the drawing rasterized on the
+server, and encodePng, which compresses a raster into a PNG image.
+
+A client joining a drawing with many segments would otherwise download all
+of them and draw them one by one (see PypadGuiDrawing.ReadDrawing). With the
+raster, it downloads one compressed image of the drawing up to some sequence
+number instead, shows it, and then only draws the segments added after that
+(see PypadData.getDrawingSnapshot and PypadClientCore.syncDrawing).
+
+The raster is one bit per pixel, black segments on white like the drawing
+window, and is kept up to date as drawing operations are applied: adding
+segments only draws those segments, so the raster costs the server the pixels
+of each new segment rather than a redraw. It is only drawn from scratch when
+the drawing was replaced (a 'set' operation, e.g. after clearing) or loaded.
+The PNG is encoded when a client asks for it and kept until the drawing
+changes again.
+
+The rasterizer is pure Python (Bresenham lines); the image is compressed with
+zlib, so neither the server nor clients without wx need an imaging library.
+Clients choose the end points of their segments, so every segment is clipped
+to the raster (see clipSegment) before it is drawn: a line costs at most the
+pixels it has inside the raster, however far away its end points are.
+"""
+
+import struct
+import zlib
+from array import array
+
+# size of the raster in pixels, the size of the drawing window (see
+# PypadGui.py). Segments outside it are clipped
+RASTER_WIDTH = 500
+RASTER_HEIGHT = 600
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+def pngChunk(type, data):
+    """Returns one PNG chunk: length, type, data and checksum"""
+    checksum = zlib.crc32(type + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + type + data + \
+        struct.pack('>I', checksum)
+
+def encodePng(width, height, pixels):
+    """
+    Returns a one bit grayscale PNG image
+
+    Args:
+        width, height: int; size of the image in pixels
+        pixels: string; the rows of the image from the top, (width + 7) / 8
+            bytes each, the leftmost pixel in the highest bit. 1 is white
+    """
+    stride = (width + 7) // 8
+    # every row starts with its filter type, 0 for none
+    rows = ''.join(['\x00' + pixels[y * stride : (y + 1) * stride]
+                    for y in range(height)])
+    header = struct.pack('>IIBBBBB', width, height, 1, 0, 0, 0, 0)
+    return PNG_SIGNATURE + pngChunk('IHDR', header) + \
+        pngChunk('IDAT', zlib.compress(rows, 6)) + pngChunk('IEND', '')
+
+def clipSegment(x0, y0, x1, y1, width, height):
+    """
+    Returns (x0, y0, x1, y1) clipped to [0, width) x [0, height) with the
+    Liang-Barsky algorithm, or None if the segment lies outside. End points
+    inside are kept as they are; those moved onto the border are rounded to
+    the nearest pixel
+    """
+    dx, dy = x1 - x0, y1 - y0
+    low, high = 0.0, 1.0
+    for p, q in ((-dx, x0), (dx, width - 1 - x0),
+                 (-dy, y0), (dy, height - 1 - y0)):
+        if p == 0:
+            if q < 0:
+                # parallel to this border, and beyond it
+                return None
+            continue
+        t = float(q) / p
+        if p < 0:
+            if t > high:
+                return None
+            low = max(low, t)
+        else:
+            if t < low:
+                return None
+            high = min(high, t)
+    def border(x, y, t):
+        # the point at t, kept inside even when rounding of huge
+        # coordinates misses
+        x = min(max(int(round(x + t * dx)), 0), width - 1)
+        y = min(max(int(round(y + t * dy)), 0), height - 1)
+        return x, y
+    start, end = (x0, y0), (x1, y1)
+    if low > 0:
+        start = border(x0, y0, low)
+    if high < 1:
+        end = border(x0, y0, high)
+    return start + end
+
+def segmentCoords(segments, width=RASTER_WIDTH, height=RASTER_HEIGHT):
+    """
+    Returns the end points of segments, clipped to a raster of the given
+    size, as a flat array of ints, x0, y0, x1, y1 for each segment, for
+    drawing in another process (see PypadWorkers.py). Segments that aren't
+    two points or lie outside the raster are left out, like 
+    DrawingRaster.draw does
+    """
+    coords = array('i')
+    for segment in segments:
+        try:
+            start, end = segment[0], segment[1]
+            clipped = clipSegment(int(start[0]), int(start[1]),
+                                  int(end[0]), int(end[1]), width, height)
+        except (IndexError, TypeError, ValueError, OverflowError):
+            continue
+        if clipped != None:
+            coords.extend(clipped)
+    return coords
+
+class DrawingRaster:
+    """
+    The drawing as a bitmap, as of drawing sequence number seq. PypadData
+    keeps it up to date under its dataLock
+    """
+    def __init__(self, width=RASTER_WIDTH, height=RASTER_HEIGHT):
+        """
+        Constructor for DrawingRaster
+
+        Args:
+            width, height: int; size of the raster in pixels
+        """
+        self.width = width
+        self.height = height
+        self.stride = (width + 7) // 8
+        self.clear(0)
+
+    def clear(self, seq):
+        """Makes the raster white, as of drawing sequence number seq"""
+        self.pixels = bytearray('\xff' * (self.stride * self.height))
+        self.seq = seq
+        # (seq, image) of the last encoded PNG
+        self.encoded = None
+
+    def apply(self, seq, op):
+        """
+        Applies a drawing operation (see PypadEdit.py), which made drawing
+        sequence number seq
+        """
+        if op[0] != 'add':
+            self.clear(seq)
+        self.draw(op[1])
+        self.seq = seq
+
+    def rebuild(self, seq, drawing):
+        """Draws drawing, which is the drawing as of seq, from scratch"""
+        self.clear(seq)
+        self.draw(drawing)
+
+    def draw(self, segments):
+        """Draws segments, each a list starting with its two end points"""
+        for segment in segments:
+            try:
+                start, end = segment[0], segment[1]
+                self.line(start, end)
+            except (IndexError, TypeError, ValueError, OverflowError):
+                # clients send what their gui recorded; a segment that
+                # isn't two points has nothing to draw
+                pass
+
+    def line(self, start, end):
+        """
+        Draws the line from point start to point end (Bresenham), clipped
+        to the raster
+        """
+        clipped = clipSegment(int(start[0]), int(start[1]), int(end[0]),
+                              int(end[1]), self.width, self.height)
+        if clipped == None:
+            return
+        x, y, x1, y1 = clipped
+        dx, dy = abs(x1 - x), -abs(y1 - y)
+        sx = (x < x1) and 1 or -1
+        sy = (y < y1) and 1 or -1
+        error = dx + dy
+        pixels, stride = self.pixels, self.stride
+        width, height = self.width, self.height
+        while True:
+            if 0 <= x < width and 0 <= y < height:
+                pixels[y * stride + (x >> 3)] &= ~(0x80 >> (x & 7)) & 0xff
+            if x == x1 and y == y1:
+                return
+            double = 2 * error
+            if double >= dy:
+                error += dy
+                x += sx
+            if double <= dx:
+                error += dx
+                y += sy
+
+    def install(self, seq, pixels, image):
+        """
+        Replaces the raster by pixels and their PNG image, drawn elsewhere
+        (see PypadWorkers.py) as of seq. Callers hold the data lock
+        """
+        self.pixels = bytearray(pixels)
+        self.seq = seq
+        self.encoded = (seq, image)
+
+    def isInk(self, x, y):
+        """Returns True if the pixel at (x, y) is drawn on"""
+        return not self.pixels[y * self.stride + (x >> 3)] & (0x80 >> (x & 7))
+
+    def copy(self):
+        """Returns (seq, pixels) for encode. Callers hold the data lock"""
+        return self.seq, str(self.pixels)
+
+    def encode(self, seq, pixels):
+        """
+        Returns the PNG image of pixels, a copy of the raster as of seq.
+        Encoding doesn't need the data lock; the image is kept until the
+        next change.
+        """
+        encoded = self.encoded
+        if encoded != None and encoded[0] == seq:
+            return encoded[1]
+        image = encodePng(self.width, self.height, pixels)
+        self.encoded = (seq, image)
+        return image
@@ -0,0 +1,272 @@
+"""
+PypadRelay.py
+
+INTRODUCTION
+Contains the RelayTree class, which the origin PypadServer uses to arrange
+its relays in a tree of bounded degree, and the PypadRelay class, a replica
+(see PypadReplica.py) that takes its place in that tree.
+
+Without relays, the server notifies every client itself, so its work per
+edit grows with the number of clients. With relays, the origin only feeds
+the relays at the top of the tree, each relay feeds at most RELAY_FANOUT
+children (relays below it and read-only viewers), and so on down the tree.
+The origin's work per edit is bounded by RELAY_FANOUT plus its own editing
+clients, however many viewers there are; each level of the tree adds one hop
+of latency.
+
+Relays join by asking the origin for a parent (joinRelayTree): the
+shallowest node of the tree that has room, so the tree stays balanced.
+Viewers ask the origin for a relay (findRelay, see PypadClientCore) the same
+way. Relays renew their place every RELAY_RENEW_INTERVAL seconds, also
+reporting their viewers; a relay that doesn't renew for RELAY_LEASE seconds
+is taken out of the tree.
+
+RE-PARENTING
+When a relay can't reach its parent, it asks the origin for a new parent
+(reparentRelay), which takes the failed parent out of the tree and places the
+relay, with the subtree below it, under the shallowest node with room
+outside that subtree. The relay then catches up from its new parent. Viewers
+whose relay fails move to another relay the same way.
+
+Run 'python PypadRelay.py <origin name> <relay name>' to start a relay, and
+'python PypadClientCore.py <origin name> -relay' for a viewer.
+"""
+
+from PypadReplica import PypadReplica
+from RemoteObject import NameServer
+from time import sleep, time
+import Pyro.errors
+import threading
+import sys
+
+# children (relays and viewers) per node of the tree
+RELAY_FANOUT = 8
+
+# a relay that hasn't renewed its place for RELAY_LEASE seconds is taken out
+# of the tree. Relays renew every RELAY_RENEW_INTERVAL seconds
+RELAY_LEASE = 30
+RELAY_RENEW_INTERVAL = 10
+
+class RelayTree:
+    """
+    The relays of one origin server and who feeds whom. The origin is the
+    root; it only counts its relays against the fanout, not its editors.
+    """
+    def __init__(self, root, fanout=RELAY_FANOUT):
+        """
+        Constructor for RelayTree
+
+        Args:
+            root: string; name of the origin server
+            fanout: int; children per node
+        """
+        self.root = root
+        self.fanout = fanout
+        # the parent of each relay, by relay name
+        self.parents = {}
+        # the number of viewers each relay reported
+        self.viewers = {}
+        # the time each relay's place runs out
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def children(self, node):
+        """Returns the relays fed by node, sorted. Callers hold lock"""
+        children = [relay for relay, parent in self.parents.items()
+                    if parent == node]
+        children.sort()
+        return children
+
+    def load(self, node):
+        """Returns the number of children of node. Callers hold lock"""
+        return len(self.children(node)) + self.viewers.get(node, 0)
+
+    def subtree(self, relay):
+        """Returns relay and all relays below it. Callers hold lock"""
+        found = set([relay])
+        pending = [relay]
+        while pending:
+            for child in self.children(pending.pop()):
+                if child not in found:
+                    found.add(child)
+                    pending.append(child)
+        return found
+
+    def reap(self):
+        """
+        Takes the relays whose place ran out out of the tree. Callers hold
+        lock
+        """
+        now = time()
+        for relay in [relay for relay in self.leases
+                      if self.leases[relay] < now]:
+            print 'Relay %s stopped renewing' % relay
+            self.remove(relay)
+
+    def remove(self, relay):
+        """
+        Takes relay out of the tree. Its children keep pointing at it until
+        they re-parent. Callers hold lock
+        """
+        self.parents.pop(relay, None)
+        self.viewers.pop(relay, None)
+        self.leases.pop(relay, None)
+
+    def shallowest(self, excluded, viewer):
+        """
+        Returns the shallowest node with room for one more child, searching
+        breadth first from the root and skipping the excluded relays, or
+        None if the tree is full. The root only takes relays, not viewers.
+        Callers hold lock
+        """
+        level = [self.root]
+        while level:
+            for node in level:
+                if viewer and node == self.root:
+                    continue
+                if node not in excluded and self.load(node) < self.fanout:
+                    return node
+            nextLevel = []
+            for node in level:
+                nextLevel.extend([child for child in self.children(node)
+                                  if child not in excluded])
+            level = nextLevel
+        return None
+
+    def place(self, relay, failed=None):
+        """
+        Puts relay (and the relays below it) under the shallowest node with
+        room, outside its own subtree, and returns that node
+
+        Args:
+            relay: string; name of the relay
+            failed: string; a parent the relay could not reach, which is
+                taken out of the tree first
+        """
+        self.lock.acquire()
+        try:
+            self.reap()
+            if failed != None and failed != self.root:
+                print 'Relay %s lost its parent %s' % (relay, failed)
+                self.remove(failed)
+            self.parents.pop(relay, None)
+            parent = self.shallowest(self.subtree(relay), False)
+            if parent == None:
+                # everything is full; overload the root rather than refuse
+                parent = self.root
+            self.parents[relay] = parent
+            self.viewers.setdefault(relay, 0)
+            self.leases[relay] = time() + RELAY_LEASE
+            return parent
+        finally:
+            self.lock.release()
+
+    def renew(self, relay, parent, viewers):
+        """
+        Extends the place of relay, recording the parent it actually follows
+        and the number of viewers it serves. A relay taken out of the tree
+        (for example after a network blip) is put back.
+        """
+        self.lock.acquire()
+        try:
+            self.parents[relay] = parent
+            self.viewers[relay] = viewers
+            self.leases[relay] = time() + RELAY_LEASE
+        finally:
+            self.lock.release()
+
+    def findViewerRelay(self, failed=None):
+        """
+        Returns the relay a new viewer should use, or the root if there
+        are no relays
+
+        Args:
+            failed: string; a relay the viewer could not reach
+        """
+        self.lock.acquire()
+        try:
+            self.reap()
+            if failed != None and failed != self.root:
+                self.remove(failed)
+            if not self.parents:
+                return self.root
+            relay = self.shallowest(set(), True)
+            if relay == None:
+                # everything is full; use the least loaded relay
+                relays = self.parents.keys()
+                relays.sort(key = self.load)
+                relay = relays[0]
+            # counted now, so that viewers joining at once spread out; the
+            # relay reports the real number when it renews
+            self.viewers[relay] = self.viewers.get(relay, 0) + 1
+            return relay
+        finally:
+            self.lock.release()
+
+class PypadRelay(PypadReplica):
+    """
+    A replica that gets its parent from the origin's RelayTree and finds a
+    new one when its parent fails, see above
+    """
+    def __init__(self, name, originName):
+        """
+        Constructor for PypadRelay. Joins the origin's relay tree and starts
+        following the parent the origin picked.
+
+        Args:
+            name: string; the name viewers connect to
+            originName: string; name of the origin server
+        """
+        self.originName = originName
+        self.origin = NameServer().get_proxy(originName)
+        parent = self.origin.joinRelayTree(name)
+        print 'Following', parent
+        PypadReplica.__init__(self, name, parent)
+        renewer = threading.Thread(target = self.renewLoop,
+                                   name = 'RelayRenewer')
+        renewer.setDaemon(True)
+        renewer.start()
+
+    def viewerCount(self):
+        """Returns the number of clients that are viewers, not relays"""
+        self.clientLock.acquire()
+        try:
+            return len([clientName for clientName in self.clients
+                        if 'ops' not in self.subscriptions.get(clientName,
+                                                               ())])
+        finally:
+            self.clientLock.release()
+
+    def renewLoop(self):
+        """Renews the relay's place in the tree every RELAY_RENEW_INTERVAL"""
+        while True:
+            sleep(RELAY_RENEW_INTERVAL)
+            try:
+                self.origin.renewRelay(self.name, self.primaryName,
+                                       self.viewerCount())
+            except Pyro.errors.PyroError, e:
+                print 'Could not reach the origin:', e
+
+    def primaryUnreachable(self):
+        """Asks the origin for a new parent and follows it"""
+        failed = self.primaryName
+        while True:
+            try:
+                parent = self.origin.reparentRelay(self.name, failed)
+                print 'Parent %s failed, following %s' % (failed, parent)
+                self.follow(parent)
+                return
+            except (Pyro.errors.PyroError, SystemExit), e:
+                # the new parent failed too, or the origin can't be reached
+                print 'Could not follow a new parent:', e
+                failed = self.primaryName
+                sleep(RELAY_RENEW_INTERVAL)
+
+def main(script, originName='Pypad_dot_com', name='Pypad_relay', *args):
+    print "*** Pypad Relay ***"
+    relay = PypadRelay(name, originName)
+    relay.VERBOSE = '-v' in args
+    relay.requestLoop()
+
+if __name__ == '__main__':
+    main(*sys.argv)
@@ -0,0 +1,344 @@
+"""
+PypadReplica.py
+
+INTRODUCTION
+Contains the PypadReplica class, a read-only copy of a PypadServer (the
+primary) that serves reads and notifications to read-only clients, such as
+the audience of a presentation, so that they don't compete with the editors
+for the primary.
+
+A replica follows the primary's ordered stream of changes: its ReplicaFeed
+registers with the primary as a client subscribed to the 'ops' channel (see
+CHANNELS in PypadServer.py), and every change record the primary publishes
+(see PypadData.publish) is queued in the replica's inbox. An applier thread
+applies the records in order to the replica's own PypadData, which keeps the
+replica's history, search and blame indexes up to date, and notifies the
+replica's clients like the primary would. Because a replica is a PypadServer,
+read-only clients use it exactly like the primary: PypadClientCore with the
+replica's name.
+
+When records are missing (when the replica starts, after its outbox at the
+primary overflowed, or after the primary dropped it) the replica catches up
+with getTextOps and getDrawingOps before applying more. Writes to a replica
+raise ValueError.
+
+Replicas publish the records they apply in turn, so a replica can follow
+another replica; PypadRelay.py builds a fan-out tree of them.
+
+LAG
+getReplicationLag returns how far the replica is behind: the revisions the
+primary has that the replica doesn't, and the seconds between the primary
+publishing the last applied change and the replica applying it. When no
+changes come in, the replica asks the primary for its revision every
+LAG_POLL_INTERVAL seconds, so that a stalled stream shows up as lag.
+
+RUNNING ON ONE MACHINE
+Start the Pyro name server (pyro-ns), then, with PYPAD_NS_HOST=localhost set
+(see RemoteObject.py):
+
+    python PypadServer.py
+    python PypadReplica.py Pypad_dot_com Pypad_replica
+    python PypadClient.py                       # an editor, on the primary
+    python PypadClientCore.py Pypad_replica     # a reader, on the replica
+"""
+
+from PypadServer import PypadServer, OPS_BATCH
+from PypadClientCore import PypadClientCore, CHUNK_SIZE
+from RemoteObject import NameServer
+from Queue import Queue, Empty
+from time import sleep, time
+import Pyro.errors
+import threading
+import sys
+
+# seconds without changes after which the applier asks the primary for its
+# revision
+LAG_POLL_INTERVAL = 5
+
+class ReplicaFeed(PypadClientCore):
+    """
+    The replica's connection to its primary: a client subscribed to the
+    'ops' channel, which passes the change records on to the replica
+    """
+    def __init__(self, primaryName, replica):
+        """
+        Constructor for ReplicaFeed. Registers with the primary.
+
+        Args:
+            primaryName: string; name of the server to follow
+            replica: the PypadReplica the records are for
+        """
+        self.replica = replica
+        PypadClientCore.__init__(self, primaryName, ['ops'])
+
+    def notify(self, type, traceId=None, value=None):
+        """
+        Invoked remotely by the primary, see PypadClientCore.notify. Change
+        records are only queued, so the primary's outbox never waits for
+        them to be applied.
+        """
+        if type == 'ops':
+            record, published = value
+            self.replica.receive(record, published)
+        elif type == 'resyncNeeded':
+            # records were dropped at the primary
+            self.replica.receive(None, None)
+        elif type == 'dropped':
+            threading.Thread(target = self.reconnect).start()
+
+    def serverUnreachable(self):
+        """
+        Called when renewing with the primary failed; the replica's applier
+        finds out for itself by catching up
+        """
+        self.replica.receive(None, None)
+
+    def reconnect(self):
+        """
+        Registers with the primary again after it dropped the feed, and has
+        the replica catch up on the records it missed meanwhile
+        """
+        self.reconnecting = True
+        try:
+            self.server = NameServer().get_proxy(self.serverName)
+            # the replica catches up with getTextOps, so no edit script
+            self.server.reconnect(self.clientName, None,
+                                  self.replica.drawingSeq, self.channels)
+        finally:
+            self.reconnecting = False
+        self.replica.receive(None, None)
+
+class PypadReplica(PypadServer):
+    """
+    A read-only PypadServer that follows a primary, see above
+    """
+    def __init__(self, name, primaryName):
+        """
+        Constructor for PypadReplica. Registers with the name server under
+        name and with the primary, and starts catching up.
+
+        Args:
+            name: string; the name clients connect to
+            primaryName: string; name of the server to follow
+        """
+        PypadServer.__init__(self, name, '')
+        self.primaryName = primaryName
+        self.VERBOSE = False
+
+        # (record, published) pairs waiting to be applied. (None, None)
+        # asks the applier to catch up
+        self.inbox = Queue()
+        # False until revision 1 was copied from the primary
+        self.bootstrapped = False
+        # the newest revision the primary is known to have
+        self.primaryRev = None
+        # seconds from the primary publishing the last applied change to the
+        # replica applying it
+        self.lagSeconds = None
+
+        self.feed = None
+        self.follow(primaryName)
+        applier = threading.Thread(target = self.applyLoop,
+                                   name = 'ReplicaApplier')
+        applier.setDaemon(True)
+        applier.start()
+
+    def follow(self, primaryName):
+        """
+        Follows primaryName from now on, catching up from it first. The 
+        feed from the previous primary is closed.
+        """
+        old = self.feed
+        self.primaryName = primaryName
+        self.feed = ReplicaFeed(primaryName, self)
+        self.feed.start()
+        self.receive(None, None)
+        if old != None:
+            old.stop()
+
+    # Writes are for the primary
+    def setState(self, sendingClient, newText=[], newDrawing =[],
+                 type = 'text', traceId=None, baseRev=None, epoch=None):
+        """Raises ValueError: replicas are read only"""
+        raise ValueError('%s is a read only replica of %s' %
+                         (self.name, self.primaryName))
+
+    def beginImport(self, sendingClient):
+        """Raises ValueError: replicas are read only"""
+        raise ValueError('%s is a read only replica of %s' %
+                         (self.name, self.primaryName))
+
+    # Following the primary
+    def receive(self, record, published):
+        """
+        Queues a change record published by the primary at time published.
+        receive(None, None) makes the replica catch up.
+        """
+        self.inbox.put((record, published))
+
+    def applyLoop(self):
+        """Applies the records in the inbox, in order"""
+        while True:
+            try:
+                record, published = self.inbox.get(True, LAG_POLL_INTERVAL)
+            except Empty:
+                self.pollPrimary()
+                continue
+            try:
+                if record == None:
+                    self.catchUp()
+                else:
+                    self.apply(record)
+                    self.lagSeconds = time() - published
+            except (Pyro.errors.PyroError, SystemExit), e:
+                # SystemExit is how NameServer.get_proxy reports a primary
+                # that is gone from the name server
+                print 'Could not reach the primary, catching up later:', e
+                self.primaryUnreachable()
+                sleep(LAG_POLL_INTERVAL)
+                self.receive(None, None)
+
+    def primaryUnreachable(self):
+        """
+        Called when the primary could not be reached. A replica simply 
+        tries again later; relays (see PypadRelay.py) find a new parent
+        """
+        pass
+
+    def pollPrimary(self):
+        """Refreshes primaryRev while no changes come in"""
+        try:
+            self.primaryRev = self.feed.call('getRevNum')
+        except (Pyro.errors.PyroError, SystemExit):
+            self.primaryUnreachable()
+            return
+        if self.VERBOSE:
+            print 'Replication lag:', self.getReplicationLag()
+
+    def apply(self, record):
+        """
+        Applies one record from the primary, catching up first if records 
+        before it are missing
+        """
+        type, number = record[:2]
+        if type == 'text':
+            self.primaryRev = max(number, self.primaryRev)
+            if not self.bootstrapped or number > len(self.history) + 1:
+                self.catchUpText()
+            if number == len(self.history) + 1:
+                self.replayRecord(record)
+                self.notifyClients(None, 'text', None, number)
+        elif type == 'drawing':
+            if number > self.drawingSeq + 1:
+                self.catchUpDrawing()
+            if number == self.drawingSeq + 1:
+                self.replayRecord(record)
+                self.notifyClients(None, 'drawing', None, number)
+
+    def getTextOps(self, sinceRev, limit=OPS_BATCH):
+        """
+        See PypadData.getTextOps. A replica that has not copied revision 1
+        yet has nothing to give to the replicas following it.
+        """
+        if not self.bootstrapped:
+            return []
+        return PypadServer.getTextOps(self, sinceRev, limit)
+
+    def catchUp(self):
+        """Fetches everything the replica is missing from the primary"""
+        self.catchUpText()
+        self.catchUpDrawing()
+
+    def catchUpText(self):
+        """Fetches the missing revisions, OPS_BATCH at a time"""
+        rev = len(self.history)
+        while True:
+            since = len(self.history)
+            if not self.bootstrapped:
+                since = 0
+            records = self.feed.call('getTextOps', since)
+            if not records:
+                break
+            for record in records:
+                self.applyTextOp(record)
+        self.primaryRev = max(len(self.history), self.primaryRev)
+        if len(self.history) != rev or since == 0:
+            self.notifyClients(None, 'text', None, len(self.history))
+
+    def applyTextOp(self, record):
+        """Applies one record returned by getTextOps"""
+        type, number, edit, author, when = record
+        if number == 1:
+            self.resetText(self.fetchFirstRevision(), when, author)
+            self.bootstrapped = True
+            return
+        self.dataLock.acquire()
+        try:
+            # revisions thinned at the primary keep their numbers here
+            while len(self.history) < number - 1:
+                self.appendRevision((0, 0, ''), None, when)
+            self.replayRecord(record)
+        finally:
+            self.dataLock.release()
+
+    def fetchFirstRevision(self):
+        """Returns the text of the primary's revision 1, read in chunks"""
+        length = self.feed.call('getTextLength', 1)
+        chunks = []
+        offset = 0
+        while offset < length:
+            chunk = self.feed.call('getTextRange', offset, CHUNK_SIZE, 1)
+            if chunk == '':
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+        return ''.join(chunks)
+
+    def catchUpDrawing(self):
+        """Fetches the missing drawing operations, or the whole drawing"""
+        seq, ops = self.feed.call('getDrawingOps', self.drawingSeq)
+        if ops == None:
+            seq, drawing = self.feed.call('getDrawingState')
+            self.dataLock.acquire()
+            try:
+                self.drawing = drawing
+                self.drawingSeq = seq
+                self.drawingLog = []
+            finally:
+                self.dataLock.release()
+        else:
+            for op in ops:
+                self.replayRecord(('drawing', self.drawingSeq + 1, op))
+        self.notifyClients(None, 'drawing', None, self.drawingSeq)
+
+    def getReplicationLag(self):
+        """
+        Returns how far the replica is behind its primary, as a dictionary
+        with
+            'rev': the replica's revision
+            'primaryRev': the newest revision the primary is known to have
+            'revisions': the number of revisions the replica is missing
+            'seconds': seconds from the primary publishing the last applied
+                change to the replica applying it, None before the first
+            'queued': records received but not applied yet
+        """
+        rev = len(self.history)
+        primaryRev = max(rev, self.primaryRev)
+        return {'rev': rev, 'primaryRev': primaryRev,
+                'revisions': primaryRev - rev, 'seconds': self.lagSeconds,
+                'queued': self.inbox.qsize()}
+
+    def cleanup(self):
+        """Stops following the primary, then shuts down like a server"""
+        self.feed.stop()
+        PypadServer.cleanup(self)
+
+def main(script, primaryName='Pypad_dot_com', name='Pypad_replica', *args):
+    print "*** Pypad Replica ***"
+    replica = PypadReplica(name, primaryName)
+    # prints the replication lag while the primary is idle
+    replica.VERBOSE = '-v' in args
+    replica.requestLoop()
+
+if __name__ == '__main__':
+    main(*sys.argv)
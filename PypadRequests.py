@@ -0,0 +1,267 @@
+"""
+PypadRequests.py
+
+INTRODUCTION
+Contains the RequestEngine class, which serves the remote calls of a
+PypadServer with a bounded pool of handler threads and limits how many calls
+of each method run at once.
+
+By default Pyro gives every client connection a thread of its own, which then
+runs whatever that client asks for. A few clients scanning the history
+(getHistory, searchHistory, getBlame) can then keep the CPU busy while the
+editors' setState calls queue up behind them, and nothing bounds the number
+of threads.
+
+With the engine, the server's Pyro daemon runs without threads of its own
+(see RemoteObject.multithreaded): the request loop waits in select for all
+client connections at once, together with the server's Wakeup pipe (see
+RemoteObject.py), and hands each connection with a request waiting to a
+handler thread. While a handler has the connection, it is taken out of the
+select; the handler gives it back through the Wakeup pipe when the reply is
+sent, so the loop never waits for a timeout.
+
+At most HANDLER_POOL_SIZE calls run at once. On top of that, METHOD_LIMITS
+bounds the calls of single methods (see gate): a call over its method's
+limit waits without taking a slot of the pool, so heavy reads queue behind
+each other and setState always finds a slot. A call that waits like that
+(see outside) still keeps its handler thread, so there are more threads
+than slots, but never more than MAX_HANDLERS: connections that find every
+handler busy wait in a queue, in order, until one is free. The queue holds
+at most one request per connection, since a connection is out of the
+select until its request is answered.
+
+Pyro's non-threaded daemon keeps one call context (the caller's connection
+and the thread local storage of Pyro.protocol.LocalStorage) for all calls.
+Every handler thread gets a context of its own instead, which the daemon's
+getLocalStorage returns to the calls it runs, so concurrent calls don't
+see each other's caller.
+
+This relies on the non-threaded connection handling of Pyro 3's TCPServer:
+its connections list, handleInvocation, which reads one request from a
+connection and sends the reply, and getLocalStorage.
+"""
+
+import Pyro.core
+import Pyro.errors
+import Pyro.protocol
+import threading
+from Queue import Queue
+
+# calls that run at once. Calls waiting at a method limit don't count
+HANDLER_POOL_SIZE = 8
+
+# handler threads at most: the calls running and those waiting outside the
+# pool (see RequestEngine.outside). Further requests wait in the queue
+MAX_HANDLERS = 4 * HANDLER_POOL_SIZE
+
+# most calls of a method that run at once, for methods that scan the history
+# or copy large data. Methods not listed are only bounded by the pool
+METHOD_LIMITS = {'getHistory': 2,
+                 'getDiff': 2,
+                 'searchHistory': 2,
+                 'getBlame': 2,
+                 'getTextOps': 2,
+                 'getDrawingState': 2,
+                 'getDrawingSnapshot': 2,
+                 'importChunk': 1}
+
+class RequestEngine:
+    """
+    Serves the requests of one RemoteObject with a pool of handler threads,
+    see above
+    """
+    def __init__(self, poolSize=HANDLER_POOL_SIZE, limits=METHOD_LIMITS,
+                 maxHandlers=MAX_HANDLERS):
+        """
+        Constructor for RequestEngine
+
+        Args:
+            poolSize: int; calls that run at once
+            limits: dictionary; the most calls of a method that run at
+                once, by method name
+            maxHandlers: int; handler threads at most, at least poolSize
+        """
+        self.poolSize = poolSize
+        self.maxHandlers = max(maxHandlers, poolSize)
+        self.remote = None
+        # a handler takes a slot for the call it runs, see gate
+        self.slots = threading.Semaphore(poolSize)
+        self.gates = {}
+        for method, limit in limits.items():
+            self.gates[method] = threading.Semaphore(limit)
+        # connections waiting for a handler
+        self.tasks = Queue()
+        # marks the handler threads, which hold a slot while they run a call
+        self.local = threading.local()
+        self.statsLock = threading.Lock()
+        self.handlers = 0
+        self.idle = 0
+        # connections queued while every handler was busy and the number of
+        # handlers was at its maximum; the next handler done takes them
+        self.backlog = 0
+        self.running = {}
+        self.waiting = {}
+        self.served = 0
+
+    def attach(self, remote):
+        """
+        Takes over the handling of remote's connections. remote's daemon
+        must be non-threaded (see RemoteObject.multithreaded)
+        """
+        self.remote = remote
+        # the daemon calls handleInvocation for every connection select
+        # found readable; the engine hands it to a handler instead
+        remote.demon.handleInvocation = self.dispatch
+        # and the calls find their caller in their handler's context
+        remote.demon.getLocalStorage = self.getLocalStorage
+
+    def getLocalStorage(self):
+        """
+        Returns the call context of the calling handler thread, or the
+        daemon's own one outside the handlers. Replaces the daemon's
+        getLocalStorage
+        """
+        return getattr(threading.currentThread(), 'localStorage',
+                       self.remote.demon.localStorage)
+
+    def dispatch(self, conn):
+        """
+        Hands a connection with a request waiting to a handler, starting
+        one if none is idle and there are fewer than maxHandlers, or else
+        queues it. Runs in the request loop, and never waits
+        """
+        self.remote.demon.connections.remove(conn)
+        self.statsLock.acquire()
+        try:
+            startHandler = False
+            if self.idle > 0:
+                self.idle -= 1
+            elif self.handlers < self.maxHandlers:
+                startHandler = True
+                self.handlers += 1
+            else:
+                self.backlog += 1
+        finally:
+            self.statsLock.release()
+        if startHandler:
+            handler = threading.Thread(target = self.handlerLoop,
+                                       name = 'RequestHandler')
+            handler.setDaemon(True)
+            handler.start()
+        self.tasks.put(conn)
+
+    def handlerLoop(self):
+        """
+        Handles the connections dispatch hands over, one at a time, each
+        with a slot of the pool
+        """
+        thread = threading.currentThread()
+        thread.localStorage = Pyro.protocol.LocalStorage()
+        self.remote.demon.initTLS(thread.localStorage)
+        while True:
+            conn = self.tasks.get()
+            self.slots.acquire()
+            self.local.holdsSlot = True
+            try:
+                self.handle(conn)
+            finally:
+                self.local.holdsSlot = False
+                self.slots.release()
+                self.statsLock.acquire()
+                try:
+                    if self.backlog > 0:
+                        # a queued connection is this handler's next task
+                        self.backlog -= 1
+                    else:
+                        self.idle += 1
+                    self.served += 1
+                finally:
+                    self.statsLock.release()
+
+    def handle(self, conn):
+        """
+        Reads one request from conn, runs it and replies, then gives the
+        connection back to the request loop
+        """
+        demon = self.remote.demon
+        try:
+            Pyro.core.Daemon.handleInvocation(demon, conn)
+        except Pyro.errors.ConnectionClosedError:
+            # the client went away
+            conn.close()
+            return
+        except Exception, e:
+            print 'Error while handling a request:', e
+            conn.close()
+            return
+        if conn.connected:
+            self.remote.wakeup.call(demon.connections.append, conn)
+        else:
+            conn.close()
+
+    def gate(self, method, function, *args):
+        """
+        Returns function(*args), a call of method, once fewer than its
+        limit of calls of method are running. Used by
+        Server.Pyro_dyncall for every remote call
+        """
+        gate = self.gates.get(method)
+        if gate == None:
+            return function(*args)
+        if not gate.acquire(False):
+            self.count(self.waiting, method, 1)
+            try:
+                # waiting doesn't take a handler from the other methods
+                self.outside(gate.acquire)
+            finally:
+                self.count(self.waiting, method, -1)
+        self.count(self.running, method, 1)
+        try:
+            return function(*args)
+        finally:
+            self.count(self.running, method, -1)
+            gate.release()
+
+    def outside(self, function, *args):
+        """
+        Returns function(*args), called without holding a handler slot, so
+        that a call that waits (see gate and PypadAdmission.py) doesn't
+        keep other calls from running
+        """
+        holdsSlot = getattr(self.local, 'holdsSlot', False)
+        if holdsSlot:
+            self.slots.release()
+        try:
+            return function(*args)
+        finally:
+            if holdsSlot:
+                self.slots.acquire()
+
+    def count(self, counts, method, change):
+        """Adds change to the count of method in counts"""
+        self.statsLock.acquire()
+        try:
+            counts[method] = counts.get(method, 0) + change
+        finally:
+            self.statsLock.release()
+
+    def stats(self):
+        """
+        Returns a dictionary with
+            'handlers': handler threads started
+            'idle': handlers waiting for a connection
+            'queued': connections waiting for a handler
+            'served': requests handled so far
+            'running': calls running, by limited method
+            'waiting': calls waiting at their method's limit, by method
+        """
+        self.statsLock.acquire()
+        try:
+            return {'handlers': self.handlers, 'idle': self.idle,
+                    'queued': self.backlog, 'served': self.served,
+                    'running': dict([(method, count) for method, count
+                                     in self.running.items() if count]),
+                    'waiting': dict([(method, count) for method, count
+                                     in self.waiting.items() if count])}
+        finally:
+            self.statsLock.release()
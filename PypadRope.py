@@ -0,0 +1,215 @@
+"""
+PypadRope.py
+
+INTRODUCTION
+Contains the Rope class, the text model behind PypadData.
+
+A rope stores a document as a balanced binary tree whose leaves hold short
+pieces of the text. Inserting or deleting at any offset only rebuilds the
+O(log n) nodes on the path to that offset, instead of the whole string.
+
+Ropes are immutable: every edit returns a new Rope that shares all untouched
+nodes with the old one. That makes a snapshot of a revision free (keep a
+reference to the old Rope), which is how PypadData stores its history.
+
+The tree is kept balanced like an AVL tree: the heights of the two children of
+a node never differ by more than one.
+
+Every node also counts the newlines below it, so the line of any offset is
+found in O(log n) (see lineOf).
+
+Leaves can hold any sliceable sequence, not just strings (for example tuples),
+as long as all leaves of one rope hold the same type.
+"""
+
+from itertools import chain
+
+# leaves longer than this are never created by joining two smaller leaves
+LEAF_SIZE = 512
+
+class RopeLeaf(object):
+    """A leaf of a rope, holding a piece of the text"""
+    __slots__ = ['data', 'length', 'height', 'newlines']
+
+    def __init__(self, data):
+        self.data = data
+        self.length = len(data)
+        self.height = 0
+        self.newlines = data.count('\n')
+
+class RopeNode(object):
+    """An inner node of a rope. Its text is the text of left then right"""
+    __slots__ = ['left', 'right', 'length', 'height', 'newlines']
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.length = left.length + right.length
+        self.height = max(left.height, right.height) + 1
+        self.newlines = left.newlines + right.newlines
+
+def _balance(left, right):
+    """
+    Returns a node with the text of left then right, rotating so that the
+    heights of the children differ by at most one. left and right must be
+    balanced and their heights can differ by at most two.
+    """
+    if left.height > right.height + 1:
+        if left.left.height >= left.right.height:
+            return RopeNode(left.left, RopeNode(left.right, right))
+        middle = left.right
+        return RopeNode(RopeNode(left.left, middle.left),
+                        RopeNode(middle.right, right))
+    if right.height > left.height + 1:
+        if right.right.height >= right.left.height:
+            return RopeNode(RopeNode(left, right.left), right.right)
+        middle = right.left
+        return RopeNode(RopeNode(left, middle.left),
+                        RopeNode(middle.right, right.right))
+    return RopeNode(left, right)
+
+def _join(left, right):
+    """Returns a balanced tree with the text of left then right"""
+    if left.length == 0:
+        return right
+    if right.length == 0:
+        return left
+    if left.height > right.height + 1:
+        return _balance(left.left, _join(left.right, right))
+    if right.height > left.height + 1:
+        return _balance(_join(left, right.left), right.right)
+    if left.height == 0 and right.height == 0 \
+    and left.length + right.length <= LEAF_SIZE:
+        return RopeLeaf(left.data + right.data)
+    return RopeNode(left, right)
+
+def _split(tree, offset):
+    """Returns two balanced trees: the text before offset and after it"""
+    if tree.height == 0:
+        return RopeLeaf(tree.data[:offset]), RopeLeaf(tree.data[offset:])
+    leftLength = tree.left.length
+    if offset < leftLength:
+        before, after = _split(tree.left, offset)
+        return before, _join(after, tree.right)
+    elif offset > leftLength:
+        before, after = _split(tree.right, offset - leftLength)
+        return _join(tree.left, before), after
+    else:
+        return tree.left, tree.right
+
+def _build(data, start, end):
+    """Returns a balanced tree holding data[start:end]"""
+    if end - start <= LEAF_SIZE:
+        return RopeLeaf(data[start:end])
+    middle = (start + end) // 2
+    return RopeNode(_build(data, start, middle), _build(data, middle, end))
+
+def _pieces(tree, start, end):
+    """Yields the leaf pieces holding the text in [start, end) of tree"""
+    stack = [(tree, 0)]
+    while stack:
+        node, offset = stack.pop()
+        if offset >= end or offset + node.length <= start:
+            continue
+        if node.height == 0:
+            yield node.data[max(start - offset, 0) : end - offset]
+        else:
+            # right is pushed first so that left is visited first
+            stack.append((node.right, offset + node.left.length))
+            stack.append((node.left, offset))
+
+class Rope(object):
+    """
+    An immutable sequence (usually text) with O(log n) insert, delete and
+    replace at any offset, and O(log n + k) reads of k items.
+    """
+    __slots__ = ['root', 'empty']
+
+    def __init__(self, data='', root=None):
+        """
+        Constructor for Rope
+
+        Args:
+            data: the initial text (or other sequence)
+            root: internal; the tree of an existing rope to wrap
+        """
+        self.empty = data[:0]
+        if root == None:
+            root = _build(data, 0, len(data))
+        self.root = root
+
+    def __len__(self):
+        return self.root.length
+
+    def _wrap(self, root):
+        """Returns a new Rope of the same type for the given tree"""
+        return Rope(self.empty, root)
+
+    def _concat(self, pieces):
+        """Joins pieces of the rope's sequence type into one sequence"""
+        if isinstance(self.empty, tuple):
+            return tuple(chain(*pieces))
+        return self.empty.join(pieces)
+
+    def replace(self, offset, length, data):
+        """
+        Returns a new rope where the length items starting at offset are
+        replaced by data. Insertion and deletion are the special cases
+        length = 0 and data = empty.
+        """
+        if offset < 0 or length < 0 or offset + length > self.root.length:
+            raise IndexError('edit (%d, %d) outside rope of length %d' %
+                             (offset, length, self.root.length))
+        before, rest = _split(self.root, offset)
+        removed, after = _split(rest, length)
+        if len(data) > 0:
+            before = _join(before, _build(data, 0, len(data)))
+        return self._wrap(_join(before, after))
+
+    def insert(self, offset, data):
+        """Returns a new rope with data inserted at offset"""
+        return self.replace(offset, 0, data)
+
+    def delete(self, offset, length):
+        """Returns a new rope with length items removed at offset"""
+        return self.replace(offset, length, self.empty)
+
+    def slice(self, start, end=None):
+        """Returns the text between start and end, like data[start:end]"""
+        length = self.root.length
+        if end == None or end > length:
+            end = length
+        start = max(start, 0)
+        if start >= end:
+            return self.empty
+        return self._concat(list(_pieces(self.root, start, end)))
+
+    def chunks(self, start=0, end=None):
+        """Yields the text between start and end as a series of leaf pieces"""
+        if end == None or end > self.root.length:
+            end = self.root.length
+        return _pieces(self.root, max(start, 0), end)
+
+    def lineOf(self, offset):
+        """
+        Returns the number of newlines before offset, which is the line
+        (counted from 0) that offset is on
+        """
+        node = self.root
+        lines = 0
+        while node.height > 0:
+            if offset < node.left.length:
+                node = node.left
+            else:
+                offset -= node.left.length
+                lines += node.left.newlines
+                node = node.right
+        return lines + node.data[:offset].count('\n')
+
+    def lineCount(self):
+        """Returns the number of lines, which is one more than newlines"""
+        return self.root.newlines + 1
+
+    def flatten(self):
+        """Returns the whole text as one string (or sequence)"""
+        return self.slice(0)
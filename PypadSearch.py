@@ -0,0 +1,164 @@
+"""
+PypadSearch.py
+
+INTRODUCTION
+Contains the SearchIndex class, which finds the revisions of a document that
+contain a string without reading every revision.
+
+For every revision, the index records the n-grams (substrings of up to
+GRAM_SIZE characters) that its edit created or destroyed: those overlapping
+the removed or inserted text, or spanning the point of the edit. An
+occurrence of the query can only appear or disappear in a revision that
+touched one of the query's n-grams, so only those candidate revisions are
+looked at. For each candidate the number of occurrences is updated from the
+text around the edit, which costs about as much as the edit and the query
+are long, not the document.
+
+Keeping the index up to date costs O(edit length) per revision.
+"""
+
+import threading
+from array import array
+
+# longest n-grams that are indexed. Queries shorter than this are looked up
+# by n-grams of their own length
+GRAM_SIZE = 3
+
+# rough memory cost of one n-gram in the index (its key and array), in bytes.
+# Every revision in an array costs 4 bytes more
+GRAM_BYTES = 120
+
+def countOccurrences(text, query):
+    """Returns the number of (possibly overlapping) occurrences of query"""
+    count = 0
+    position = text.find(query)
+    while position != -1:
+        count += 1
+        position = text.find(query, position + 1)
+    return count
+
+def touchedGrams(rope, offset, length):
+    """
+    Returns the set of n-grams of rope that overlap the length characters
+    at offset, or span offset when length is 0
+    """
+    text = rope.slice(offset - GRAM_SIZE + 1, offset + length + GRAM_SIZE - 1)
+    start = offset - max(offset - GRAM_SIZE + 1, 0)
+    grams = set()
+    for n in range(1, GRAM_SIZE + 1):
+        # grams starting before start - n + 1 end before the edit
+        for i in range(max(start - n + 1, 0),
+                       min(start + max(length, 1), len(text) - n + 1)):
+            grams.add(text[i : i + n])
+    return grams
+
+class SearchIndex:
+    """
+    An index of which revisions touched which n-grams, see above.
+    Revisions are added in order by PypadData.
+    """
+    def __init__(self):
+        """Constructor for SearchIndex"""
+        # postings[gram] is the ascending array of revisions that created or
+        # destroyed an occurrence of gram
+        self.postings = {}
+        # the number of revisions in all arrays, for memoryBytes
+        self.entries = 0
+        self.lock = threading.Lock()
+
+    def add(self, rev, before, after, edit):
+        """
+        Indexes one revision
+
+        Args:
+            rev: int; the revision number
+            before: Rope; the text of revision rev-1
+            after: Rope; the text of revision rev
+            edit: the edit (offset, length, text) between them
+        """
+        offset, length, text = edit
+        grams = touchedGrams(before, offset, length)
+        grams.update(touchedGrams(after, offset, len(text)))
+        self.lock.acquire()
+        try:
+            for gram in grams:
+                revs = self.postings.get(gram)
+                if revs == None:
+                    revs = self.postings[gram] = array('i')
+                if not revs or revs[-1] != rev:
+                    revs.append(rev)
+                    self.entries += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """Empties the index"""
+        self.lock.acquire()
+        try:
+            self.postings = {}
+            self.entries = 0
+        finally:
+            self.lock.release()
+
+    def rebuild(self, store):
+        """
+        Indexes all revisions of store (a RevisionStore, see
+        PypadHistory.py), after the history was loaded from a checkpoint
+        """
+        self.clear()
+        for rev, before, edit, after, author in \
+        store.walk(range(2, len(store) + 1)):
+            self.add(rev, before, after, edit)
+
+    def memoryBytes(self):
+        """Estimates the memory used by the index, in O(1)"""
+        return GRAM_BYTES * len(self.postings) + 4 * self.entries
+
+    def candidates(self, query):
+        """Returns the revisions that may have changed the matches of query"""
+        n = min(len(query), GRAM_SIZE)
+        revs = set()
+        self.lock.acquire()
+        try:
+            for i in range(len(query) - n + 1):
+                revs.update(self.postings.get(query[i : i + n], ()))
+        finally:
+            self.lock.release()
+        return revs
+
+    def search(self, query, store):
+        """
+        Returns the list of revision ranges (first, last) whose text
+        contains query, in ascending order
+
+        Args:
+            query: non-empty string
+            store: the RevisionStore holding the revisions
+        """
+        if len(query) == 0:
+            raise ValueError('empty query')
+        last = len(store)
+        revs = [rev for rev in self.candidates(query) if 1 < rev <= last]
+        count = countOccurrences(store.rope(1).flatten(), query)
+        ranges = []
+        first = None
+        if count > 0:
+            first = 1
+        context = len(query) - 1
+        for rev, before, edit, after, author in store.walk(revs):
+            offset, length, text = edit
+            # occurrences that don't overlap the edit are in both windows
+            count -= countOccurrences(
+                before.slice(offset - context, offset + length + context),
+                query)
+            count += countOccurrences(
+                after.slice(offset - context, offset + len(text) + context),
+                query)
+            if count > 0 and first == None:
+                first = rev
+            elif count == 0 and first != None:
+                ranges.append((first, rev - 1))
+                first = None
+        if first != None:
+            ranges.append((first, last))
+        return ranges
@@ -91,11 +91,76 @@ Added basic structure of PypadData class
 
 
 from RemoteObject import *
+from PypadTrace import tracer
+from PypadRope import Rope
+from PypadEdit import diffText, composeRange
+from PypadCheckpoint import Checkpointer
+from PypadHistory import RevisionStore, THINNING
+from PypadOutbox import Outbox, STUCK_DEADLINE, valueCost
+from PypadSearch import SearchIndex
+from PypadBlame import BlameIndex
+from PypadArchive import importArchive
+from PypadRaster import DrawingRaster
+from PypadRequests import RequestEngine
+from PypadAdmission import AdmissionControl
+from PypadCrdt import RgaDocument
+from PypadWorkers import workers
 import sys
 from copy import *
+from collections import OrderedDict
 import random
-from threading import Thread
-from time import sleep
+from threading import Thread, RLock, Lock
+from time import sleep, time
+
+# number of recently requested getDiff results that are kept
+DIFF_CACHE_SIZE = 128
+
+# number of drawing operations kept for clients catching up after reconnecting
+DRAWING_LOG_SIZE = 1000
+
+# drawings with fewer segments are sent to joining clients as they are rather
+# than as a raster snapshot, see PypadRaster.py
+SNAPSHOT_MIN_SEGMENTS = 2000
+
+# rough memory cost, in bytes, of one drawing segment (a list of points), of
+# one entry of the drawing log besides the segments it shares with the 
+# drawing, and of one character of the CRDT replica (its id, flag and the 
+# entries pointing at its block); see getMemoryStats
+SEGMENT_BYTES = 250
+LOG_ENTRY_BYTES = 100
+CRDT_CHAR_BYTES = 150
+
+# reconnecting clients further behind than this many revisions re-download the
+# text instead of having the missed edits replayed
+MAX_REPLAY_REVS = 10000
+
+# the notification channels a client can subscribe to:
+#   'text'      the text changed; the value is the new revision number
+#   'drawing'   the drawing changed; the value is its sequence number
+#   'rev'       like 'text', for clients that only show the revision number
+#   'presence'  a client joined or left; the value is the list of clients
+#   'ops'       every change, in order, for replicas (see PypadReplica.py); 
+#               the value is (record, published), a journal record (see 
+#               PypadData.publish) and the time it was published
+#   'crdt'      in CRDT mode, the operations merged into the text; the value
+#               is (epoch, seq, ops), see PypadData.applyCrdtOps
+CHANNELS = ('text', 'drawing', 'rev', 'presence', 'ops', 'crdt')
+
+# channels of clients that register without naming any
+DEFAULT_CHANNELS = ('text', 'drawing')
+
+# most text records returned by one getTextOps call
+OPS_BATCH = 1000
+
+# number of CRDT operation batches kept for clients catching up, see 
+# PypadData.getCrdtOps
+CRDT_LOG_SIZE = 1000
+
+# a client that hasn't renewed its registration for LEASE_TIME seconds is 
+# dropped. Clients renew every RENEW_INTERVAL (PypadClientCore.py), which must 
+# be well below LEASE_TIME. Expired leases are looked for every REAP_INTERVAL
+LEASE_TIME = 30
+REAP_INTERVAL = 5
 
 class Server(RemoteObject):
     """
@@ -111,6 +176,10 @@ class Server(RemoteObject):
     
     Steven wrote the multithreading code in the notification methods
     """
+    
+    # remote calls are handled by a RequestEngine (see PypadRequests.py)
+    # rather than a Pyro thread per client
+    multithreaded = False
 
     def __init__(self, name):
         """
@@ -121,31 +190,115 @@ class Server(RemoteObject):
         
         """
     
+        self.engine = RequestEngine()
+        # rate limits for writes, see PypadAdmission.py
+        self.admission = AdmissionControl(self.engine.outside)
         RemoteObject.__init__(self, name)
         self.clients = []
         
+        # the set of channels each client is subscribed to, by client name
+        self.subscriptions = {}
+        
+        # the time each client's lease runs out, by client name. 
+        # reapLoop drops the clients whose lease ran out
+        self.leases = {}
+        self.clientLock = RLock()
+        
+        # the queue of notifications for each client, see PypadOutbox.py
+        self.outboxes = {}
+        reaper = Thread(target = self.reapLoop, name = 'LeaseReaper')
+        reaper.setDaemon(True)
+        reaper.start()
+        
         # prevents name clashes if multiple PypadServer instances are running
         # on same name server
         self.clientAccumulator = random.randint(0, 1000);   
-    def notifyClientThread(self, clientName, type):
+    def connect(self, ns, name):
+        """
+        Inherited RemoteObject method; the request engine takes over the
+        new daemon's connections
+        """
+        name = RemoteObject.connect(self, ns, name)
+        self.engine.attach(self)
+        return name
+    
+    def Pyro_dyncall(self, method, flags, args):
+        """
+        Called by Pyro for every remote call. Runs the call within the 
+        engine's limit for its method, see RequestEngine.gate
+        """
+        return self.engine.gate(method, RemoteObject.Pyro_dyncall, self, 
+                                method, flags, args)
+    
+    def getRequestStats(self):
+        """Returns the request engine's counters, see RequestEngine.stats"""
+        return self.engine.stats()
+    
+    def getWorkerStats(self):
+        """
+        Returns the counters of the worker processes, see WorkerPool.stats
+        """
+        return workers.stats()
+    
+    def getAdmissionStats(self):
+        """
+        Returns the rate limiting counters, see AdmissionControl.stats
+        """
+        return self.admission.stats()
+        
+    def notifyClient(self, outbox, type, traceId=None, created=None, 
+                     value=None):
+        """
+        Sends one notification to the client of outbox. Called by the 
+        outbox's thread, see PypadOutbox.py; exceptions tell it the client
+        is gone.
+        
+        Args:
+            outbox: the client's Outbox
+            type: string; one of CHANNELS, or 'resyncNeeded' if the client
+                fell too far behind and should fetch the current state
+            traceId: string; trace id of the edit that caused the 
+                notification, or None if the edit isn't traced
+            created: float; time the notification was queued
+            value: the value of the notification, see CHANNELS
+        """
+        if created != None:
+            tracer.span(traceId, 'server.queued', created)
+        start = tracer.now()
+        if outbox.proxy == None:
+            outbox.proxy = NameServer().get_proxy(outbox.clientName)
+        outbox.proxy.notify(type, traceId, value)
+        tracer.span(traceId, 'server.notify', start)
+        
+    def notifyClientThread(self, clientName, type, traceId=None, 
+                           created=None, value=None):
         """
-        Thread called by notifyClients method. Each of these threads notifies one 
-        client of change in data.         
+        Notifies a client that has no outbox, which is only the case for
+        the 'dropped' notification (see checkSender). Runs in its own
+        thread.
         
         Args:
             clientName: string; name of the client to notify
-            type: string; type of data to update 
-                value can be either 'drawing' or 'text'
+            type: string; type of data to update
+            traceId: string; trace id of the edit that caused the 
+                notification, or None if the edit isn't traced
+            created: float; time the thread was created, used to trace 
+                thread startup
+            value: the value of the notification, see CHANNELS
         
         History
             Added 4/24/10 by Steven
         """
+        if created != None:
+            tracer.span(traceId, 'server.threadStart', created)
         try:
             print 'Notifying', clientName
             
+            start = tracer.now()
             ns = NameServer()
             proxy = ns.get_proxy(clientName)
-            proxy.notify(type)
+            proxy.notify(type, traceId, value)
+            tracer.span(traceId, 'server.notify', start)
             print 'Finished notifying'
         #=======================================================================
         # # Steven commented these lines because they caught NamingErrors
@@ -161,15 +314,22 @@ class Server(RemoteObject):
             # which occur when an client dies.
             self.unregister(clientName)
             
-    def notifyClients(self, sendingClient, type):
+    def notifyClients(self, sendingClient, type, traceId=None, value=None):
         """
         Notify all registered clients when the state of
         the Server changes, except sendingClient (otherwise infinite loop
-        occurs)
+        occurs). Only clients subscribed to the channel type are notified;
+        text changes reach clients subscribed to 'rev' as 'rev' 
+        notifications.
+        
+        The notifications are queued in each client's outbox, so this 
+        never waits for a client.
         
         Args:
             sendingClient: string; name of client whose state changed
-            type: 'drawing' or 'text'
+            type: one of CHANNELS
+            traceId: string; trace id of the edit, passed on to the clients
+            value: the value of the notification, see CHANNELS
             
         History
             This method was from Subject.py template
@@ -178,28 +338,38 @@ class Server(RemoteObject):
             Modified heavily by Steven.
             Split into two methods for multithreading purposes
         """
-        t = list()      #lists of notification threads
-        
         if (self.VERBOSE):
             print "------------"
             print "list of clients:" + str(self.clients)
         
-        i = 0   #thread number
         for clientName in copy(self.clients): # copy to permit mods to clients
-            if clientName != sendingClient:
-                if (self.VERBOSE): print "notifying using thread " + str(i)
-                t.append(Thread(target = self.notifyClientThread,
-                                args = [clientName, type]))
-                if (self.VERBOSE): print "Created thread"
-                t[i].start()
-                if (self.VERBOSE): print "Started thread" + str(i)
-                i += 1
+            channels = self.subscriptions.get(clientName, DEFAULT_CHANNELS)
+            if type in channels:
+                notification = (type, traceId)
+            elif type == 'text' and 'rev' in channels:
+                notification = ('rev', None)
+            else:
+                continue
+            outbox = self.outboxes.get(clientName)
+            if clientName != sendingClient and outbox != None:
+                if (self.VERBOSE): print "queueing for " + clientName
+                outbox.put(notification[0], notification[1], value)
 
+    def notifyPresence(self, changedClient):
+        """
+        Tells the clients subscribed to 'presence' that changedClient joined
+        or left
+        """
+        self.notifyClients(changedClient, 'presence', None, list(self.clients))
+    
     # the following methods are intended to be invoked remotely
-    def register(self):
+    def register(self, channels=DEFAULT_CHANNELS):
         """
         Register a new client to server (invoked by the client)
         
+        Args:
+            channels: list of the channels to subscribe to, see CHANNELS
+        
         History
             This method was part of Subject.py template
             
@@ -208,10 +378,18 @@ class Server(RemoteObject):
             entirely random ids. The first id is random, the the rest are 
             sequential
         """
-        id = self.clientAccumulator
-        self.clientAccumulator += 1
-        clientName = self.name + '_client_' + str(id)
-        self.clients.append(clientName)
+        self.clientLock.acquire()
+        try:
+            id = self.clientAccumulator
+            self.clientAccumulator += 1
+            clientName = self.name + '_client_' + str(id)
+            self.subscriptions[clientName] = set(self.checkChannels(channels))
+            self.leases[clientName] = time() + LEASE_TIME
+            self.openOutbox(clientName)
+            self.clients.append(clientName)
+        finally:
+            self.clientLock.release()
+        self.notifyPresence(clientName)
          
         print "----------------"
         print 'Registered ' + clientName
@@ -223,8 +401,118 @@ class Server(RemoteObject):
         """
         Steven added this method to unregister clients when they disconnect.
         """
-        self.clients.remove(clientName)
+        self.clientLock.acquire()
+        try:
+            # several notification threads can fail for the same client
+            if clientName not in self.clients:
+                return
+            self.clients.remove(clientName)
+            self.subscriptions.pop(clientName, None)
+            self.leases.pop(clientName, None)
+            outbox = self.outboxes.pop(clientName, None)
+            if outbox != None:
+                outbox.close()
+        finally:
+            self.clientLock.release()
+        self.admission.forget(clientName)
         print 'Unregistered ' + clientName
+        self.notifyPresence(clientName)
+    
+    def isRegistered(self, clientName):
+        """
+        Returns True if clientName is registered. A client that finds it was
+        dropped (for example because a notification failed during a network
+        blip) should call reconnect.
+        """
+        return clientName in self.clients
+    
+    def renew(self, clientName):
+        """
+        Extends the lease of clientName by LEASE_TIME seconds. Returns False
+        if the client was dropped, in which case it should call reconnect.
+        """
+        self.clientLock.acquire()
+        try:
+            if clientName not in self.clients:
+                return False
+            self.leases[clientName] = time() + LEASE_TIME
+            return True
+        finally:
+            self.clientLock.release()
+    
+    def openOutbox(self, clientName):
+        """Starts the outbox of a newly registered client"""
+        outbox = Outbox(clientName, self.notifyClient, self.unregister)
+        self.outboxes[clientName] = outbox
+        outbox.start()
+    
+    def reapLoop(self):
+        """
+        Drops the clients whose lease ran out, and those that haven't taken
+        a notification for STUCK_DEADLINE seconds, every REAP_INTERVAL
+        """
+        while True:
+            sleep(REAP_INTERVAL)
+            now = time()
+            self.clientLock.acquire()
+            try:
+                expired = [clientName for clientName in self.clients
+                           if self.leases.get(clientName, 0) < now]
+                stuck = [clientName for clientName in self.clients
+                         if clientName in self.outboxes and 
+                         self.outboxes[clientName].stuckFor(now) > 
+                         STUCK_DEADLINE]
+            finally:
+                self.clientLock.release()
+            for clientName in expired:
+                print 'Lease of %s expired' % clientName
+                self.unregister(clientName)
+            for clientName in stuck:
+                print '%s stopped taking notifications' % clientName
+                self.unregister(clientName)
+    
+    def checkChannels(self, channels):
+        """Returns channels, raising ValueError if one is unknown"""
+        for channel in channels:
+            if channel not in CHANNELS:
+                raise ValueError('unknown channel %r' % (channel,))
+        return channels
+    
+    def subscribe(self, clientName, channels):
+        """
+        Subscribes clientName to more channels, see CHANNELS. A client that
+        subscribes to 'text' or 'drawing' should fetch the current state 
+        afterwards, since it wasn't notified of the changes before.
+        """
+        self.checkChannels(channels)
+        self.subscriptions.setdefault(clientName, set()).update(channels)
+    
+    def unsubscribe(self, clientName, channels):
+        """Stops notifying clientName on the given channels"""
+        self.subscriptions.get(clientName, set()).difference_update(channels)
+    
+    def getSubscriptions(self, clientName):
+        """Returns the list of channels clientName is subscribed to"""
+        return sorted(self.subscriptions.get(clientName, ()))
+    
+    def getPresence(self):
+        """Returns the list of registered clients"""
+        return list(self.clients)
+    
+    def getClientMemory(self):
+        """
+        Returns, by client name, a dictionary with the notifications 
+        'queued' in the client's outbox and their estimated 'bytes' (see 
+        PypadOutbox.valueCost)
+        """
+        self.clientLock.acquire()
+        try:
+            outboxes = self.outboxes.items()
+        finally:
+            self.clientLock.release()
+        return dict([(clientName, {'queued': len(outbox.queue),
+                                   'bytes': outbox.queuedBytes})
+                     for clientName, outbox in outboxes])
 
 class PypadData():
     """
@@ -243,27 +531,282 @@ class PypadData():
         Args:
             string: initial text to be stored in the PypadServer object
         """
-        self.history = list()   #history is a list of all past text strings
-        self.history.append(string)
+        # history holds all past texts as Ropes (see PypadRope.py) and the 
+        # edits (offset, length, text) between them. Ropes share all 
+        # unchanged text with each other, so a revision only costs memory 
+        # for the part that changed; old revisions are spilled to disk when
+        # the history outgrows its memory budget (see PypadHistory.py)
+        self.history = RevisionStore(string)
+        
+        # finds the revisions containing a string, see PypadSearch.py
+        self.searchIndex = SearchIndex()
+        
+        # who last changed each line, see PypadBlame.py
+        self.blameIndex = BlameIndex(string)
+        
+        # the current text as one string, rebuilt lazily from the rope
+        self.textCache = string
+        
+        # Pyro calls come in on several threads, so edits are serialized
+        self.dataLock = RLock()
+        
+        # memoized getDiff results, least recently used first, and the 
+        # estimated memory they use
+        self.diffCache = OrderedDict()
+        self.diffCacheBytes = 0
+        
+        # when persistence is on, every change is also written here; see 
+        # PypadCheckpoint.py
+        self.journal = None
+        
+        # callables that get every change record too, in order; see publish
+        self.opListeners = []
         
         # self.drawing is the remote attribute that stores the drawings
         self.drawing = []
         
+        # every change to the drawing gets the next drawingSeq number. 
+        # drawingLog holds the recent changes as (seq, op) pairs, so 
+        # clients can catch up without downloading the whole drawing. 
+        # See PypadEdit.py for the drawing operations
+        self.drawingSeq = 0
+        self.drawingLog = []
+        
+        # the drawing rasterized for joining clients, see PypadRaster.py
+        self.raster = DrawingRaster()
+        
+        # in CRDT mode (see enableCrdt), the server's replica of the text 
+        # as an RgaDocument (PypadCrdt.py). Every batch of operations merged
+        # into it gets the next crdtSeq number; crdtLog holds the recent 
+        # batches as (seq, ops) pairs. crdtEpoch changes when the replica is
+        # made anew, e.g. after a restart, since ids don't carry over
+        self.crdt = None
+        self.crdtEpoch = None
+        self.crdtSeq = 0
+        self.crdtLog = []
+        # the estimated memory used by the operations in crdtLog
+        self.crdtLogBytes = 0
+        
     # The following methods should be invoked remotely by client or the update
     # loops in PypadClient.py
     def getText(self):
         """
         Getter for the text data
         """
-        return self.history[len(self.history)-1]        
-    def changeText(self,string):
+        text = self.textCache
+        if text == None:
+            self.dataLock.acquire()
+            try:
+                if self.textCache == None:
+                    self.textCache = self.history.current().flatten()
+                text = self.textCache
+            finally:
+                self.dataLock.release()
+        return text
+    def changeText(self, string, author=None):
         """
         Setter for the text data on the PypadServer object
         
+        The new text is stored as the edit from the current text, so the 
+        new revision shares everything else with the previous one.
+        
         Args:
             string: text data to be set
+            author: string; name of the client making the change
+        
+        Returns the number of the new revision
+        """
+        self.dataLock.acquire()
+        try:
+            edit = diffText(self.getText(), string)
+            if edit == None:
+                edit = (0, 0, '')
+            if self.crdt != None:
+                self.logCrdtOps(self.crdt.localEdit(*edit))
+            self.appendRevision(edit, author)
+            # the new string is the current text, so keep it as the cache
+            self.textCache = string
+            return len(self.history)
+        finally:
+            self.dataLock.release()
+    def editText(self, offset, length, text, author=None, baseRev=None):
+        """
+        Replaces the length characters at offset by text, creating a new
+        revision. Costs O(log n) for a document of n characters, unlike 
+        changeText, which needs the whole document.
+        
+        Args:
+            offset: int; position of the edit in the current text
+            length: int; number of characters removed at offset
+            text: string; text inserted at offset
+            author: string; name of the client making the change
+            baseRev: int; the revision the edit was made on, or None if the
+                caller doesn't know. An edit made on an older revision than
+                the current one is refused, since its offsets may point 
+                into text that changed since
+        
+        Returns the number of the new revision. Raises ValueError if the 
+        edit is based on an older revision or lies outside the text
+        """
+        self.dataLock.acquire()
+        try:
+            rev = len(self.history)
+            if baseRev != None and baseRev != rev:
+                raise ValueError('the edit is based on revision %s, but the '
+                                 'text is at revision %d' % (baseRev, rev))
+            if offset < 0 or length < 0 or \
+            offset + length > len(self.history.current()):
+                raise ValueError('the edit (%d, %d) lies outside the text' %
+                                 (offset, length))
+            if self.crdt != None:
+                self.logCrdtOps(self.crdt.localEdit(offset, length, text))
+            self.appendRevision((offset, length, text), author)
+            self.textCache = None
+            return len(self.history)
+        finally:
+            self.dataLock.release()
+    def appendRevision(self, edit, author=None, when=None):
+        """
+        Applies edit to the current rope and stores the result as a new 
+        revision made by the client author at time when (default now). 
+        Callers must hold dataLock.
+        """
+        if when == None:
+            when = time()
+        offset, length, text = edit
+        if length == 0 and text == '':
+            # stored the way spilled segments store it (see 
+            # RevisionStore.writeSegment), so a revision reads the same 
+            # before and after it is spilled
+            edit = offset, length, text = (0, 0, '')
+        before = self.history.current()
+        after = before.replace(offset, length, text)
+        self.history.append(after, edit, when, author)
+        rev = len(self.history)
+        self.searchIndex.add(rev, before, after, edit)
+        self.blameIndex.add(rev, before, edit)
+        self.publish(('text', rev, edit, author, when))
+    def publish(self, record):
+        """
+        Writes a change record to the journal and passes it to the 
+        opListeners. Records are ('text', rev, edit, author, when) or 
+        ('drawing', seq, op). Callers hold dataLock, so records are 
+        published in order.
+        """
+        if self.journal != None:
+            self.journal.write(record)
+        for listener in self.opListeners:
+            listener(record)
+    # CRDT mode, see PypadCrdt.py
+    def enableCrdt(self):
+        """
+        Switches to CRDT mode: text changes are merged as CRDT operations
+        from now on, starting from the current text. Changes made as edits
+        or whole texts (by clients not in CRDT mode) are turned into
+        operations by the server.
+        """
+        self.dataLock.acquire()
+        try:
+            # the epoch is the site of the text's ids, so they differ from
+            # those of the replicas of earlier epochs
+            self.crdtEpoch = '%s-%f' % (self.name, time())
+            self.crdt = RgaDocument(self.name, self.getText(),
+                                    origin = self.crdtEpoch)
+            self.crdtSeq = 0
+            self.crdtLog = []
+            self.crdtLogBytes = 0
+        finally:
+            self.dataLock.release()
+    
+    def applyCrdtOps(self, ops, author=None, epoch=None):
+        """
+        Merges CRDT operations into the server's replica and stores the 
+        edits they make to the text as revisions. Operations the replica 
+        already has are skipped, so clients may send them again.
+        
+        Args:
+            ops: list of operations, see PypadCrdt.py
+            author: string; name of the client that made them
+            epoch: string; the epoch of the replica they were made on (see
+                getCrdtState)
+        
+        Returns (seq, rev): the batch's sequence number and the newest
+        revision. Raises ValueError, changing nothing, if the operations 
+        were made on a replica of another epoch or refer to characters the
+        server's replica doesn't have; the client then joins again
+        """
+        self.dataLock.acquire()
+        try:
+            if self.crdt == None:
+                raise ValueError('the server is not in CRDT mode')
+            if epoch != self.crdtEpoch:
+                raise ValueError('the operations were made in epoch %s, '
+                                 'but the server is in epoch %s' % 
+                                 (epoch, self.crdtEpoch))
+            for edit in self.crdt.integrate(ops):
+                self.appendRevision(edit, author)
+                self.textCache = None
+            return self.logCrdtOps(ops), len(self.history)
+        finally:
+            self.dataLock.release()
+    
+    def logCrdtOps(self, ops):
+        """
+        Gives a batch of operations merged into the replica the next 
+        sequence number, keeps it in crdtLog and passes it to crdtChanged.
+        Returns the sequence number. Callers hold dataLock
+        """
+        self.crdtSeq += 1
+        self.crdtLog.append((self.crdtSeq, ops))
+        self.crdtLogBytes += valueCost(ops)
+        while len(self.crdtLog) > CRDT_LOG_SIZE:
+            self.crdtLogBytes -= valueCost(self.crdtLog.pop(0)[1])
+        self.crdtChanged(self.crdtSeq, ops)
+        return self.crdtSeq
+    
+    def crdtChanged(self, seq, ops):
+        """
+        Called with every batch of operations merged by applyCrdtOps, in 
+        order, while holding dataLock. PypadServer passes them on to the 
+        clients
+        """
+        pass
+    
+    def getCrdtState(self):
         """
-        self.history.append(string)
+        Returns (epoch, seq, state): the state of the server's replica (see
+        RgaDocument.getState) as of batch seq, for clients joining in CRDT
+        mode. state is None when the server is not in CRDT mode
+        """
+        self.dataLock.acquire()
+        try:
+            if self.crdt == None:
+                return None, None, None
+            return self.crdtEpoch, self.crdtSeq, self.crdt.getState()
+        finally:
+            self.dataLock.release()
+    
+    def getCrdtOps(self, sinceSeq):
+        """
+        Returns (epoch, seq, ops): the operations of the batches after 
+        sinceSeq, in order, as one list. ops is None if the log doesn't go 
+        back that far; the client then needs the whole state.
+        """
+        self.dataLock.acquire()
+        try:
+            seq = self.crdtSeq
+            if sinceSeq == None or sinceSeq > seq:
+                return self.crdtEpoch, seq, None
+            if self.crdtLog and self.crdtLog[0][0] > sinceSeq + 1:
+                return self.crdtEpoch, seq, None
+            ops = []
+            for batchSeq, batch in self.crdtLog:
+                if batchSeq > sinceSeq:
+                    ops.extend(batch)
+            return self.crdtEpoch, seq, ops
+        finally:
+            self.dataLock.release()
+    
     def getHistory(self, num):
         """
         Returns the revision that is num revisions before the
@@ -278,11 +821,11 @@ class PypadData():
         """
         lenHist = len(self.history)
         
-        if num <= lenHist:
-            return self.history[num-1]
+        if 1 <= num <= lenHist:
+            return self.history.rope(num).flatten()
         else:
             print "You're trying to reach a revision that doesn't exist!"
-            return self.history[lenHist]
+            return self.getText()
             
     def getDrawing(self):
         """
@@ -294,15 +837,404 @@ class PypadData():
     def changeDrawing(self, newDrawing):
         """
         Setter for drawing data. 
+        
+        Clients send their whole drawing, so the change is logged as an 
+        'add' operation when only new segments were appended, and as a 'set'
+        operation otherwise (for example when the drawing was cleared).
+        
+        Returns the drawing sequence number of the change
+        """
+        self.dataLock.acquire()
+        try:
+            old = self.drawing
+            if newDrawing == old:
+                return self.drawingSeq
+            if newDrawing[:len(old)] == old:
+                op = ('add', newDrawing[len(old):])
+            else:
+                op = ('set', newDrawing)
+            self.applyDrawingOp(op)
+            return self.drawingSeq
+        finally:
+            self.dataLock.release()
+    
+    def addStrokes(self, segments):
+        """
+        Appends segments to the drawing, for clients that only have part of 
+        the drawing (see getDrawingSnapshot). Returns the drawing sequence 
+        number of the change
+        """
+        self.dataLock.acquire()
+        try:
+            if segments:
+                self.applyDrawingOp(('add', list(segments)))
+            return self.drawingSeq
+        finally:
+            self.dataLock.release()
+    
+    def applyDrawingOp(self, op):
+        """
+        Applies a drawing operation and logs it under the next sequence 
+        number. Callers must hold dataLock.
+        """
+        if op[0] == 'add':
+            self.drawing = self.drawing + op[1]
+        else:
+            self.drawing = op[1]
+        self.drawingSeq += 1
+        if self.raster.seq == self.drawingSeq - 1:
+            # otherwise the drawing was replaced without an operation, and 
+            # getDrawingSnapshot redraws the raster
+            self.raster.apply(self.drawingSeq, op)
+        self.drawingLog.append((self.drawingSeq, op))
+        if len(self.drawingLog) > DRAWING_LOG_SIZE:
+            del self.drawingLog[:len(self.drawingLog) - DRAWING_LOG_SIZE]
+        self.publish(('drawing', self.drawingSeq, op))
+    
+    def getDrawingState(self):
+        """
+        Returns (seq, drawing): the drawing and its sequence number, read
+        atomically
+        """
+        self.dataLock.acquire()
+        try:
+            return self.drawingSeq, self.drawing
+        finally:
+            self.dataLock.release()
+    
+    def getDrawingSnapshot(self):
+        """
+        Returns (seq, image): the drawing rasterized as a PNG image (see 
+        PypadRaster.py) and the sequence number it covers, so a joining 
+        client only needs the operations after seq. image is None for 
+        drawings of fewer than SNAPSHOT_MIN_SEGMENTS segments, which are 
+        cheap enough to send as they are (see getDrawingState).
+        """
+        self.dataLock.acquire()
+        try:
+            if len(self.drawing) < SNAPSHOT_MIN_SEGMENTS:
+                return self.drawingSeq, None
+            if self.raster.seq == self.drawingSeq:
+                seq, pixels = self.raster.copy()
+                drawing = None
+            else:
+                # the drawing list is replaced, never changed in place (see 
+                # applyDrawingOp), so it can be drawn without the lock
+                seq, drawing = self.drawingSeq, self.drawing
+        finally:
+            self.dataLock.release()
+        if drawing == None:
+            return seq, self.raster.encode(seq, pixels)
+        # drawn by a worker process, see PypadWorkers.py
+        pixels, image = workers.rasterize(drawing, self.raster.width,
+                                          self.raster.height)
+        self.dataLock.acquire()
+        try:
+            # unless another call brought the raster up to date meanwhile;
+            # operations applied meanwhile didn't reach the old raster 
+            if self.raster.seq != self.drawingSeq:
+                self.raster.install(seq, pixels, image)
+        finally:
+            self.dataLock.release()
+        return seq, image
+    
+    def getDrawingOps(self, sinceSeq):
+        """
+        Returns (seq, ops): the current drawing sequence number and the 
+        drawing operations after sinceSeq. ops is None if the log doesn't 
+        go back that far, in which case the caller needs the whole drawing.
+        """
+        self.dataLock.acquire()
+        try:
+            seq = self.drawingSeq
+            if sinceSeq == None or sinceSeq > seq:
+                return seq, None
+            if sinceSeq == seq:
+                return seq, []
+            if len(self.drawingLog) == 0 or self.drawingLog[0][0] > sinceSeq + 1:
+                return seq, None
+            # sequence numbers in the log are consecutive
+            first = sinceSeq + 1 - self.drawingLog[0][0]
+            return seq, [op for (s, op) in self.drawingLog[first:]]
+        finally:
+            self.dataLock.release()
+            
+    def getTextOps(self, sinceRev, limit=OPS_BATCH):
+        """
+        Returns the text change records after revision sinceRev, at most 
+        limit of them, in the form published to the 'ops' channel (see 
+        publish). Replicas use it to catch up. Thinned revisions have no 
+        record; their edits are in the next retained revision's.
+        
+        With sinceRev 0, the first record is ('text', 1, None, author, 
+        when) for revision 1, whose text is read with getTextRange.
+        """
+        last = min(len(self.history), sinceRev + limit)
+        records = []
+        if sinceRev < 1:
+            info = self.history.authorsOf([1]), self.history.timesOf([1])
+            records.append(('text', 1, None, info[0][1], info[1][1]))
+            sinceRev = 1
+        revs = range(sinceRev + 1, last + 1)
+        times = self.history.timesOf(revs)
+        for rev, before, edit, after, author in self.history.walk(revs):
+            if rev not in times:
+                # a thinned revision was replaced by one after the batch
+                times.update(self.history.timesOf([rev]))
+            records.append(('text', rev, edit, author, times[rev]))
+        return records
+    def resetText(self, string, when=None, author=None):
+        """
+        Replaces the whole history by a single revision holding string, 
+        keeping the history's settings. Used to import an archive (see 
+        PypadArchive.py); the reset is not journaled.
+        
+        Args:
+            string: the text of the new revision 1
+            when: float; its time, default now
+            author: string; the client that made it
         """
-        self.drawing = newDrawing
+        self.dataLock.acquire()
+        try:
+            old = self.history
+            self.history = RevisionStore(string, old.budget, old.directory,
+                                         old.thinning, when, author)
+            self.history.checkpointed = old.checkpointed
+            # the new store spills into the same directory
+            self.history.tempDirectory = old.tempDirectory
+            self.searchIndex.clear()
+            self.blameIndex.reset(self.history.current())
+            self.textCache = string
+            self.diffCache.clear()
+            self.diffCacheBytes = 0
+        finally:
+            self.dataLock.release()
             
+    # Persistence, see PypadCheckpoint.py
+    def loadCheckpoint(self, state):
+        """
+        Replaces the data by a checkpoint written by PypadCheckpoint
+        
+        Args:
+            state: dictionary with the revision history (see 
+                RevisionStore.loadState), the drawing and its sequence number
+        """
+        self.dataLock.acquire()
+        try:
+            self.history.loadState(state['history'])
+            self.searchIndex.rebuild(self.history)
+            self.blameIndex.rebuild(self.history)
+            self.textCache = None
+            self.diffCache.clear()
+            self.diffCacheBytes = 0
+            self.drawing = state['drawing']
+            self.drawingSeq = state['drawingSeq']
+            self.drawingLog = []
+        finally:
+            self.dataLock.release()
+    
+    def replayRecord(self, record):
+        """
+        Applies one journaled change, skipping changes the data already has
+        
+        Args:
+            record: ('text', rev, edit, author, when) or ('drawing', seq, 
+                op). Journals written before authors and times were 
+                recorded have ('text', rev, edit) or ('text', rev, edit, 
+                author)
+        """
+        type, number, change = record[:3]
+        self.dataLock.acquire()
+        try:
+            if type == 'text' and number == len(self.history) + 1:
+                author, when = (record + (None, None))[3:5]
+                self.appendRevision(change, author, when)
+                self.textCache = None
+            elif type == 'drawing' and number == self.drawingSeq + 1:
+                self.applyDrawingOp(change)
+        finally:
+            self.dataLock.release()
+    
     def getRevNum(self):
         """
         Returns the number of the most current revision
         """
         return len(self.history)
 
+    # Ranged reads, so that clients can fetch large documents in chunks
+    # instead of in one Pyro response
+    def getRevision(self, rev=None):
+        """
+        Returns the rope of revision rev (numbered from 1 like getHistory),
+        or of the current revision if rev is None
+        """
+        if rev == None:
+            return self.history.current()
+        return self.history.rope(rev)
+    def getTextLength(self, rev=None):
+        """
+        Returns the length of the text of revision rev (default: current)
+        """
+        return len(self.getRevision(rev))
+    def getTextRange(self, offset, length, rev=None):
+        """
+        Returns length characters of the text of revision rev, starting at 
+        offset. Costs O(log n + length), whatever the size of the document.
+        
+        Args:
+            offset: int; position of the first character
+            length: int; number of characters. Fewer are returned at the end
+                of the text
+            rev: int; revision number, or None for the current revision
+        """
+        return self.getRevision(rev).slice(offset, offset + length)
+    def getDiff(self, fromRev, toRev=None):
+        """
+        Returns an edit script turning the text of revision fromRev into the
+        text of revision toRev (default: current). The script is a list of
+        edits (offset, length, text), see PypadEdit.py; it is empty if the
+        texts are equal. fromRev may be newer than toRev.
+        
+        The edits between the two revisions are composed into the one range
+        they changed, so the cost and the size of the result depend on the
+        size of the change, not on the size of the document. Recently 
+        requested scripts are memoized.
+        
+        Args:
+            fromRev: int; revision the caller has
+            toRev: int; revision the caller wants
+        """
+        if toRev == None:
+            toRev = len(self.history)
+        fromRope = self.getRevision(fromRev)
+        toRope = self.getRevision(toRev)
+        key = (fromRev, toRev)
+        
+        self.dataLock.acquire()
+        try:
+            if key in self.diffCache:
+                script = self.diffCache.pop(key)
+                self.diffCache[key] = script
+                return script
+        finally:
+            self.dataLock.release()
+        
+        low, high = min(fromRev, toRev), max(fromRev, toRev)
+        changed = composeRange(self.history.editsBetween(low, high))
+        
+        script = []
+        if changed != None:
+            start, lowEnd, highEnd = changed
+            if fromRev > toRev:
+                lowEnd, highEnd = highEnd, lowEnd
+            # the composed range can contain text that was changed and 
+            # changed back, so trim it to what actually differs
+            edit = diffText(fromRope.slice(start, lowEnd), 
+                            toRope.slice(start, highEnd))
+            if edit != None:
+                script.append((start + edit[0], edit[1], edit[2]))
+        
+        self.dataLock.acquire()
+        try:
+            if key not in self.diffCache:
+                self.diffCacheBytes += valueCost(script)
+            self.diffCache[key] = script
+            while len(self.diffCache) > DIFF_CACHE_SIZE:
+                self.diffCacheBytes -= \
+                    valueCost(self.diffCache.popitem(last = False)[1])
+        finally:
+            self.dataLock.release()
+        return script
+    def getBlame(self, rev=None):
+        """
+        Returns who last changed each line of revision rev (default: 
+        current), as a list with one (author, rev) pair per line of 
+        text.split('\\n'), where author is the name of the client that made
+        revision rev. Lines of the initial text have (None, 1).
+        
+        The attribution is kept up to date as revisions are added, see 
+        PypadBlame.py.
+        """
+        if rev == None:
+            rev = len(self.history)
+        if rev < 1 or rev > len(self.history):
+            raise IndexError('revision %d does not exist' % rev)
+        return self.blameIndex.blame(rev, self.history)
+    def searchHistory(self, query):
+        """
+        Returns the ranges of revisions whose text contains query, as a list
+        of (first, last) pairs in ascending order. For example [(3, 10)] 
+        means that revision 3 introduced the string and revision 11 removed
+        it. Uses the index of PypadSearch.py, so only the revisions that 
+        touched the query are looked at.
+        
+        Args:
+            query: non-empty string
+        """
+        return self.searchIndex.search(query, self.history)
+    def getTextHead(self, length):
+        """
+        Returns (rev, totalLength, text): the current revision number, the 
+        length of its text and its first length characters, read atomically.
+        
+        A joining client shows text right away and then fetches the rest of 
+        revision rev with getTextRange.
+        """
+        self.dataLock.acquire()
+        try:
+            rope = self.history.current()
+            rev = len(self.history)
+        finally:
+            self.dataLock.release()
+        return rev, len(rope), rope.slice(0, length)
+    
+    # Memory accounting
+    def getMemoryStats(self):
+        """
+        Returns the estimated memory used by the document, in bytes, as a 
+        dictionary with
+            'history': the revisions, see RevisionStore.memoryStats. 
+                'spilled' is on disk, not in memory
+            'drawing': 'segments' in the drawing and their 'bytes', the 
+                drawing 'log' and the 'raster' (see PypadRaster.py)
+            'caches': the current 'text', the 'diff' cache, the PNG 
+                'snapshot' of the drawing, the 'search' index and the 
+                keyframes of the 'blame' index
+            'crdt': 'chars' of the CRDT replica (including deleted ones) 
+                and their 'bytes', and the operations 'log'; all 0 when not
+                in CRDT mode
+            'total': the sum of the above, without the spilled history
+        Every figure comes from a counter or a length kept up to date as 
+        the document changes, so this costs O(1) and doesn't walk the 
+        objects.
+        """
+        self.dataLock.acquire()
+        try:
+            history = self.history.memoryStats()
+            segments = len(self.drawing)
+            drawing = {'segments': segments,
+                       'bytes': segments * SEGMENT_BYTES,
+                       'log': len(self.drawingLog) * LOG_ENTRY_BYTES,
+                       'raster': len(self.raster.pixels)}
+            encoded = self.raster.encoded
+            caches = {'text': len(self.textCache or ''),
+                      'diff': self.diffCacheBytes,
+                      'snapshot': encoded and len(encoded[1]) or 0,
+                      'search': self.searchIndex.memoryBytes(),
+                      'blame': self.blameIndex.memoryBytes()}
+            chars = 0
+            if self.crdt != None:
+                chars = len(self.crdt.blockOf)
+            crdt = {'chars': chars, 'bytes': chars * CRDT_CHAR_BYTES,
+                    'log': self.crdtLogBytes}
+        finally:
+            self.dataLock.release()
+        total = history['hot'] + history['cache'] + drawing['bytes'] + \
+            drawing['log'] + drawing['raster'] + sum(caches.values()) + \
+            crdt['bytes'] + crdt['log']
+        return {'history': history, 'drawing': drawing, 'caches': caches,
+                'crdt': crdt, 'total': total}
+
 class PypadServer(Server, PypadData):    
     """
     PypadServer is the final object class, that contains necessary Server and
@@ -322,30 +1254,324 @@ class PypadServer(Server, PypadData):
         """
         Server.__init__(self, name)
         PypadData.__init__(self, string)
+        self.opListeners.append(self.publishOp)
         
-    def setState(self, sendingClient, newText=[], newDrawing =[], type = 'text'):
+        # relays forwarding the changes to read-only viewers, when this is
+        # the origin of a relay tree. Imported here because PypadRelay.py
+        # builds on this module
+        from PypadRelay import RelayTree
+        self.relayTree = RelayTree(name)
+        
+        # bulk imports in progress, see beginImport: for each client, the
+        # chunks received so far and their total length
+        self.imports = {}
+        self.importLock = Lock()
+        
+    def setState(self, sendingClient, newText=[], newDrawing =[], type = 'text',
+                 traceId=None, baseRev=None, epoch=None):
         """
         Setter for changing the state of the server
         
         Args:
-            type: 'drawing' or 'text'; type of state change
+            type: 'drawing', 'strokes', 'text', 'edit' or 'crdt'; type of 
+                state change
             sendingClient: string; name of client  whose state changed, initiating the 
                 PypadServer state
             newText: string; the new text contained in the sendingClient's text
-                editor window
-            newDrawing: 
+                editor window. For type 'edit', a tuple (offset, length, text)
+                describing the change instead, and for type 'crdt' a list
+                of CRDT operations (see PypadCrdt.py)
+            newDrawing: list of segments; the sendingClient's drawing. For
+                type 'strokes', only the segments to append to the drawing
+            traceId: string; trace id of the edit, or None if the edit isn't
+                traced. See PypadTrace.py
+            baseRev: int; for type 'edit', the revision the edit was made
+                on. The edit is refused with ValueError if the text changed
+                since (see editText); the client then sends its whole text
+            epoch: string; for type 'crdt', the epoch of the client's
+                replica. Operations of another epoch are refused with
+                ValueError (see applyCrdtOps)
+        
+        Returns the new revision number for text changes (or the drawing 
+        sequence number for drawing changes), so the client knows which 
+        revision its data corresponds to. Writes over the rate limits wait,
+        see PypadAdmission.py
         
         Written by Steven
         """
-        if type == 'text':
+        if type == 'drawing' or type == 'strokes':
+            value = newDrawing
+        elif type == 'edit':
+            value = (newText, baseRev)
+        elif type == 'crdt':
+            value = (newText, epoch)
+        else:
+            value = newText
+        return self.admission.admit(sendingClient, self.applyState,
+                                    sendingClient, type, value, traceId)
+    
+    def applyState(self, sendingClient, type, value, traceId=None):
+        """
+        Applies a write admitted by setState and notifies the other clients.
+        Returns the new revision or drawing sequence number
+        
+        Args:
+            sendingClient: string; name of the client writing
+            type: the type of the write, see setState
+            value: the newText or newDrawing of setState. For 'edit', a
+                pair of the edit and the revision it is based on; for 
+                'crdt', a pair of the operations and their epoch
+            traceId: string; trace id of the edit, see PypadTrace.py
+        """
+        newText = newDrawing = value
+        if type in ('text', 'edit'):
             print '----------'
             print 'Changing the text of the server'
-            self.changeText(newText)
-            self.notifyClients(sendingClient, 'text')
+            start = tracer.now()
+            if type == 'edit':
+                # an edit (offset, length, text), see PypadEdit.py
+                edit, baseRev = newText
+                rev = self.editText(*edit, author = sendingClient, 
+                                    baseRev = baseRev)
+            else:
+                rev = self.changeText(newText, sendingClient)
+            tracer.span(traceId, 'server.setState', start)
+            start = tracer.now()
+            self.notifyClients(sendingClient, 'text', traceId, rev)
+            tracer.span(traceId, 'server.notifyClients', start)
+            self.checkSender(sendingClient)
+            return rev
         elif type == 'drawing':
             print 'Changing the drawing of the server'
-            self.changeDrawing(newDrawing)
-            self.notifyClients(sendingClient, 'drawing')  
+            seq = self.changeDrawing(newDrawing)
+            self.notifyClients(sendingClient, 'drawing', None, seq)  
+            self.checkSender(sendingClient)
+            return seq
+        elif type == 'crdt':
+            # a list of CRDT operations (see PypadCrdt.py) and their epoch
+            ops, epoch = newText
+            seq, rev = self.applyCrdtOps(ops, sendingClient, epoch)
+            self.notifyClients(sendingClient, 'text', traceId, rev)
+            self.checkSender(sendingClient)
+            return rev
+        elif type == 'strokes':
+            seq = self.addStrokes(newDrawing)
+            self.notifyClients(sendingClient, 'drawing', None, seq)  
+            self.checkSender(sendingClient)
+            return seq
+    
+    def crdtChanged(self, seq, ops):
+        """
+        Passes merged CRDT operations on to the clients subscribed to 
+        'crdt', including the one that sent them, so that every client sees
+        every batch number. See PypadData.crdtChanged
+        """
+        self.notifyClients(None, 'crdt', None, (self.crdtEpoch, seq, ops))
+    
+    def publishOp(self, record):
+        """
+        Queues a change record for the clients subscribed to 'ops', which 
+        are replicas (see PypadReplica.py). Called by PypadData.publish 
+        while holding dataLock, so every replica gets the records in order.
+        """
+        self.notifyClients(None, 'ops', None, (record, time()))
+        
+    # The relay tree, see PypadRelay.py
+    def joinRelayTree(self, relayName):
+        """Adds a relay to the tree. Returns the name of its parent"""
+        return self.relayTree.place(relayName)
+        
+    def reparentRelay(self, relayName, failedParent):
+        """
+        Moves a relay that can't reach failedParent to a new parent, and 
+        returns the name of the new parent
+        """
+        return self.relayTree.place(relayName, failedParent)
+        
+    def renewRelay(self, relayName, parentName, viewers):
+        """
+        Keeps a relay in the tree, see RelayTree.renew
+        
+        Args:
+            relayName: string; name of the relay
+            parentName: string; name of the server it follows
+            viewers: int; number of viewers it serves
+        """
+        self.relayTree.renew(relayName, parentName, viewers)
+        
+    def findRelay(self, failedRelay=None):
+        """
+        Returns the name of the server a new read-only viewer should use: a
+        relay with room, or this server if it has no relays
+        
+        Args:
+            failedRelay: string; a relay the viewer could not reach
+        """
+        return self.relayTree.findViewerRelay(failedRelay)
+        
+    def beginImport(self, sendingClient):
+        """
+        Starts a bulk import of a whole new text by sendingClient, for 
+        example a file the user opened. The text is sent with importChunk in
+        pieces small enough for one Pyro call each, and replaces the current
+        text as one revision when endImport is called. Starting an import 
+        drops the client's unfinished one. Like setState, each of the three
+        calls counts as a write for the rate limits (see PypadAdmission.py)
+        """
+        def begin():
+            self.importLock.acquire()
+            try:
+                self.imports[sendingClient] = ([], [0])
+            finally:
+                self.importLock.release()
+        self.admission.admit(sendingClient, begin)
+        
+    def importChunk(self, sendingClient, offset, chunk):
+        """
+        Adds the next chunk of the text imported by sendingClient
+        
+        Args:
+            sendingClient: string; name of the importing client
+            offset: int; position of chunk in the imported text. It must be 
+                the length received so far, so lost or repeated chunks are
+                noticed
+            chunk: string; the next part of the text
+        
+        Returns the number of characters received so far
+        """
+        def add():
+            self.importLock.acquire()
+            try:
+                if sendingClient not in self.imports:
+                    raise ValueError('no import in progress')
+                chunks, received = self.imports[sendingClient]
+                if offset != received[0]:
+                    raise ValueError('expected the chunk at %d, got %d' % 
+                                     (received[0], offset))
+                chunks.append(chunk)
+                received[0] += len(chunk)
+                return received[0]
+            finally:
+                self.importLock.release()
+        return self.admission.admit(sendingClient, add)
+        
+    def endImport(self, sendingClient, traceId=None):
+        """
+        Replaces the text by the text imported by sendingClient and notifies
+        the other clients, like setState. Returns the new revision number.
+        """
+        def end():
+            self.importLock.acquire()
+            try:
+                if sendingClient not in self.imports:
+                    raise ValueError('no import in progress')
+                chunks, received = self.imports.pop(sendingClient)
+            finally:
+                self.importLock.release()
+            print '----------'
+            print 'Importing %d characters from %s' % (received[0], 
+                                                       sendingClient)
+            start = tracer.now()
+            rev = self.changeText(''.join(chunks), sendingClient)
+            tracer.span(traceId, 'server.endImport', start)
+            self.notifyClients(sendingClient, 'text', traceId, rev)
+            self.checkSender(sendingClient)
+            return rev
+        return self.admission.admit(sendingClient, end)
+    
+    def getMemoryStats(self):
+        """
+        See PypadData.getMemoryStats. Also returns 'clients': for each 
+        client, its outbox (see Server.getClientMemory) and the 'import' 
+        bytes received of an unfinished import, which count towards 'total'
+        """
+        stats = PypadData.getMemoryStats(self)
+        clients = self.getClientMemory()
+        self.importLock.acquire()
+        try:
+            imports = [(clientName, received[0]) for clientName, 
+                       (chunks, received) in self.imports.items()]
+        finally:
+            self.importLock.release()
+        for clientName, received in imports:
+            clients.setdefault(clientName, {'queued': 0, 'bytes': 0})
+            clients[clientName]['import'] = received
+        for memory in clients.values():
+            memory.setdefault('import', 0)
+            stats['total'] += memory['bytes'] + memory['import']
+        stats['clients'] = clients
+        return stats
+    
+    def unregister(self, clientName):
+        """Also drops the client's unfinished import, see Server.unregister"""
+        self.importLock.acquire()
+        try:
+            self.imports.pop(clientName, None)
+        finally:
+            self.importLock.release()
+        Server.unregister(self, clientName)
+        
+    def checkSender(self, sendingClient):
+        """
+        Sending a change renews the sender's lease. A client dropped after a 
+        failed notification learns about it here or when it next renews: it
+        is told with a 'dropped' notification and then reconnects.
+        """
+        if not self.renew(sendingClient):
+            Thread(target = self.notifyClientThread,
+                   args = [sendingClient, 'dropped']).start()
+        
+    def reconnect(self, clientName, lastRev=None, lastDrawingSeq=None,
+                  channels=DEFAULT_CHANNELS):
+        """
+        Registers clientName again after it was dropped, and returns what the 
+        client missed since the revision and drawing sequence number it last
+        applied, so that it doesn't have to download everything again.
+        
+        Args:
+            clientName: string; name the client got from register
+            lastRev: int; last text revision the client applied
+            lastDrawingSeq: int; last drawing sequence number it applied
+            channels: list of the channels the client was subscribed to
+        
+        Returns a dictionary with
+            'rev': the current revision
+            'edits': the edit script from lastRev to rev (see getDiff), or 
+                None if the client should re-download the text
+            'drawingSeq': the current drawing sequence number
+            'drawingOps': the drawing operations after lastDrawingSeq, or None
+                if they are no longer logged
+            'drawing': the whole drawing, only when drawingOps is None
+        """
+        self.clientLock.acquire()
+        try:
+            rejoined = not self.isRegistered(clientName)
+            if rejoined:
+                self.subscriptions[clientName] = \
+                    set(self.checkChannels(channels))
+                self.openOutbox(clientName)
+                self.clients.append(clientName)
+            self.leases[clientName] = time() + LEASE_TIME
+        finally:
+            self.clientLock.release()
+        if rejoined:
+            print 'Reconnected ' + clientName
+            self.notifyPresence(clientName)
+        
+        rev = self.getRevNum()
+        edits = None
+        if lastRev != None and 1 <= lastRev <= rev \
+        and rev - lastRev <= MAX_REPLAY_REVS:
+            edits = self.getDiff(lastRev, rev)
+        
+        drawingSeq, drawingOps = self.getDrawingOps(lastDrawingSeq)
+        drawing = None
+        if drawingOps == None:
+            drawingSeq, drawing = self.getDrawingState()
+        
+        return {'rev': rev, 'edits': edits, 
+                'drawingSeq': drawingSeq, 'drawingOps': drawingOps, 
+                'drawing': drawing}
         
     def getState(self, type):
         """
@@ -365,15 +1591,58 @@ class PypadServer(Server, PypadData):
         
 def main(script, *args):
     print "*** Pypad Server ***"
+    # forks the worker processes for CPU-heavy jobs before the server starts
+    # any threads; see PypadWorkers.py
+    workers.start()
     server = PypadServer('Pypad_dot_com')
     server.VERBOSE = False
     
-    for arg in args:
-        if args == "-v":
+    checkpointer = None
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == "-v":
             server.VERBOSE = True;
+        elif arg == "-t":
+            # writes edit propagation spans, see PypadTrace.py
+            tracer.enable('server', 'pypad_server_trace.log')
+        elif arg == "-c":
+            # persists the document in the given directory, recovering it
+            # from there first; see PypadCheckpoint.py
+            checkpointer = Checkpointer(server, args.pop(0))
+            checkpointer.start()
+        elif arg == "-m":
+            # keeps at most this many megabytes of revisions in memory and
+            # spills older ones to disk; see PypadHistory.py
+            server.history.budget = int(float(args.pop(0)) * 1024 * 1024)
+        elif arg == "-crdt":
+            # merges concurrent edits as CRDT operations, see PypadCrdt.py.
+            # Put it after -c and -i, so it starts from the loaded text
+            server.enableCrdt()
+        elif arg == "-rate":
+            # writes per second and burst of each client, then of the 
+            # document, see PypadAdmission.py
+            limits = [float(args.pop(0)) for i in range(4)]
+            server.admission.setLimits(*limits)
+        elif arg == "-thin":
+            # keeps hourly, then daily revisions of old history
+            server.history.thinning = THINNING
+        elif arg == "-i":
+            # replaces the document by an archive, see PypadArchive.py. 
+            # With -c, put -c first so the import gets checkpointed
+            f = open(args.pop(0), 'rb')
+            try:
+                print 'Imported %d revisions' % importArchive(server, f)
+            finally:
+                f.close()
             
-    
-    server.requestLoop()    #starts the server
+    try:
+        server.requestLoop()    #starts the server
+    finally:
+        if checkpointer != None:
+            checkpointer.stop()
+        workers.stop()
+        server.history.cleanup()
 
 if __name__ == '__main__':
     main(*sys.argv)
\ No newline at end of file
@@ -0,0 +1,186 @@
+"""
+PypadTrace.py
+
+INTRODUCTION
+Contains the Tracer class, which records timestamped spans for an edit as it
+travels from PypadGuiText.onTextChange, through the PypadClient loops and the
+PypadServer, to the PypadGuiText.setText call on a remote client.
+
+Every edit is given a trace id when the user first types it. The trace id is
+passed along with the Pyro calls (setState, notify), so each process can write
+the spans it sees into its own local trace file. Merging the trace files of
+the server and clients by trace id gives the whole keystroke-to-screen path.
+
+Tracing is off by default and costs one attribute check per span when off.
+
+TRACE FILE FORMAT
+One JSON object per line:
+    {"trace": "<trace id>", "span": "<span name>", "process": "<process>",
+     "thread": "<thread name>", "start": <seconds>, "end": <seconds>}
+Timestamps are time.time() values, so trace files of processes on the same
+machine (or on machines with synchronized clocks) can be compared directly.
+
+USAGE
+    from PypadTrace import tracer
+    tracer.enable('server', 'pypad_server_trace.log')
+
+    start = tracer.now()
+    ... do work ...
+    tracer.span(traceId, 'server.setState', start)
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+class Tracer:
+    """
+    A Tracer hands out trace ids and writes spans to a local trace file.
+
+    A disabled tracer (the default) returns None for trace ids and ignores
+    spans, so callers don't need to check whether tracing is turned on.
+    """
+    def __init__(self):
+        """Constructor for Tracer. Tracers start out disabled."""
+        self.enabled = False
+        self.processName = None
+        self.traceFile = None
+        self.lock = threading.Lock()
+        self.counter = 0
+
+    def enable(self, processName, filename):
+        """
+        Turns on tracing, appending spans to filename
+
+        Args:
+            processName: string; name written with every span, and used as
+                the prefix of the trace ids handed out by this process
+            filename: string; path of the local trace file
+        """
+        self.lock.acquire()
+        try:
+            if self.traceFile != None:
+                self.traceFile.close()
+            self.processName = processName
+            self.traceFile = open(filename, 'a')
+            # trace ids only need to be unique across the processes that are
+            # traced together, so a random start keeps clients from clashing
+            self.counter = random.randint(0, 1000000)
+            self.enabled = True
+        finally:
+            self.lock.release()
+
+    def disable(self):
+        """Turns off tracing and closes the trace file"""
+        self.lock.acquire()
+        try:
+            self.enabled = False
+            if self.traceFile != None:
+                self.traceFile.close()
+                self.traceFile = None
+        finally:
+            self.lock.release()
+
+    def now(self):
+        """Returns the timestamp used for spans"""
+        return time.time()
+
+    def newTraceId(self):
+        """
+        Returns a new trace id, or None when tracing is disabled
+        """
+        if not self.enabled:
+            return None
+        self.lock.acquire()
+        try:
+            self.counter += 1
+            return '%s-%d-%d' % (self.processName, os.getpid(), self.counter)
+        finally:
+            self.lock.release()
+
+    def span(self, traceId, name, start, end=None):
+        """
+        Writes one span to the trace file
+
+        Args:
+            traceId: string; trace id of the edit. Spans without a trace id
+                are ignored, so untraced edits don't show up in the file
+            name: string; name of the span, such as 'server.setState'
+            start: float; timestamp from tracer.now() when the span began
+            end: float; timestamp when the span ended. Defaults to now
+        """
+        if not self.enabled or traceId == None:
+            return
+        if end == None:
+            end = self.now()
+        record = {'trace': traceId,
+                  'span': name,
+                  'process': self.processName,
+                  'thread': threading.currentThread().getName(),
+                  'start': start,
+                  'end': end}
+        line = json.dumps(record) + '\n'
+        self.lock.acquire()
+        try:
+            if self.traceFile != None:
+                self.traceFile.write(line)
+                self.traceFile.flush()
+        finally:
+            self.lock.release()
+
+    def mark(self, traceId, name):
+        """Writes a zero-length span, marking the moment something happened"""
+        if not self.enabled or traceId == None:
+            return
+        t = self.now()
+        self.span(traceId, name, t, t)
+
+def readTrace(*filenames):
+    """
+    Reads spans from one or more trace files and groups them by trace id,
+    with each trace's spans sorted by start time. Used to profile the
+    keystroke-to-screen path offline.
+
+    Args:
+        filenames: paths of trace files, typically one per process
+
+    Returns:
+        a dictionary from trace id to a list of span dictionaries
+    """
+    traces = dict()
+    for filename in filenames:
+        f = open(filename, 'r')
+        for line in f:
+            line = line.strip()
+            if line == '':
+                continue
+            record = json.loads(line)
+            traces.setdefault(record['trace'], []).append(record)
+        f.close()
+    for spans in traces.values():
+        spans.sort(key = lambda record: record['start'])
+    return traces
+
+# the tracer shared by every module in this process
+tracer = Tracer()
+
+def main(script, *filenames):
+    """
+    Prints the spans of each trace in the given trace files, with times
+    relative to the first span of the trace in milliseconds
+    """
+    traces = readTrace(*filenames)
+    for traceId, spans in sorted(traces.items(),
+                                 key = lambda item: item[1][0]['start']):
+        origin = spans[0]['start']
+        print traceId
+        for record in spans:
+            print '    %-28s %-12s %9.2f ms %9.2f ms' % (record['span'],
+                record['process'], (record['start'] - origin) * 1000,
+                (record['end'] - record['start']) * 1000)
+
+if __name__ == '__main__':
+    main(*sys.argv)
@@ -0,0 +1,301 @@
+"""
+PypadWorkers.py
+
+INTRODUCTION
+Contains the WorkerPool class, a pool of worker processes for the server's
+CPU-bound jobs, and the global pool, workers.
+
+Python threads share one interpreter lock, so a request thread rasterizing a
+big drawing or compressing a large segment keeps the editors' setState
+calls waiting for the CPU, however many handler threads there are. Jobs run
+by the pool use other processes (and other cores), and the thread that asked
+for them only waits for the result, which doesn't hold the lock.
+
+JOBS
+    rasterize   drawing a whole drawing and encoding it as a PNG image for
+                getDrawingSnapshot (see PypadRaster.py)
+    compress    compressing and writing a spilled history segment (see
+                RevisionStore.writeSegment)
+
+Searching the history and diffing revisions stay in the server process:
+they read the in-memory ropes, which the workers don't have. A worker would
+have to be sent the texts first, and writing them out costs about as much
+as the work itself. getDiff only compares the range the edits between the
+two revisions changed (see PypadServer.getDiff), so it is cheap in process.
+
+SHARED BUFFERS
+Large inputs are not pickled through the pool's pipe. The server writes them
+to a SharedBuffer, a file in /dev/shm (memory, not disk, where available),
+and the worker maps the file read only. Results are small (an image, a
+size) and come back through the pipe.
+
+Compressions of fewer than OFFLOAD_MIN_BYTES, and all jobs while the pool
+isn't started, run in the calling thread: passing them to another process
+would cost more than it saves. So does a job whose worker fails or takes
+longer than JOB_TIMEOUT seconds: it is run again in the calling thread, so
+the server never loses a snapshot or a segment to a broken worker. The
+partial file such a worker may leave behind is removed. Rasterizing always goes to a worker;
+it is only asked for drawings of SNAPSHOT_MIN_SEGMENTS or more (see
+PypadServer.py), which cost far more than the trip.
+
+PypadServer's main starts the pool before the server starts any threads,
+since forking a process with running threads can leave locks held in the
+child.
+"""
+
+from PypadRaster import DrawingRaster, encodePng, segmentCoords
+from array import array
+import glob
+import multiprocessing
+import mmap
+import os
+import signal
+import tempfile
+import threading
+import zlib
+
+# worker processes; one core is left for the server's own threads
+WORKER_PROCESSES = max(1, multiprocessing.cpu_count() - 1)
+
+# jobs with inputs smaller than this many bytes run in the calling thread
+OFFLOAD_MIN_BYTES = 256 * 1024
+
+# seconds a job may take before the caller gives up on it
+JOB_TIMEOUT = 120
+
+# where shared buffers are made: memory backed where available
+if os.path.isdir('/dev/shm'):
+    SHARED_DIRECTORY = '/dev/shm'
+else:
+    SHARED_DIRECTORY = None
+
+# bytes of a mapped buffer compressed at a time
+COMPRESS_CHUNK = 1024 * 1024
+
+class SharedBuffer:
+    """
+    Data passed to a worker through a memory-mapped file, see above. The
+    file is removed by close
+    """
+    def __init__(self, data):
+        """
+        Constructor for SharedBuffer
+
+        Args:
+            data: string or array; the data the worker reads
+        """
+        fd, self.path = tempfile.mkstemp(prefix = 'pypad_shared_',
+                                         dir = SHARED_DIRECTORY)
+        f = os.fdopen(fd, 'wb')
+        try:
+            if isinstance(data, array):
+                data.tofile(f)
+                self.size = len(data) * data.itemsize
+            else:
+                f.write(data)
+                self.size = len(data)
+        finally:
+            f.close()
+
+    def close(self):
+        """Removes the file"""
+        os.remove(self.path)
+
+def openShared(path, size):
+    """
+    Maps a SharedBuffer read only, in a worker. Returns '' for an empty
+    buffer, which can't be mapped
+    """
+    if size == 0:
+        return ''
+    f = open(path, 'rb')
+    try:
+        return mmap.mmap(f.fileno(), size, access = mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+def closeShared(mapped):
+    """Unmaps a buffer opened by openShared"""
+    if mapped != '':
+        mapped.close()
+
+# The jobs, run in the workers. Their arguments and results are pickled
+def rasterizeJob(path, size, width, height):
+    """
+    Draws the segments in a shared buffer (see PypadRaster.segmentCoords).
+    Returns (pixels, image): the raster's pixels and its PNG image
+    """
+    mapped = openShared(path, size)
+    try:
+        coords = array('i')
+        coords.fromstring(mapped[:])
+    finally:
+        closeShared(mapped)
+    raster = DrawingRaster(width, height)
+    for i in range(0, len(coords), 4):
+        raster.line((coords[i], coords[i + 1]),
+                    (coords[i + 2], coords[i + 3]))
+    pixels = str(raster.pixels)
+    return pixels, encodePng(width, height, pixels)
+
+def compressJob(path, size, target, level):
+    """
+    Compresses a shared buffer with zlib into the file target, flushed to
+    disk. Returns the compressed size. The file is written under another
+    name and renamed to target when complete, since a worker that timed
+    out may still be writing it while the job runs again elsewhere (see
+    WorkerPool.run)
+    """
+    mapped = openShared(path, size)
+    compressor = zlib.compressobj(level)
+    written = 0
+    partial = '%s.%d' % (target, os.getpid())
+    f = open(partial, 'wb')
+    try:
+        for start in range(0, size, COMPRESS_CHUNK):
+            chunk = compressor.compress(mapped[start :
+                                               start + COMPRESS_CHUNK])
+            f.write(chunk)
+            written += len(chunk)
+        chunk = compressor.flush()
+        f.write(chunk)
+        written += len(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+        closeShared(mapped)
+    os.rename(partial, target)
+    return written
+
+def ignoreInterrupts():
+    """Initializer of the workers: Ctrl-C stops the server, not them"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+class WorkerPool:
+    """
+    The worker processes and the jobs they run, see above. Thread safe
+    """
+    def __init__(self):
+        """Constructor for WorkerPool. The pool starts stopped"""
+        self.pool = None
+        self.processes = 0
+        self.lock = threading.Lock()
+        # jobs run by the workers and in the calling thread, and jobs the
+        # workers failed, by job name
+        self.offloaded = {}
+        self.inline = {}
+        self.failed = {}
+
+    def start(self, processes=WORKER_PROCESSES):
+        """Starts the worker processes"""
+        self.stop()
+        self.pool = multiprocessing.Pool(processes, ignoreInterrupts)
+        self.processes = processes
+
+    def stop(self):
+        """Stops the worker processes; jobs run in the calling thread"""
+        pool, self.pool = self.pool, None
+        self.processes = 0
+        if pool != None:
+            pool.terminate()
+            pool.join()
+
+    def offload(self, size):
+        """Returns whether a job with size bytes of input goes to a worker"""
+        return self.pool != None and size >= OFFLOAD_MIN_BYTES
+
+    def count(self, counts, job):
+        """Adds one to the count of job in counts"""
+        self.lock.acquire()
+        try:
+            counts[job] = counts.get(job, 0) + 1
+        finally:
+            self.lock.release()
+
+    def run(self, job, function, *args):
+        """
+        Returns function(*args), run by a worker, or in the calling thread
+        if the pool is stopped or the worker fails or times out
+        """
+        pool = self.pool
+        if pool != None:
+            self.count(self.offloaded, job)
+            try:
+                return pool.apply_async(function, args).get(JOB_TIMEOUT)
+            except Exception, e:
+                # including multiprocessing.TimeoutError
+                print 'Worker job %s failed, running it here:' % job, \
+                    repr(e)
+                self.count(self.failed, job)
+        self.count(self.inline, job)
+        return function(*args)
+
+    def rasterize(self, drawing, width, height):
+        """
+        Returns (pixels, image): drawing rasterized (see DrawingRaster) and
+        its PNG image
+        """
+        if self.pool == None:
+            self.count(self.inline, 'rasterize')
+            raster = DrawingRaster(width, height)
+            raster.draw(drawing)
+            pixels = str(raster.pixels)
+            return pixels, encodePng(width, height, pixels)
+        buffer = SharedBuffer(segmentCoords(drawing, width, height))
+        try:
+            return self.run('rasterize', rasterizeJob, buffer.path,
+                            buffer.size, width, height)
+        finally:
+            buffer.close()
+
+    def compressFile(self, data, target, level):
+        """
+        Writes data compressed with zlib at level to the file target and
+        flushes it to disk. Returns the compressed size
+        """
+        if not self.offload(len(data)):
+            self.count(self.inline, 'compress')
+            compressed = zlib.compress(data, level)
+            f = open(target, 'wb')
+            try:
+                f.write(compressed)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            return len(compressed)
+        buffer = SharedBuffer(data)
+        try:
+            return self.run('compress', compressJob, buffer.path,
+                            buffer.size, target, level)
+        finally:
+            buffer.close()
+            # a worker that was killed or timed out leaves its partial
+            # file (see compressJob); one that finished renamed it
+            for partial in glob.glob(target + '.[0-9]*'):
+                try:
+                    os.remove(partial)
+                except OSError:
+                    pass
+
+    def stats(self):
+        """
+        Returns a dictionary with
+            'processes': worker processes running, 0 when stopped
+            'offloaded': jobs run by the workers, by job name
+            'inline': jobs run in the calling thread, by job name
+            'failed': jobs that failed or timed out in a worker and were
+                run in the calling thread, by job name
+        """
+        self.lock.acquire()
+        try:
+            return {'processes': self.processes,
+                    'offloaded': dict(self.offloaded),
+                    'inline': dict(self.inline),
+                    'failed': dict(self.failed)}
+        finally:
+            self.lock.release()
+
+# the server's pool, started by PypadServer's main
+workers = WorkerPool()
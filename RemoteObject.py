@@ -4,9 +4,13 @@ import threading
 import socket
 import os
 import signal
+import errno
+import fcntl
 
-# change me as appropriate when you run the app!
-default_ns_host = '192.168.150.1'
+# change me as appropriate when you run the app! The PYPAD_NS_HOST environment
+# variable overrides it, e.g. PYPAD_NS_HOST=localhost to run everything on one
+# machine
+default_ns_host = os.environ.get('PYPAD_NS_HOST', '192.168.150.1')
 
 class MyThread(threading.Thread):
     """this is a wrapper for threading.Thread that improves
@@ -61,6 +65,61 @@ class Watcher:
         except OSError: pass
 
 
+class Wakeup:
+    """a pipe that wakes up a request loop waiting in select, so
+    that stopping the loop or handing it work from another thread
+    takes effect right away instead of at the next timeout.  Pass
+    it to handleRequests as one of the 'others' with run as the
+    callback.
+    """
+
+    def __init__(self):
+        self.reader, self.writer = os.pipe()
+        for fd in (self.reader, self.writer):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def fileno(self):
+        return self.reader
+
+    def wake(self):
+        """make the loop's select return"""
+        try:
+            os.write(self.writer, 'x')
+        except OSError, e:
+            # a full pipe wakes the loop just as well
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def call(self, function, *args):
+        """run function(*args) in the loop's thread, soon"""
+        self.lock.acquire()
+        try:
+            self.pending.append((function, args))
+        finally:
+            self.lock.release()
+        self.wake()
+
+    def run(self, ready=None):
+        """empty the pipe and run the pending calls; this is the
+        callback of handleRequests"""
+        try:
+            while os.read(self.reader, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        self.lock.acquire()
+        try:
+            pending, self.pending = self.pending, []
+        finally:
+            self.lock.release()
+        for function, args in pending:
+            function(*args)
+
+
 def get_ip_addr():
     port = 9090
     """get the real IP address of this machine"""
@@ -130,6 +189,12 @@ class RemoteObject(Pyro.core.ObjBase):
     from this class, and either (1) don't override __init__ or
     (2) call RemoteObject.__init__ explicitly"""
 
+    # by default Pyro handles every connection in a thread of its
+    # own.  Objects that set this to False get a daemon that leaves
+    # the connections to the request loop, e.g. to hand them to a
+    # pool of handler threads (see PypadRequests.py)
+    multithreaded = True
+
     def __init__(self, name = None, ns = None):
         Pyro.core.ObjBase.__init__(self)
 
@@ -146,10 +211,17 @@ class RemoteObject(Pyro.core.ObjBase):
         """connect to the given name server with the given name"""
 
         # create the daemon (the attribute is spelled "demon" to
-        # avoid a name collision)
+        # avoid a name collision).  Pyro reads the threading mode
+        # from its config when the daemon is made
         addr = get_ip_addr()
-        self.demon = Pyro.core.Daemon(host=addr)
+        threaded = Pyro.config.PYRO_MULTITHREADED
+        Pyro.config.PYRO_MULTITHREADED = int(self.multithreaded)
+        try:
+            self.demon = Pyro.core.Daemon(host=addr)
+        finally:
+            Pyro.config.PYRO_MULTITHREADED = threaded
         self.demon.useNameServer(ns.ns)
+        self.wakeup = Wakeup()
 
         # instantiate the object and advertise it
         try:
@@ -164,7 +236,8 @@ class RemoteObject(Pyro.core.ObjBase):
     def requestLoop(self):
         """run the request loop until an exception occurs"""
         try:
-            self.demon.requestLoop()
+            self.demon.requestLoop(others=[self.wakeup],
+                                   callback=self.wakeup.run)
         except:
             self.cleanup()
             if sys.exc_type != KeyboardInterrupt:
@@ -186,17 +259,21 @@ class RemoteObject(Pyro.core.ObjBase):
         self.thread.start()
         
     def stoppableLoop(self):
-        """run handleRequests until another thread clears self.running"""
+        """run handleRequests until another thread calls stopLoop"""
         self.running = 1
         try:
             while self.running:
-                self.demon.handleRequests(0.1)
+                # no timeout: stopLoop wakes the select up
+                self.demon.handleRequests(None, [self.wakeup],
+                                          self.wakeup.run)
         finally:
             self.cleanup()
 
     def stopLoop(self):
         """if threadLoop is running, stop it"""
         self.running = 0
+        if hasattr(self, 'wakeup'):
+            self.wakeup.wake()
 
     def join(self):
         """wait for the threadLoop to complete"""